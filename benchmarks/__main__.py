@@ -0,0 +1,179 @@
+"""
+Benchmarks for the decode and load throughput of the converter.
+
+Every stage runs in a fresh process, so that the reported peak RSS belongs to that stage only.
+The results are written as json, and can be compared with an earlier run to catch regressions.
+
+    python -m benchmarks --synthetic 200000 --output bench_output.json
+    python -m benchmarks --baseline bench_output.json
+    python -m benchmarks --pg_host localhost --pg_password postgres
+"""
+import os, sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import multiprocessing
+
+from benchmarks import stages
+from benchmarks.synthetic import write_zone, write_ascii_catalog
+
+# the bundled sample files in the root of the repository
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_stage(stage, input_name, params, repeat):
+    """ run a stage 'repeat' times, each in a new process, and keep the fastest run """
+    context = multiprocessing.get_context('spawn')
+    runs = []
+    for i in range(repeat):
+        with context.Pool(1) as pool:
+            runs.append(pool.apply(stages.measure_stage, (stage.__name__, params)))
+
+    records, seconds, size, peak_rss = min(runs, key=lambda run: run[1])
+    result = {
+        'stage': stage.__name__,
+        'input': input_name,
+        'records': records,
+        'seconds': round(seconds, 6),
+        'records_per_sec': round(records / seconds) if seconds > 0 else None,
+        'bytes_per_sec': round(size / seconds) if seconds > 0 and size else None,
+        'peak_rss_kb': peak_rss,
+    }
+    print(result['stage'] + " " + input_name + ": " + str(result['records_per_sec']) + " records/sec", file=sys.stderr)
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """
+    compare the records/sec per stage and input with a baseline run
+    :return: the list of regressions (slower than tolerance)
+    """
+    previous = {(r['stage'], r['input']): r for r in baseline['results']}
+    regressions = []
+
+    for result in results:
+        old = previous.get((result['stage'], result['input']))
+        if not old or not old['records_per_sec'] or not result['records_per_sec']:
+            continue
+
+        ratio = result['records_per_sec'] / old['records_per_sec']
+        result['baseline_ratio'] = round(ratio, 3)
+        if ratio < 1 - tolerance:
+            regressions.append(result)
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the decode and load stages of the UCAC4 converter")
+    parser.add_argument("--stages",
+                        default=None,
+                        help="comma separated list of stages to run, default all")
+    parser.add_argument("--synthetic",
+                        default="100000",
+                        help="comma separated sizes (number of stars) of synthetic zones to generate, 0 for none")
+    parser.add_argument("--batch_size",
+                        default=10000,
+                        type=int,
+                        help="number of stars per batch/transaction")
+    parser.add_argument("--repeat",
+                        default=3,
+                        type=int,
+                        help="run every stage this many times and report the fastest")
+    parser.add_argument("--output",
+                        default=None,
+                        help="write the json results to this file, default stdout")
+    parser.add_argument("--baseline",
+                        default=None,
+                        help="json results of an earlier run to compare with")
+    parser.add_argument("--tolerance",
+                        default=0.2,
+                        type=float,
+                        help="a stage that is slower than the baseline by more than this fraction is a regression")
+    parser.add_argument("--pg_host",
+                        default=None,
+                        help="postgres host (or socket directory) of a local test instance, no postgres stages when omitted")
+    parser.add_argument("--pg_port",
+                        default="5432",
+                        help="postgres port")
+    parser.add_argument("--pg_user",
+                        default="postgres",
+                        help="postgres user")
+    parser.add_argument("--pg_password",
+                        default="postgres",
+                        help="postgres password")
+    parser.add_argument("--pg_database",
+                        default="ucac4_benchmark",
+                        help="postgres database that is created for the benchmark")
+    args = parser.parse_args()
+
+    selected = args.stages.split(',') if args.stages else None
+
+    def _selected(stage_list):
+        return [stage for stage in stage_list if selected is None or stage.__name__ in selected]
+
+    with tempfile.TemporaryDirectory() as directory:
+        # the inputs with the stages that apply to them
+        inputs = [
+            ('z001', os.path.join(repository, 'z001'), stages.binary_stages + stages.postgres_stages),
+            ('z001.asc', os.path.join(repository, 'z001.asc'), stages.ascii_stages),
+            ('UCAC4_sample.txt', os.path.join(repository, 'UCAC4_sample.txt'), stages.ascii_catalog_stages),
+        ]
+        for size in [int(size) for size in args.synthetic.split(',') if int(size) > 0]:
+            zone_directory = os.path.join(directory, str(size))
+            os.makedirs(zone_directory)
+            inputs.append(('synthetic_' + str(size), write_zone(zone_directory, size),
+                           stages.binary_stages + stages.postgres_stages))
+            inputs.append(('synthetic_ascii_' + str(size),
+                           write_ascii_catalog(zone_directory, size, os.path.join(repository, 'UCAC4_sample.txt')),
+                           stages.ascii_catalog_stages))
+
+        postgres = None
+        if args.pg_host:
+            postgres = {
+                'host': args.pg_host,
+                'port': args.pg_port,
+                'user': args.pg_user,
+                'password': args.pg_password,
+                'database': 'postgres',
+                'benchmark_database': args.pg_database,
+            }
+
+        results = []
+        for input_name, source_location, stage_list in inputs:
+            for stage in _selected(stage_list):
+                if stage in stages.postgres_stages and not postgres:
+                    continue
+
+                params = {'source_location': source_location, 'batch_size': args.batch_size, 'postgres': postgres}
+                results.append(run_stage(stage, input_name, params, args.repeat))
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'batch_size': args.batch_size,
+        'results': results,
+    }
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        report['regressions'] = [r['stage'] + ' ' + r['input'] for r in regressions]
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if regressions:
+        print("regressions: " + ", ".join(report['regressions']), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
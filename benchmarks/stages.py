@@ -0,0 +1,178 @@
+import os, sys
+import time
+import resource
+import argparse
+import tempfile
+
+from ucac4_convert.decoder import record_size, read_binary_zone, decode_columns, iter_star_batches, iter_csv_chunks, column_to_list
+from ucac4_convert.ascii_reader import iter_ascii_lines, iter_ascii_columns, is_u4dump_file
+from ucac4_convert.converters import read_binary_stars_with_struct, parse_ascii_line
+from ucac4_convert.database_helper import \
+    open_sqlite_database, \
+    open_postgres_database, \
+    add_stars_to_sqlite, \
+    add_stars_to_postgres, \
+    copy_stars_to_postgres, \
+    create_table_schema
+
+# Every stage gets a dict of parameters and returns (records, seconds, bytes) of only the measured part,
+# so that preparing the input (like decoding the stars for a write stage) is not part of the timing.
+
+
+def _zone(source_location):
+    return int(source_location[-3:])
+
+
+def _decoded_stars(source_location, batch_size):
+    columns = decode_columns(read_binary_zone(source_location))
+    return list(iter_star_batches(_zone(source_location), columns, batch_size))
+
+
+def decode_struct(params):
+    """ binary decode, record by record with struct.unpack (--decoder struct) """
+    source_location = params['source_location']
+    timestamp = time.perf_counter()
+    records = 0
+    for stars in read_binary_stars_with_struct(_zone(source_location), source_location, params['batch_size']):
+        records = records + len(stars)
+    return records, time.perf_counter() - timestamp, os.path.getsize(source_location)
+
+
+def decode_numpy(params):
+    """ binary decode of whole zones with numpy, including building the star tuples for the writers """
+    source_location = params['source_location']
+    timestamp = time.perf_counter()
+    records = 0
+    columns = decode_columns(read_binary_zone(source_location))
+    for stars in iter_star_batches(_zone(source_location), columns, params['batch_size']):
+        records = records + len(stars)
+    return records, time.perf_counter() - timestamp, os.path.getsize(source_location)
+
+
+def decode_numpy_columns(params):
+    """ binary decode of whole zones into numpy columns only (as used by the columnar and COPY targets) """
+    source_location = params['source_location']
+    timestamp = time.perf_counter()
+    columns = decode_columns(read_binary_zone(source_location))
+    return len(columns['mpos1']), time.perf_counter() - timestamp, os.path.getsize(source_location)
+
+
+def ascii_read(params):
+    """ stream the lines of an ascii file, without parsing. Only the stars are counted, not the header """
+    source_location = params['source_location']
+    skip = 0 if is_u4dump_file(source_location) else 1
+    timestamp = time.perf_counter()
+    records = 0
+    for line in iter_ascii_lines(source_location, skip):
+        if line.strip():
+            records = records + 1
+    return records, time.perf_counter() - timestamp, os.path.getsize(source_location)
+
+
+def ascii_parse(params):
+    """ parse the lines of the UCAC4 ascii catalog (like UCAC4_sample.txt) with parse_ascii_line """
+    source_location = params['source_location']
+    timestamp = time.perf_counter()
+    records = 0
+    for line in iter_ascii_lines(source_location, 1):
+        if line.strip():
+            parse_ascii_line(line)
+            records = records + 1
+    return records, time.perf_counter() - timestamp, os.path.getsize(source_location)
+
+
+def ascii_parse_numpy(params):
+    """ parse an ascii file (the catalog or u4dump) in chunks of lines with numpy, including building the star tuples """
+    source_location = params['source_location']
+    timestamp = time.perf_counter()
+    records = 0
+    for columns, size in iter_ascii_columns(source_location, params['batch_size']):
+        stars = list(zip(*[column_to_list(column) for column in columns.values()]))
+        records = records + len(stars)
+    return records, time.perf_counter() - timestamp, os.path.getsize(source_location)
+
+
+def sqlite_write(params):
+    """ write decoded stars into a new sqlite database with the batch writer """
+    star_batches = _decoded_stars(params['source_location'], params['batch_size'])
+
+    with tempfile.TemporaryDirectory() as directory:
+        database_name = os.path.join(directory, 'benchmark.sqlite3')
+        conn = open_sqlite_database(database_name, create_table_schema.replace("replace-with-zone", 'stars'), True)
+
+        timestamp = time.perf_counter()
+        records = 0
+        for stars in star_batches:
+            add_stars_to_sqlite(conn, 'stars', stars, params['batch_size'])
+            records = records + len(stars)
+        seconds = time.perf_counter() - timestamp
+
+        conn.close()
+
+    # the bytes of the records that were written, like the decode stages (not the size of the database file)
+    return records, seconds, records * record_size
+
+
+def _open_postgres(params):
+    args = argparse.Namespace(**params['postgres'])
+    schema = create_table_schema.replace("replace-with-zone", 'benchmark_stars')
+    conn = open_postgres_database(args, args.benchmark_database, schema)
+
+    # start every run with an empty table
+    cur = conn.cursor()
+    cur.execute("TRUNCATE benchmark_stars")
+    conn.commit()
+    return conn
+
+
+def postgres_insert(params):
+    """ write decoded stars into postgres with the batch writer (execute_values) """
+    star_batches = _decoded_stars(params['source_location'], params['batch_size'])
+    conn = _open_postgres(params)
+
+    timestamp = time.perf_counter()
+    records = 0
+    for stars in star_batches:
+        add_stars_to_postgres(conn, 'benchmark_stars', stars, params['batch_size'])
+        records = records + len(stars)
+    seconds = time.perf_counter() - timestamp
+
+    conn.close()
+    return records, seconds, 0
+
+
+def postgres_copy(params):
+    """ bulk load decoded columns into postgres with COPY FROM STDIN (the postgres-copy target) """
+    source_location = params['source_location']
+    columns = decode_columns(read_binary_zone(source_location))
+    conn = _open_postgres(params)
+
+    timestamp = time.perf_counter()
+    csv_chunks = iter_csv_chunks(_zone(source_location), columns, params['batch_size'])
+    records = copy_stars_to_postgres(conn, 'benchmark_stars', csv_chunks)
+    seconds = time.perf_counter() - timestamp
+
+    conn.close()
+    return records, seconds, 0
+
+
+def measure_stage(stage_name, params):
+    """
+    run a stage in this process and measure its peak memory.
+    The benchmark runs this in a fresh process for every stage, so the peak belongs to that stage only.
+    """
+    records, seconds, size = globals()[stage_name](params)
+
+    # ru_maxrss is in kilobytes on Linux, and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak_rss = peak_rss // 1024
+
+    return records, seconds, size, peak_rss
+
+
+# the stages per kind of input
+binary_stages = [decode_struct, decode_numpy, decode_numpy_columns, sqlite_write]
+postgres_stages = [postgres_insert, postgres_copy]
+ascii_stages = [ascii_read, ascii_parse_numpy]
+ascii_catalog_stages = [ascii_read, ascii_parse, ascii_parse_numpy]
@@ -0,0 +1,64 @@
+import os
+import numpy as np
+
+from ucac4_convert.decoder import ucac4_dtype, missing_magnitude
+
+
+def generate_zone(number_of_stars, zone=451, seed=0):
+    """
+    generate a synthetic binary zone with the 78 byte record layout.
+    The stars are sorted on ra and lie within the declination band of the zone,
+    about 20% of the APASS magnitudes and 5% of the 2MASS magnitudes are missing (20000).
+    """
+    rng = np.random.default_rng(seed)
+    records = np.zeros(number_of_stars, dtype=ucac4_dtype)
+
+    records['ra'] = np.sort(rng.integers(0, 360 * 3600000, number_of_stars))
+    spd_min = (zone - 1) * 720000
+    records['spd'] = rng.integers(spd_min, spd_min + 720000, number_of_stars)
+    records['magm'] = rng.integers(8000, 16500, number_of_stars)
+    records['maga'] = records['magm'] + rng.integers(-200, 200, number_of_stars)
+    records['objt'] = rng.choice([0, 0, 0, 0, 1, 3, 8], number_of_stars)
+    records['pmrac'] = rng.integers(-2000, 2000, number_of_stars)
+    records['pmdc'] = rng.integers(-2000, 2000, number_of_stars)
+    records['cepra'] = rng.integers(9000, 10500, number_of_stars)
+    records['cepdc'] = rng.integers(9000, 10500, number_of_stars)
+
+    for field in ['j_m', 'h_m', 'k_m']:
+        values = rng.integers(6000, 16000, number_of_stars)
+        values[rng.random(number_of_stars) < 0.05] = missing_magnitude
+        records[field] = values
+
+    apasm = rng.integers(8000, 17000, (number_of_stars, 5))
+    apasm[rng.random((number_of_stars, 5)) < 0.2] = missing_magnitude
+    records['apasm'] = apasm
+
+    records['rnm'] = 1000000 * zone + np.arange(1, number_of_stars + 1)
+    matched = rng.random(number_of_stars) < 0.7
+    records['zn2'] = np.where(matched, rng.integers(1, 289, number_of_stars), 0)
+    records['rn2'] = np.where(matched, rng.integers(1, 200000, number_of_stars), 0)
+    return records
+
+
+def write_zone(directory, number_of_stars, zone=451, seed=0):
+    """ write a synthetic zone file like ../z451 and return its location """
+    source_location = os.path.join(directory, 'z' + str(zone).zfill(3))
+    generate_zone(number_of_stars, zone, seed).tofile(source_location)
+    return source_location
+
+
+def write_ascii_catalog(directory, number_of_stars, sample_location):
+    """
+    write a synthetic ascii catalog like UCAC4_sample.txt, with its header and its lines repeated
+    up to number_of_stars lines, and return its location
+    """
+    with open(sample_location) as f:
+        header = f.readline()
+        lines = [line.rstrip('\n') + '\n' for line in f if line.strip()]
+
+    source_location = os.path.join(directory, 'UCAC4_synthetic.txt')
+    with open(source_location, 'w') as f:
+        f.write(header)
+        for start in range(0, number_of_stars, len(lines)):
+            f.writelines(lines[:number_of_stars - start])
+    return source_location
@@ -1,6 +1,6 @@
 from setuptools import setup, find_packages
 
-requirements = ['requests','psycopg2','pika']
+requirements = ['requests','psycopg2','pika','numpy']
 
 setup(name='ucac4_converter',
       version='1.0.0',
@@ -10,7 +10,10 @@ setup(name='ucac4_converter',
       author_email='nvermaas@xs4all.nl',
       license='BSD',
       install_requires=requirements,
-      packages=find_packages(),
+      extras_require={
+            'parquet': ['pyarrow']
+      },
+      packages=find_packages(exclude=['benchmarks']),
       entry_points={
             'console_scripts': [
                   'ucac4=ucac4_convert.main:main'
@@ -0,0 +1,94 @@
+import os
+import bz2
+import gzip
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from ucac4_convert.converters import parse_ascii_line
+from ucac4_convert.ascii_reader import iter_ascii_lines, iter_ascii_columns
+from ucac4_convert.decoder import read_binary_zone, decode_columns, select_columns, column_to_list
+
+# the bundled samples in the root of the repository
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sample = os.path.join(repository, 'UCAC4_sample.txt')
+
+
+def line_stars(source_location):
+    """ the stars of parse_ascii_line, with a blank ucac2 as None like the numpy parser """
+    stars = [parse_ascii_line(line) for line in iter_ascii_lines(source_location, 1) if line.strip()]
+    return [star[:2] + (star[2].strip() or None,) + star[3:] for star in stars]
+
+
+def column_stars(source_location, batch_size):
+    return [star for columns, size in iter_ascii_columns(source_location, batch_size)
+            for star in zip(*[column_to_list(column) for column in columns.values()])]
+
+
+class AsciiReaderTest(unittest.TestCase):
+    """ the numpy parser of the ascii catalogs gives the same stars as parse_ascii_line """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_sample(self):
+        stars = line_stars(sample)
+        self.assertEqual(len(stars), 1000)
+        for batch_size in [1, 97, 1000, 5000]:
+            self.assertEqual(column_stars(sample, batch_size), stars, batch_size)
+
+    def test_edited_lines(self):
+        # negative declinations, '---' and blank magnitudes, and a short last line without a newline
+        with open(sample) as f:
+            lines = f.readlines()
+        for index in range(1, len(lines), 7):
+            line = lines[index]
+            line = line[:22] + '-' + line[23:]
+            line = line[:230] + '  --- ' + line[236:]
+            lines[index] = line[:174] + ' ' * 6 + line[180:]
+        lines[-1] = lines[-1].rstrip()
+
+        source_location = os.path.join(self.directory, 'UCAC4_edited.txt')
+        with open(source_location, 'w') as f:
+            f.writelines(lines)
+
+        stars = line_stars(source_location)
+        self.assertIn(None, [star[10] for star in stars])
+        self.assertTrue(any([star[5] < 0 for star in stars]))
+        self.assertEqual(column_stars(source_location, 64), stars)
+
+    def test_compressed(self):
+        with open(sample, 'rb') as f:
+            data = f.read()
+        stars = line_stars(sample)
+
+        for name, compress in [('UCAC4_sample.txt.gz', gzip.compress), ('UCAC4_sample.txt.bz2', bz2.compress)]:
+            source_location = os.path.join(self.directory, name)
+            with open(source_location, 'wb') as f:
+                f.write(compress(data))
+            self.assertEqual(column_stars(source_location, 97), stars, name)
+
+    def test_u4dump(self):
+        # z001.asc is the u4dump output of z001, with all fields of the binary record
+        columns = select_columns('all')
+        binary = decode_columns(read_binary_zone(os.path.join(repository, 'z001')), columns)
+        chunks = [chunk for chunk, size in iter_ascii_columns(os.path.join(repository, 'z001.asc'), 50, columns)]
+
+        self.assertEqual(list(chunks[0].keys()), ['zone'] + list(binary.keys()))
+        for name, column in binary.items():
+            values = column_to_list(column)
+            u4dump = [value for chunk in chunks for value in column_to_list(chunk[name])]
+            if name == 'gcflg':
+                # u4dump writes the gcflg of one star differently (4 instead of 14)
+                self.assertEqual(sum([a != b for a, b in zip(values, u4dump)]), 1)
+            else:
+                self.assertEqual(u4dump, values, name)
+        self.assertTrue(np.all(np.concatenate([chunk['zone'] for chunk in chunks]) == 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import os
+import shutil
+import argparse
+import tempfile
+import unittest
+import numpy as np
+
+from ucac4_convert.converters import read_binary_stars_with_struct, read_binary_star_batches
+from ucac4_convert.decoder import ucac4_dtype, record_size, read_binary_zone, decode_columns, stars_from_columns
+
+# the bundled sample zone in the root of the repository
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+z001 = os.path.join(repository, 'z001')
+
+
+def struct_stars(zone, source_location, batch_size=50):
+    return [star for stars in read_binary_stars_with_struct(zone, source_location, batch_size) for star in stars]
+
+
+def numpy_stars(zone, source_location):
+    return stars_from_columns(zone, decode_columns(read_binary_zone(source_location)))
+
+
+def random_records(number_of_stars, seed=1):
+    """ records with random bytes, with the fields that the stars table decodes in the ranges of the catalog """
+    rng = np.random.default_rng(seed)
+    records = np.frombuffer(rng.integers(0, 256, number_of_stars * record_size, dtype=np.uint8).tobytes(),
+                            dtype=ucac4_dtype).copy()
+    records['ra'] = rng.integers(0, 360 * 3600000, number_of_stars)
+    records['spd'] = rng.integers(0, 180 * 3600000, number_of_stars)
+    records['objt'] = rng.integers(0, 10, number_of_stars)
+
+    # 'no data' magnitudes, and stars without a UCAC2 match
+    for name in ['j_m', 'h_m', 'k_m']:
+        records[name][rng.random(number_of_stars) < 0.3] = 20000
+    records['apasm'][rng.random((number_of_stars, 5)) < 0.3] = 20000
+    no_match = rng.random(number_of_stars) < 0.3
+    records['zn2'][no_match] = 0
+    records['rn2'][no_match] = 0
+    return records
+
+
+class DecoderTest(unittest.TestCase):
+    """ the numpy decoder gives the same star tuples as the original struct decoder """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_z001(self):
+        stars = numpy_stars(1, z001)
+        self.assertEqual(len(stars), os.path.getsize(z001) // record_size)
+        self.assertEqual(stars, struct_stars(1, z001))
+
+    def test_random_records(self):
+        source_location = os.path.join(self.directory, 'z451')
+        random_records(5000).tofile(source_location)
+
+        stars = numpy_stars(451, source_location)
+        self.assertEqual(stars, struct_stars(451, source_location, 333))
+        self.assertIn(None, [star[2] for star in stars])
+        self.assertIn(None, [star[10] for star in stars])
+
+    def test_batches(self):
+        source_location = os.path.join(self.directory, 'z451')
+        random_records(1000).tofile(source_location)
+        stars = numpy_stars(451, source_location)
+
+        # the whole zone at once, with the pipeline of blocks, and the struct decoder, after the committed stars
+        for decoder, pipeline_depth in [('numpy', 0), ('numpy', 2), ('struct', 0)]:
+            for start in [0, 1, 64, 999, 1000]:
+                args = argparse.Namespace(decoder=decoder, columns='default', batch_size=64,
+                                          pipeline_depth=pipeline_depth)
+                batches = list(read_binary_star_batches(args, 451, source_location, start))
+                self.assertEqual([star for batch in batches for star in batch], stars[start:],
+                                 decoder + " " + str(pipeline_depth) + " " + str(start))
+                self.assertTrue(all([len(batch) <= 64 for batch in batches]))
+
+
+if __name__ == '__main__':
+    unittest.main()
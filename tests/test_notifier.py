@@ -0,0 +1,217 @@
+import sys
+import time
+import types
+import socket
+import argparse
+import threading
+import unittest
+from unittest import mock
+
+from ucac4_convert.notifier import RabbitMQNotifier
+
+
+def rabbit_args(host='localhost', port=5672):
+    return argparse.Namespace(rabbit_host=host, rabbit_port=port, rabbit_user='ucac4', rabbit_password='secret')
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError("timeout")
+        time.sleep(0.01)
+
+
+class FakeBroker:
+    """ a stand-in for pika, that records the published messages in memory """
+
+    def __init__(self):
+        self.published = []
+        self.connections = 0
+        self.reachable = True
+        self.connecting = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+        broker = self
+
+        class Channel:
+            def exchange_declare(self, exchange, exchange_type):
+                pass
+
+            def basic_publish(self, exchange, routing_key, body):
+                broker.published.append((time.time(), exchange, body))
+
+        class BlockingConnection:
+            def __init__(self, parameters):
+                broker.connections = broker.connections + 1
+                broker.connecting.set()
+                # a broker that does not answer keeps the connection waiting
+                broker.release.wait()
+                if not broker.reachable:
+                    raise ConnectionRefusedError("broker not reachable")
+                self.is_open = True
+
+            def channel(self):
+                return Channel()
+
+            def process_data_events(self):
+                pass
+
+            def close(self):
+                self.is_open = False
+
+        self.module = types.SimpleNamespace(PlainCredentials=lambda user, password: (user, password),
+                                            ConnectionParameters=lambda *args, **kwargs: (args, kwargs),
+                                            BlockingConnection=BlockingConnection)
+
+    def messages(self):
+        return [line for _, _, body in self.published for line in body.split('\n')]
+
+
+class NotifierTest(unittest.TestCase):
+    """ the notifier with a fake pika, so that no RabbitMQ server is needed """
+
+    def setUp(self):
+        self.broker = FakeBroker()
+        self.pika = mock.patch.dict(sys.modules, {'pika': self.broker.module})
+        self.pika.start()
+        self.notifiers = []
+
+    def tearDown(self):
+        self.broker.release.set()
+        for notifier in self.notifiers:
+            notifier.close()
+        self.pika.stop()
+
+    def notifier(self, **kwargs):
+        notifier = RabbitMQNotifier(rabbit_args(), 'slack', **kwargs)
+        self.notifiers.append(notifier)
+        return notifier
+
+    def test_disabled_without_password(self):
+        args = rabbit_args()
+        args.rabbit_password = None
+        notifier = RabbitMQNotifier(args, 'slack')
+        notifier.send("z001: 206 stars")
+        notifier.close()
+
+        self.assertIsNone(notifier.thread)
+        self.assertEqual(self.broker.connections, 0)
+
+    def test_messages_are_published_on_close(self):
+        notifier = self.notifier()
+        notifier.send("z001: 206 stars")
+        notifier.send("z002: 712 stars")
+        notifier.close()
+
+        self.assertEqual(self.broker.messages(), ["z001: 206 stars", "z002: 712 stars"])
+        self.assertEqual(self.broker.published[0][1], 'slack')
+        self.assertEqual(notifier.sent, 2)
+
+    def test_queue_is_bounded(self):
+        # the background thread waits for a broker that does not answer, with the first message
+        self.broker.release.clear()
+        notifier = self.notifier(queue_size=5)
+        notifier.send("first")
+        self.assertTrue(self.broker.connecting.wait(5))
+
+        for x in range(20):
+            notifier.send("zone " + str(x))
+
+        self.assertEqual(notifier.messages.qsize(), 5)
+        self.assertEqual(notifier.dropped, 15)
+
+        self.broker.release.set()
+        notifier.close()
+        self.assertEqual(self.broker.messages(), ["first"] + ["zone " + str(x) for x in range(5)])
+
+    def test_messages_are_batched_and_rate_limited(self):
+        notifier = self.notifier(interval=0.2)
+        for x in range(100):
+            notifier.send("zone " + str(x))
+            time.sleep(0.01)
+        notifier.close()
+
+        # all messages arrive in order, in far fewer publishes, at least an interval apart
+        # (except the last one, close publishes the waiting messages at once)
+        self.assertEqual(self.broker.messages(), ["zone " + str(x) for x in range(100)])
+        self.assertLessEqual(len(self.broker.published), 8)
+        timestamps = [timestamp for timestamp, _, _ in self.broker.published[:-1]]
+        for previous, timestamp in zip(timestamps, timestamps[1:]):
+            self.assertGreaterEqual(timestamp - previous, 0.19)
+
+    def test_unreachable_broker_does_not_block_send(self):
+        self.broker.reachable = False
+        notifier = self.notifier(interval=0.05, retry_interval=60)
+
+        timestamp = time.time()
+        for x in range(1000):
+            notifier.send("zone " + str(x))
+        self.assertLess(time.time() - timestamp, 0.5)
+
+        wait_for(lambda: notifier.failed + notifier.dropped == 1000)
+        self.assertEqual(notifier.sent, 0)
+
+        # the connection is not tried again before the retry interval
+        self.assertEqual(self.broker.connections, 1)
+
+    def test_close_returns_within_timeout(self):
+        # a broker that never answers the connection
+        self.broker.release.clear()
+        notifier = self.notifier()
+        notifier.send("z001: 206 stars")
+        self.assertTrue(self.broker.connecting.wait(5))
+
+        timestamp = time.time()
+        notifier.close(timeout=0.5)
+        self.assertLess(time.time() - timestamp, 1.0)
+        self.assertTrue(notifier.thread.is_alive())
+
+
+class StandInBrokerTest(unittest.TestCase):
+    """ the notifier with pika against a local server that accepts connections, but never speaks AMQP """
+
+    def setUp(self):
+        try:
+            import pika
+        except ImportError:
+            self.skipTest("pika is not installed")
+
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(5)
+        self.clients = []
+        self.accepting = threading.Thread(target=self.accept, daemon=True)
+        self.accepting.start()
+
+    def accept(self):
+        while True:
+            try:
+                client, address = self.server.accept()
+            except OSError:
+                return
+            self.clients.append(client)
+
+    def tearDown(self):
+        self.server.close()
+        for client in self.clients:
+            client.close()
+
+    def test_send_and_close_do_not_wait_for_the_broker(self):
+        notifier = RabbitMQNotifier(rabbit_args('127.0.0.1', self.server.getsockname()[1]), 'slack')
+
+        timestamp = time.time()
+        for x in range(200):
+            notifier.send("zone " + str(x))
+        self.assertLess(time.time() - timestamp, 0.5)
+
+        wait_for(lambda: len(self.clients) > 0)
+        timestamp = time.time()
+        notifier.close(timeout=0.5)
+        self.assertLess(time.time() - timestamp, 1.0)
+        self.assertEqual(notifier.sent, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
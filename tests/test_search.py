@@ -0,0 +1,195 @@
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import unittest
+import subprocess
+import numpy as np
+
+from benchmarks.synthetic import write_zone
+from ucac4_convert.decoder import read_binary_zone
+from ucac4_convert.query import cone_to_box, angular_distances
+from ucac4_convert.search import search_cone, search_box
+from ucac4_convert import cache
+
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# synthetic zones around the south pole, around ra = 0/360 on the equator, and around the north pole
+zone_ranges = [(1, 5, 2000), (446, 455, 10000), (896, 900, 2000)]
+
+# the distance to the radius or the edges of a box within which a star can be found or not (rounding)
+margin = 1e-9
+
+
+def ucac4_convert(*arguments):
+    """ run the converter like the command line does """
+    return subprocess.run([sys.executable, '-m', 'ucac4_convert.main'] + list(arguments), cwd=repository,
+                          capture_output=True, text=True, check=True)
+
+
+def random_cones(number_of_cones, seed=0):
+    """ cones near the poles (some of them contain a pole) and cones on the equator that wrap around ra = 0/360 """
+    rng = np.random.default_rng(seed)
+    cones = []
+    for x in range(number_of_cones):
+        radius = rng.uniform(0.01, 1.0)
+        kind = x % 3
+        if kind == 0:
+            cones.append((rng.uniform(0, 360), rng.uniform(-90, -89.2), radius))
+        elif kind == 1:
+            cones.append((rng.uniform(0, 360), rng.uniform(89.2, 90), radius))
+        else:
+            cones.append((rng.uniform(-1, 1) % 360, rng.uniform(-0.9, 0.9), radius))
+
+    # on the poles and on ra = 0
+    return cones + [(0, -90, 0.3), (180, 90, 0.5), (0, 0, 0.5), (359.999, 0.1, 0.2), (0.001, -0.1, 0.2)]
+
+
+def random_boxes(number_of_boxes, seed=0):
+    """ boxes around ra = 0/360 (ra_min > ra_max) and around the poles """
+    rng = np.random.default_rng(seed)
+    boxes = []
+    for x in range(number_of_boxes):
+        if x % 2 == 0:
+            dec = rng.uniform(-1, 0.8)
+            boxes.append([rng.uniform(359, 360), rng.uniform(0, 1), dec, dec + rng.uniform(0.01, 0.5)])
+        else:
+            dec = rng.choice([-90, 89])
+            ra = rng.uniform(0, 360)
+            boxes.append([ra, (ra + rng.uniform(1, 300)) % 360, dec, dec + rng.uniform(0.1, 1)])
+
+    # like the boxes of the command line and the server
+    return [[float(value) for value in box] for box in boxes]
+
+
+class SearchTest(unittest.TestCase):
+    """ the cone and box searches of a converted database find the same stars as a brute force search """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        records = []
+        for first, last, number_of_stars in zone_ranges:
+            for zone in range(first, last + 1):
+                records.append(read_binary_zone(write_zone(cls.directory, number_of_stars, zone, zone)))
+        records = np.concatenate(records)
+
+        cls.mpos1 = records['rnm'].astype(np.int64)
+        cls.ra = records['ra'] / 3600000
+        cls.dec = records['spd'] / 3600000 - 90
+
+        # without a cache, so that every search searches the target
+        cache.start_cache(argparse.Namespace(cache_size=0))
+        cls.args = argparse.Namespace(host='localhost', port='5432', user='postgres', password='postgres')
+
+    @classmethod
+    def tearDownClass(cls):
+        cache.start_cache(argparse.Namespace(cache_size=cache.default_cache_size))
+        shutil.rmtree(cls.directory)
+
+    def convert(self, target):
+        for first, last, number_of_stars in zone_ranges:
+            source = os.path.join(self.directory, 'z' + str(first).zfill(3) + '..z' + str(last).zfill(3))
+            ucac4_convert('--source', 'binary::' + source, '--target', target)
+
+    def check_cones(self, target, cones):
+        for ra, dec, radius in cones:
+            results = search_cone(self.args, target, ra, dec, radius)
+            found = set([star[1] for distance, star in results])
+
+            distances = angular_distances(ra, dec, self.ra, self.dec)
+            inside = set(self.mpos1[distances <= radius - margin].tolist())
+            near = set(self.mpos1[distances <= radius + margin].tolist())
+
+            cone = str((ra, dec, radius))
+            self.assertEqual(len(found), len(results), cone)
+            self.assertTrue(inside <= found, cone + " misses " + str(sorted(inside - found)[:5]))
+            self.assertTrue(found <= near, cone + " has " + str(sorted(found - near)[:5]))
+            self.assertEqual([distance for distance, star in results],
+                             sorted([distance for distance, star in results]), cone)
+
+    def check_boxes(self, target, boxes):
+        for box in boxes:
+            results = search_box(self.args, target, box)
+            found = set([star[1] for star in results])
+
+            if box[0] <= box[1]:
+                in_ra = (self.ra >= box[0] - margin) & (self.ra <= box[1] + margin)
+                inner_ra = (self.ra >= box[0] + margin) & (self.ra <= box[1] - margin)
+            else:
+                in_ra = (self.ra >= box[0] - margin) | (self.ra <= box[1] + margin)
+                inner_ra = (self.ra >= box[0] + margin) | (self.ra <= box[1] - margin)
+            in_dec = (self.dec >= box[2] - margin) & (self.dec <= box[3] + margin)
+            inner_dec = (self.dec >= box[2] + margin) & (self.dec <= box[3] - margin)
+
+            inside = set(self.mpos1[inner_ra & inner_dec].tolist())
+            near = set(self.mpos1[in_ra & in_dec].tolist())
+
+            self.assertEqual(len(found), len(results), str(box))
+            self.assertTrue(inside <= found, str(box) + " misses " + str(sorted(inside - found)[:5]))
+            self.assertTrue(found <= near, str(box) + " has " + str(sorted(found - near)[:5]))
+            self.assertEqual([(star[0], star[4]) for star in results], sorted([(star[0], star[4]) for star in results]))
+
+    def test_cone_to_box(self):
+        # the box of a cone contains the cone, also where it wraps around ra = 0/360 or contains a pole
+        rng = np.random.default_rng(1)
+        for ra, dec, radius in random_cones(300):
+            box = cone_to_box(ra, dec, radius)
+            self.assertTrue(0 <= box[0] <= 360 and 0 <= box[1] <= 360)
+
+            # points on the circle of the cone
+            angle = np.radians(rng.uniform(0, 360, 500))
+            distance = np.radians(radius)
+            dec_0 = np.radians(dec)
+            point_dec = np.arcsin(np.sin(dec_0) * np.cos(distance) + np.cos(dec_0) * np.sin(distance) * np.cos(angle))
+            point_ra = np.radians(ra) + np.arctan2(np.sin(angle) * np.sin(distance) * np.cos(dec_0),
+                                                   np.cos(distance) - np.sin(dec_0) * np.sin(point_dec))
+            point_ra = np.degrees(point_ra) % 360
+            point_dec = np.degrees(point_dec)
+
+            self.assertTrue(np.all(point_dec >= box[2] - margin) and np.all(point_dec <= box[3] + margin), str(box))
+            if box[0] <= box[1]:
+                in_ra = (point_ra >= box[0] - margin) & (point_ra <= box[1] + margin)
+            else:
+                in_ra = (point_ra >= box[0] - margin) | (point_ra <= box[1] + margin)
+            self.assertTrue(np.all(in_ra | (np.abs(point_dec) > 90 - margin)), str((ra, dec, radius, box)))
+
+    def test_sqlite(self):
+        target = 'sqlite::' + os.path.join(self.directory, 'UCAC4.sqlite3') + ':stars'
+        self.convert(target)
+        self.check_cones(target, random_cones(300))
+        self.check_boxes(target, random_boxes(60))
+
+    def test_ucac4pack(self):
+        target = 'ucac4pack::' + os.path.join(self.directory, 'ucac4_pack')
+        self.convert(target)
+        self.check_cones(target, random_cones(300))
+        self.check_boxes(target, random_boxes(60))
+
+        # the stars are the same as those of a database
+        database = 'sqlite::' + os.path.join(self.directory, 'UCAC4_pack.sqlite3') + ':stars'
+        self.convert(database)
+        # (the distances of the files are calculated with numpy, they can differ in the last bit)
+        for ra, dec, radius in random_cones(30, 2):
+            results = sorted(search_cone(self.args, target, ra, dec, radius), key=lambda result: result[1])
+            expected = sorted(search_cone(self.args, database, ra, dec, radius), key=lambda result: result[1])
+            self.assertEqual([star for distance, star in results], [star for distance, star in expected])
+            self.assertTrue(np.allclose([distance for distance, star in results],
+                                        [distance for distance, star in expected], rtol=0, atol=1e-12))
+
+    def test_empty_ucac4pack(self):
+        # a zone without stars
+        source_location = os.path.join(self.directory, 'empty', 'z447')
+        os.makedirs(os.path.dirname(source_location))
+        open(source_location, 'wb').close()
+
+        target = 'ucac4pack::' + os.path.join(self.directory, 'ucac4_empty')
+        ucac4_convert('--source', 'binary::' + source_location, '--target', target)
+        self.assertTrue(os.path.exists(os.path.join(self.directory, 'ucac4_empty', 'z447.ucac4pack')))
+        self.assertEqual(search_cone(self.args, target, 0, -0.5, 0.5), [])
+        self.assertEqual(search_box(self.args, target, [359, 1, -0.7, -0.5]), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
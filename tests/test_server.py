@@ -0,0 +1,261 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import unittest
+import subprocess
+import http.client
+import urllib.request
+from unittest import mock
+import numpy as np
+
+from ucac4_convert.decoder import ucac4_dtype, star_columns
+from ucac4_convert.search import search_cone, search_id
+from ucac4_convert.server import QueryServer
+from ucac4_convert import search, cache
+
+# the bundled sample zone in the root of the repository
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def ucac4_convert(*arguments):
+    """ run the converter like the command line does """
+    return subprocess.run([sys.executable, '-m', 'ucac4_convert.main'] + list(arguments), cwd=repository,
+                          capture_output=True, text=True, check=True)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class ServeDuringUpdateTest(unittest.TestCase):
+    """ a running server answers with the new stars after an update of its database """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.zone_file = os.path.join(self.directory, 'z001')
+        shutil.copy(os.path.join(repository, 'z001'), self.zone_file)
+
+        self.source = 'binary::' + self.zone_file
+        self.target = 'sqlite::' + os.path.join(self.directory, 'UCAC4.sqlite3') + ':stars'
+        ucac4_convert('--source', self.source, '--target', self.target)
+
+        self.address = '127.0.0.1:' + str(free_port())
+        self.server = subprocess.Popen([sys.executable, '-m', 'ucac4_convert.main', '--operation', 'serve',
+                                        '--target', self.target, '--listen', self.address], cwd=repository,
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.wait_for_server()
+
+    def tearDown(self):
+        self.server.terminate()
+        self.server.wait()
+        shutil.rmtree(self.directory)
+
+    def wait_for_server(self, timeout=20):
+        deadline = time.time() + timeout
+        while True:
+            try:
+                return self.get('/metrics')
+            except OSError:
+                if time.time() > deadline or self.server.poll() is not None:
+                    raise
+                time.sleep(0.1)
+
+    def get(self, path):
+        with urllib.request.urlopen('http://' + self.address + path, timeout=10) as response:
+            body = response.read().decode()
+        return json.loads(body) if path != '/metrics' else body
+
+    def test_update_is_served(self):
+        records = np.fromfile(self.zone_file, dtype=ucac4_dtype)
+        mpos1 = int(records['rnm'][0])
+        v_mag = star_columns.index('v_mag')
+
+        # the first answer is cached by the server
+        star = self.get('/id?mpos1=' + str(mpos1))['star']
+        self.assertEqual(self.get('/id?mpos1=' + str(mpos1))['star'], star)
+        self.assertNotEqual(star[v_mag], 12345)
+
+        # a corrected zone file, with a new V magnitude for the first star
+        records['apasm'][0, 1] = 12345
+        records.tofile(self.zone_file)
+        ucac4_convert('--operation', 'update', '--source', self.source, '--target', self.target)
+
+        star = self.get('/id?mpos1=' + str(mpos1))['star']
+        self.assertEqual(star[v_mag], 12345)
+
+        ra, dec = star[star_columns.index('ra')], star[star_columns.index('dec')]
+        stars = self.get('/cone?ra=' + str(ra) + '&dec=' + str(dec) + '&radius=0.001')['stars']
+        self.assertEqual(stars[0]['star'][v_mag], 12345)
+
+
+def server_args(target, listen, cache_size=0):
+    """ the parameters of the serve operation, with the defaults of the command line """
+    return argparse.Namespace(target=target, listen=listen, source='binary::../z001', zones=None, radius=0.1,
+                              columns='default', host='localhost', port='5432', user='postgres', password='postgres',
+                              remove_database=False, shard_zones=1, cache_size=cache_size)
+
+
+def as_json(value):
+    """ a value as the server answers it """
+    return json.loads(json.dumps(value, default=str))
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """ an http connection over a unix socket """
+
+    def __init__(self, path):
+        super().__init__('localhost')
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+class QueryServerTest(unittest.TestCase):
+    """ a QueryServer in this process, without a cache, so that every request searches the database """
+
+    server = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.target = 'sqlite::' + os.path.join(cls.directory, 'UCAC4.sqlite3') + ':stars'
+        ucac4_convert('--source', 'binary::' + os.path.join(repository, 'z001'), '--target', cls.target)
+
+        records = np.fromfile(os.path.join(repository, 'z001'), dtype=ucac4_dtype)
+        cls.stars = [(int(record['rnm']), record['ra'] / 3600000, record['spd'] / 3600000 - 90) for record in records]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def start_server(self, listen):
+        args = server_args(self.target, listen)
+        cache.start_cache(args)
+        self.server = QueryServer(args)
+        self.thread = threading.Thread(target=self.server.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return args
+
+    def stop_server(self):
+        if self.server:
+            self.server.httpd.shutdown()
+            self.server.close()
+            self.thread.join()
+            self.server = None
+
+    def tearDown(self):
+        self.stop_server()
+
+    def get(self, connection, path):
+        connection.request('GET', path)
+        response = connection.getresponse()
+        self.assertEqual(response.status, 200)
+        return json.loads(response.read())
+
+    def tcp_connection(self):
+        return http.client.HTTPConnection(*self.server.httpd.server_address[:2], timeout=10)
+
+    def requests(self, args):
+        """ cone and id requests around the stars of z001, with their answers from a search without the server """
+        requests = []
+        for mpos1, ra, dec in self.stars[:40]:
+            results = search_cone(args, self.target, ra, dec, 0.05)
+            requests.append(('/cone?ra=' + str(ra) + '&dec=' + str(dec) + '&radius=0.05', as_json(
+                {'count': len(results),
+                 'stars': [{'distance': round(distance * 3600, 3), 'star': star} for distance, star in results]})))
+            star = search_id(args, self.target, mpos1)
+            requests.append(('/id?mpos1=' + str(mpos1), as_json({'count': 1, 'star': star})))
+        return requests
+
+    def test_concurrent_cone_and_id_requests(self):
+        args = self.start_server('127.0.0.1:0')
+        requests = self.requests(args)
+        errors = []
+
+        def client(seed):
+            # every client has its own kept alive connection, and does the requests in its own order
+            connection = self.tcp_connection()
+            try:
+                for path, expected in random.Random(seed).sample(requests, len(requests)):
+                    answer = self.get(connection, path)
+                    del answer['ms']
+                    if answer != expected:
+                        errors.append(path)
+            except Exception as error:
+                errors.append(repr(error))
+            finally:
+                connection.close()
+
+        clients = [threading.Thread(target=client, args=(seed,)) for seed in range(8)]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+
+        self.assertEqual(errors, [])
+
+        # a request is counted after its answer is written
+        deadline = time.time() + 5
+        while sum([count for count, seconds in self.server.requests.values()]) < 640 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertIn('ucac4_requests_total{path="/cone",status="200"} 320', self.server.metrics())
+        self.assertIn('ucac4_requests_total{path="/id",status="200"} 320', self.server.metrics())
+
+    def test_connection_pool_is_reused_across_threads(self):
+        self.start_server('127.0.0.1:0')
+        mpos1, ra, dec = self.stars[0]
+
+        with mock.patch.object(search, 'open_query_connection', wraps=search.open_query_connection) as opened:
+            # every client connection is handled by a new thread of the server
+            for x in range(10):
+                connection = self.tcp_connection()
+                self.assertEqual(self.get(connection, '/id?mpos1=' + str(mpos1))['count'], 1)
+                connection.close()
+            self.assertEqual(opened.call_count, 1)
+
+            # concurrent clients need more connections, but never more than the number of clients
+            clients = [self.tcp_connection() for x in range(4)]
+            threads = [threading.Thread(target=lambda connection=connection: [
+                self.get(connection, '/cone?ra=' + str(ra) + '&dec=' + str(dec)) for x in range(20)])
+                for connection in clients]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            for connection in clients:
+                connection.close()
+
+            self.assertLessEqual(opened.call_count, 4)
+        self.assertEqual(len(self.server.pool.idle[('sqlite', self.target.split('::')[1].split(':')[0])]),
+                         opened.call_count)
+
+    def test_unix_socket(self):
+        path = os.path.join(self.directory, 'ucac4.sock')
+        args = self.start_server('unix:' + path)
+        path_and_answers = self.requests(args)[:4]
+
+        connection = UnixHTTPConnection(path)
+        for request_path, expected in path_and_answers:
+            answer = self.get(connection, request_path)
+            del answer['ms']
+            self.assertEqual(answer, expected)
+        connection.close()
+
+        # the socket file is removed when the server is closed
+        self.stop_server()
+        self.assertFalse(os.path.exists(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
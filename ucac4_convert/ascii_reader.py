@@ -0,0 +1,207 @@
+import os
+import gzip
+import bz2
+from itertools import islice
+import numpy as np
+
+from ucac4_convert.decoder import ucac4_dtype, star_columns, decode_columns
+
+# magic bytes at the start of compressed files
+gzip_magic = b'\x1f\x8b'
+bz2_magic = b'BZh'
+
+# The fields of the fixed width lines of the UCAC4 ascii catalog (like UCAC4_sample.txt), in the order of the
+# columns of the stars table: (column, first character, last character + 1, kind). The kinds are 'int', 'float',
+# 'magnitude' (in mag, converted to millimag) and 'id' (a ucac2 id like 181-173041).
+# See https://irsa.ipac.caltech.edu/data/UCAC4/readme_u4.txt
+fixed_width_fields = [
+    ('zone', 0, 3, 'int'),
+    ('mpos1', 129, 138, 'int'),
+    ('ucac2', 139, 149, 'id'),
+    ('ot', 84, 85, 'int'),
+    ('ra', 11, 22, 'float'),
+    ('dec', 22, 33, 'float'),
+    ('j_mag', 174, 180, 'magnitude'),
+    ('h_mag', 189, 195, 'magnitude'),
+    ('k_mag', 204, 210, 'magnitude'),
+    ('b_mag', 219, 225, 'magnitude'),
+    ('v_mag', 230, 236, 'magnitude'),
+    ('g_mag', 241, 247, 'magnitude'),
+    ('r_mag', 252, 258, 'magnitude'),
+    ('i_mag', 263, 269, 'magnitude'),
+]
+
+# the lines are padded to at least the end of the last field before they are parsed
+fixed_width_line = max([field[2] for field in fixed_width_fields])
+
+# The u4dump tool writes a zone as comma separated lines (like z001.asc) with the 53 values of the binary record,
+# where icf is split into its 9 digits and the errors below are written without the offset of 128 of the binary
+# record. The proper motion errors 251..255 (after the offset) are written as the errors they stand for.
+# The gcflg of u4dump can differ from the binary record (in z001 one star has 4 instead of 14).
+u4dump_values = 53
+u4dump_offset_fields = ['sigra', 'sigdc', 'sigpmr', 'sigpmd']
+u4dump_pm_error_codes = {275: 251, 325: 252, 375: 253, 450: 254, 500: 255}
+
+
+def open_ascii_file(source_location):
+    """
+    open an ascii catalog file for reading text, gzip and bz2 compressed files are decompressed on the fly.
+    The compression is recognized by the first bytes of the file, not by its extension.
+    """
+    with open(source_location, "rb") as f:
+        magic = f.read(3)
+
+    if magic.startswith(gzip_magic):
+        return gzip.open(source_location, "rt")
+    if magic.startswith(bz2_magic):
+        return bz2.open(source_location, "rt")
+    return open(source_location, "r")
+
+
+def iter_ascii_lines(source_location, skip=0):
+    """
+    stream the lines of an ascii catalog file, without reading the whole file in memory.
+    :param skip: the number of header lines to skip
+    """
+    with open_ascii_file(source_location) as f:
+        yield from islice(f, skip, None)
+
+
+def iter_ascii_chunks(source_location, chunk_size, skip=0):
+    """ stream the lines of an ascii catalog file in lists of at most chunk_size lines """
+    lines = iter_ascii_lines(source_location, skip)
+    while True:
+        chunk = list(islice(lines, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def is_u4dump_file(source_location):
+    """ True for the comma separated output of the u4dump tool (like z001.asc), False for the fixed width catalog """
+    for line in iter_ascii_lines(source_location):
+        if line.strip():
+            return line.count(',') == u4dump_values - 1
+    return False
+
+
+def u4dump_zone(source_location):
+    """ the zone of a u4dump file, from its name (like z001.asc) """
+    name = os.path.basename(source_location)
+    if not (name[:1] == 'z' and name[1:4].isdigit()):
+        raise Exception("the zone of a u4dump file is taken from its name, like z001.asc, not " + name)
+    return int(name[1:4])
+
+
+def _fixed_width_values(field, kind):
+    """
+    convert a field of all lines at once, from its characters (a 2d uint8 array with a row per line).
+    The digits are added up from left to right, and the digits after the '.' give the scale,
+    so the values are the same as float() and int() of the field. Blank and '---' fields (no digits) are masked.
+    :return: numpy array, or a masked array when there are missing values
+    """
+    if kind == 'id':
+        ids = np.char.strip(np.ascontiguousarray(field).view('S' + str(field.shape[1])).ravel().astype('U'))
+        values = ids.astype(object)
+        values[ids == ''] = None
+        return values
+
+    # a row per character position of the field
+    characters = np.ascontiguousarray(field.T)
+    digits = characters - ord('0')
+    is_digit = digits < 10
+
+    values = np.zeros(len(field), dtype=np.int64)
+    decimals = np.zeros(len(field), dtype=np.int64)
+    after_point = np.zeros(len(field), dtype=bool)
+    for position in range(len(characters)):
+        values = np.where(is_digit[position], values * 10 + digits[position], values)
+        decimals += is_digit[position] & after_point
+        after_point |= characters[position] == ord('.')
+    values = np.where(np.any(characters == ord('-'), axis=0), -values, values)
+    missing = ~np.any(is_digit, axis=0)
+
+    if kind == 'float':
+        values = values / 10.0 ** decimals
+    elif kind == 'magnitude':
+        values = np.rint(values * 10.0 ** (3 - decimals)).astype(np.int64)
+
+    if missing.any():
+        return np.ma.masked_array(values, mask=missing)
+    return values
+
+
+def parse_fixed_width_lines(lines):
+    """
+    parse lines of the UCAC4 ascii catalog (like UCAC4_sample.txt) into columns: the lines are copied into one
+    array of characters with a row per line, and every field is converted for all lines at once.
+    :return: dict with a numpy array per column of fixed_width_fields, like decoder.decode_columns (with zone)
+    """
+    # the lines of a catalog file have the same length, only the exceptions (like the last line) are padded
+    width = max(len(lines[0]), fixed_width_line)
+    if set(map(len, lines)) == {width}:
+        data = "".join(lines)
+    else:
+        data = "".join([line if len(line) == width else line.rstrip('\r\n').ljust(width)[:width] for line in lines])
+    characters = np.frombuffer(data.encode('latin-1'), dtype=np.uint8).reshape(len(lines), width)
+    return {name: _fixed_width_values(characters[:, start:stop], kind)
+            for name, start, stop, kind in fixed_width_fields}
+
+
+def parse_u4dump_lines(lines):
+    """
+    parse comma separated lines of the u4dump tool (like z001.asc) into binary records,
+    so that they can be decoded like a binary zone file (decoder.decode_columns)
+    :return: numpy array with ucac4_dtype
+    """
+    values = np.loadtxt(lines, delimiter=',', dtype=np.int64, ndmin=2)
+    if values.shape[1] != u4dump_values:
+        raise Exception("a u4dump line has " + str(u4dump_values) + " values, not " + str(values.shape[1]))
+
+    records = np.zeros(len(values), dtype=ucac4_dtype)
+    column = 0
+    for name in ucac4_dtype.names:
+        if name == 'icf':
+            # the 9 digits of the flags
+            records[name] = values[:, column:column + 9] @ (10 ** np.arange(8, -1, -1))
+            column = column + 9
+        elif ucac4_dtype[name].shape:
+            size = ucac4_dtype[name].shape[0]
+            records[name] = values[:, column:column + size]
+            column = column + size
+        else:
+            field = values[:, column]
+            if name in ['sigpmr', 'sigpmd']:
+                for error, code in u4dump_pm_error_codes.items():
+                    field = np.where(field == error, code, field)
+            if name in u4dump_offset_fields:
+                field = (field + 128) % 256
+            records[name] = field
+            column = column + 1
+
+    return records
+
+
+def iter_ascii_columns(source_location, batch_size, columns=star_columns):
+    """
+    stream an ascii catalog file in chunks of batch_size lines, and parse every chunk into columns at once.
+    The fixed width catalog (like UCAC4_sample.txt) has the columns of the 'stars' table,
+    the comma separated u4dump files (like z001.asc) have all fields of the binary record.
+    :param columns: the columns to decode from a u4dump file, see decoder.select_columns
+    :return: yields (dict with a numpy array per column starting with zone, the number of characters of the chunk)
+    """
+    if is_u4dump_file(source_location):
+        zone = u4dump_zone(source_location)
+        for lines in iter_ascii_chunks(source_location, batch_size):
+            lines = list(filter(str.strip, lines))
+            if lines:
+                records = parse_u4dump_lines(lines)
+                zones = {'zone': np.full(len(records), zone)}
+                yield dict(zones, **decode_columns(records, columns)), sum(map(len, lines))
+        return
+
+    # skip the first line with the header
+    for lines in iter_ascii_chunks(source_location, batch_size, 1):
+        lines = list(filter(str.strip, lines))
+        if lines:
+            yield parse_fixed_width_lines(lines), sum(map(len, lines))
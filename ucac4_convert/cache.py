@@ -0,0 +1,171 @@
+import sys
+import threading
+from collections import OrderedDict
+
+# The query side keeps decoded zones (of the zone readers) and the results of recent queries in memory,
+# so that repeated searches around the same fields do not read and decode the same zones again.
+# The entries are evicted in least recently used order when the cache grows over its byte budget.
+
+# the default byte budget of the cache (--cache_size is in MB)
+default_cache_size = 256
+
+
+def value_size(value, sample=100):
+    """
+    estimate the memory size (bytes) of a cached value: numpy arrays, (nested) lists, tuples and dicts,
+    and functions with the values that they enclose (like the star readers of crossmatch.zone_reader).
+    The size of a long list is estimated from its first items.
+    """
+    # the cache does not import numpy, so that the cli starts without it. A cached array means that it is loaded
+    np = sys.modules.get('numpy')
+
+    if np is not None and np.ma.isMaskedArray(value):
+        return value_size(value.data, sample) + np.ma.getmask(value).nbytes
+
+    if np is not None and isinstance(value, np.ndarray):
+        if value.dtype == object and len(value):
+            # the pointers and the python objects (like the ucac2 strings)
+            return value.nbytes + value_size(value[:sample].tolist(), sample) * len(value) // min(len(value), sample)
+        return value.nbytes
+
+    if isinstance(value, (list, tuple)):
+        size = sys.getsizeof(value)
+        if not value:
+            return size
+        items = value[:sample]
+        return size + sum([value_size(item, sample) for item in items]) * len(value) // len(items)
+
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + value_size(list(value.values()), sample)
+
+    if callable(value) and getattr(value, '__closure__', None):
+        # the enclosed functions are not followed, they can enclose each other
+        return sys.getsizeof(value) + sum([value_size(cell.cell_contents, sample) for cell in value.__closure__
+                                           if not callable(cell.cell_contents)])
+
+    return sys.getsizeof(value)
+
+
+class LRUCache:
+    """
+    A cache with a byte budget and least recently used eviction, that counts its hits, misses and evictions.
+    It can be used from several threads.
+
+    Usage:
+        cache = LRUCache(256 * 1000000)
+        results = cache.cached(('cone', target, ra, dec, radius), lambda: cone_search(conn, ...))
+        print(cache.stats())
+    """
+
+    def __init__(self, max_bytes=0):
+        """
+        Constructor.
+        :param max_bytes: the byte budget, 0 disables the cache (every lookup is a miss, and nothing is stored)
+        """
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        """ the cached value of a key (which becomes the most recently used), or default """
+        with self.lock:
+            if key not in self.entries:
+                self.misses = self.misses + 1
+                return default
+
+            self.hits = self.hits + 1
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def put(self, key, value, size=None):
+        """
+        store a value, and evict the least recently used values until the cache fits in its budget.
+        A value that is larger than the whole budget is not stored.
+        :param size: the size of the value in bytes, estimated with value_size when not given
+        """
+        if self.max_bytes <= 0:
+            return
+
+        size = value_size(value) if size is None else size
+        with self.lock:
+            if key in self.entries:
+                self.bytes = self.bytes - self.entries.pop(key)[1]
+            if size > self.max_bytes:
+                return
+
+            while self.entries and self.bytes + size > self.max_bytes:
+                evicted_value, evicted_size = self.entries.popitem(last=False)[1]
+                self.bytes = self.bytes - evicted_size
+                self.evictions = self.evictions + 1
+
+            self.entries[key] = (value, size)
+            self.bytes = self.bytes + size
+
+    def cached(self, key, load, size=None):
+        """
+        the cached value of a key, or load (and store) it on a miss. None values are not stored.
+        :param load: function without arguments that returns the value
+        :param size: function(value) that returns the size of the value in bytes, see value_size
+        """
+        missing = object()
+        value = self.get(key, missing)
+        if value is not missing:
+            return value
+
+        value = load()
+        if value is not None:
+            self.put(key, value, size(value) if size else None)
+        return value
+
+    def stats(self):
+        """ :return: dict with the counters, the number of entries, and the size and budget in bytes """
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self.entries), 'bytes': self.bytes, 'max_bytes': self.max_bytes}
+
+    def report(self):
+        """ print the counters as a key=value line, like the progress lines of a conversion """
+        stats = self.stats()
+        print("cache hits=" + str(stats['hits']) + " misses=" + str(stats['misses']) +
+              " evictions=" + str(stats['evictions']) + " entries=" + str(stats['entries']) +
+              " mb=" + str(round(stats['bytes'] / 1000000, 2)) + "/" + str(round(stats['max_bytes'] / 1000000)))
+
+    def metrics(self):
+        """ the counters in the Prometheus text format (see progress.Progress.metrics) """
+        stats = self.stats()
+        lines = [
+            "# HELP ucac4_cache_hits_total Lookups that were found in the cache.",
+            "# TYPE ucac4_cache_hits_total counter",
+            "ucac4_cache_hits_total " + str(stats['hits']),
+            "# HELP ucac4_cache_misses_total Lookups that were not found in the cache.",
+            "# TYPE ucac4_cache_misses_total counter",
+            "ucac4_cache_misses_total " + str(stats['misses']),
+            "# HELP ucac4_cache_evictions_total Values that were evicted to stay within the budget.",
+            "# TYPE ucac4_cache_evictions_total counter",
+            "ucac4_cache_evictions_total " + str(stats['evictions']),
+            "# HELP ucac4_cache_entries Values in the cache.",
+            "# TYPE ucac4_cache_entries gauge",
+            "ucac4_cache_entries " + str(stats['entries']),
+            "# HELP ucac4_cache_bytes Estimated size of the values in the cache.",
+            "# TYPE ucac4_cache_bytes gauge",
+            "ucac4_cache_bytes " + str(stats['bytes']),
+        ]
+        return "\n".join(lines) + "\n"
+
+
+# The cache of the running process, for the zone readers and the query results.
+current = LRUCache(default_cache_size * 1000000)
+
+
+def start_cache(args):
+    """ start a new (empty) cache with a budget of --cache_size MB """
+    global current
+    current = LRUCache(int(args.cache_size * 1000000))
+    return current
@@ -0,0 +1,91 @@
+import os
+import numpy as np
+
+# pyarrow is only needed for the 'parquet' and 'arrow' targets, install it with 'pip install ucac4_converter[parquet]'
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from ucac4_convert.decoder import star_columns
+
+# the arrow types of the columns of the 'stars' table. Magnitudes are nullable integers (millimag).
+star_types = {
+    'zone': pa.int16(),
+    'mpos1': pa.int64(),
+    'ucac2': pa.string(),
+    'ot': pa.int8(),
+    'ra': pa.float64(),
+    'dec': pa.float64(),
+}
+star_schema = pa.schema([(name, star_types.get(name, pa.int16())) for name in star_columns])
+
+file_extensions = {
+    'parquet': '.parquet',
+    'arrow': '.arrow',
+}
+
+
+def column_type(name, column):
+    """ the arrow type of a decoded column, the other fields of the record keep their numpy type """
+    if name in star_types:
+        return star_types[name]
+    if np.ma.isMaskedArray(column):
+        # magnitudes in millimag
+        return pa.int16()
+    return pa.from_numpy_dtype(column.dtype)
+
+
+def table_from_columns(zone, columns):
+    """
+    convert the decoded numpy columns of a zone (see decoder.select_columns) into an arrow table,
+    masked values become nulls
+    """
+    number_of_stars = len(columns['mpos1'])
+    schema = pa.schema([('zone', star_types['zone'])] +
+                       [(name, column_type(name, column)) for name, column in columns.items()])
+    arrays = [pa.array(np.full(number_of_stars, zone), type=star_types['zone'])]
+
+    for field in schema:
+        if field.name == 'zone':
+            continue
+
+        column = columns[field.name]
+        if np.ma.isMaskedArray(column):
+            arrays.append(pa.array(column.data, mask=np.ma.getmaskarray(column), type=field.type))
+        else:
+            # ucac2 is an object column with None for 'no match', that also becomes a null
+            arrays.append(pa.array(column, type=field.type, from_pandas=True))
+
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def table_from_stars(stars):
+    """ convert a list of star tuples into an arrow table """
+    columns = list(zip(*stars)) if stars else [[] for name in star_columns]
+    arrays = [pa.array(list(column), type=field.type) for field, column in zip(star_schema, columns)]
+    return pa.Table.from_arrays(arrays, schema=star_schema)
+
+
+def columnar_path(target_location, filename, target_format):
+    """ the file of a zone in the target directory, like ../ucac4_parquet/z001.parquet """
+    return os.path.join(target_location, filename + file_extensions[target_format])
+
+
+def write_columnar(table, path, target_format, row_group_size):
+    """
+    write an arrow table to a compressed parquet or arrow (IPC) file.
+
+    For parquet, the row groups have min/max statistics per column. Stars in a zone are sorted on ra,
+    so readers can skip row groups with a predicate on ra (and dec) without reading them.
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    if target_format == 'parquet':
+        pq.write_table(table, path,
+                       row_group_size=row_group_size,
+                       compression='zstd',
+                       write_statistics=True)
+
+    elif target_format == 'arrow':
+        options = pa.ipc.IpcWriteOptions(compression='zstd')
+        with pa.ipc.new_file(path, table.schema, options=options) as writer:
+            writer.write_table(table, max_chunksize=row_group_size)
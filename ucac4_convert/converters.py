@@ -1,34 +1,64 @@
-import os, sys
+import os
+import time
 import struct
-import pika
+import argparse
 
 from ucac4_convert.database_helper import \
     open_sqlite_database,\
     open_postgres_database, \
-    add_star_to_sqlite, \
-    add_star_to_postgres, \
+    add_stars_to_sqlite, \
+    add_stars_to_postgres, \
+    copy_stars_to_postgres, \
+    create_indexes, \
+    set_sqlite_pragmas, \
+    bulk_load_pragmas, \
+    add_primary_key_to_postgres, \
+    create_table, \
+    tier_table_schema, \
+    iter_csv_chunks_from_stars, \
     add_zone_to_database, \
     create_database_schema, \
-    create_table_schema, \
+    table_schema, \
     zone_stats
 
-progressbar_length = 100
-
-def send_message_to_rabbitMQ(args, exchange, message):
-    try:
-        rabbit_host = args.rabbit_host
-        rabbit_port = args.rabbit_port
-        credentials = pika.PlainCredentials(args.rabbit_user, args.rabbit_password)
-        connection = pika.BlockingConnection(pika.ConnectionParameters(rabbit_host, rabbit_port, '/', credentials))
-
-        channel = connection.channel()
-        channel.exchange_declare(exchange=exchange, exchange_type='fanout')
-        channel.basic_publish(exchange=exchange, routing_key='', body=message)
-
-        connection.close()
-    except:
-        # only send a message if all parameters are given, otherwise just ignore
-        pass
+from ucac4_convert.decoder import \
+    record_size, \
+    star_columns, \
+    select_columns, \
+    read_binary_zone, \
+    iter_binary_blocks, \
+    records_from_block, \
+    decode_columns, \
+    stars_from_columns, \
+    column_to_list, \
+    iter_star_batches, \
+    csv_from_columns, \
+    iter_csv_chunks
+
+from ucac4_convert.ascii_reader import iter_ascii_lines, iter_ascii_columns, is_u4dump_file
+
+from ucac4_convert.ledger import \
+    file_fingerprint, \
+    open_ledger, \
+    get_ledger_entry, \
+    update_ledger, \
+    ledger_batches, \
+    delete_zone, \
+    skip_stars
+from ucac4_convert.epoch import epoch_columns, epoch_table_name, read_epoch_stars
+from ucac4_convert.tiers import parse_tiers, tier_table_name, tier_stars
+from ucac4_convert.shards import shard_target, write_manifest, read_manifest
+from ucac4_convert.pack import convert_from_binary_to_pack
+from ucac4_convert.notifier import RabbitMQNotifier
+from ucac4_convert import progress
+from ucac4_convert.pipeline import ZonePipeline
+from ucac4_convert.parallel import convert_zones_in_parallel
+
+# the target formats that write into databases
+database_targets = ['sqlite', 'sqlite-shards', 'postgres', 'postgres-copy']
+
+# the target formats that write a file per zone into a directory
+file_targets = ['parquet', 'arrow', 'ucac4pack']
 
 def convert_zonestats_from_ascii_to_sqlite(source_location, target_location):
     """
@@ -74,16 +104,13 @@ def convert_zonestats_from_ascii_to_sqlite(source_location, target_location):
     # create a database connection
     conn = open_sqlite_database(database_name, zone_stats, True)
 
-    with open(source_location, "r") as f:
-        lines = f.readlines()
+    # skip the lines with header and documentation
+    for line in iter_ascii_lines(source_location, 11):
+        if line.strip() and not "-----" in line:
+            zone = _parse_ascii_line(line)
 
-        # skip the lines with header and documentation
-        for line in lines[11:]:
-            if not "-----" in line:
-                zone = _parse_ascii_line(line)
-
-                add_zone_to_database(conn, zone)
-                count = count + 1
+            add_zone_to_database(conn, zone)
+            count = count + 1
 
     # close the database connection
     if conn:
@@ -93,131 +120,363 @@ def convert_zonestats_from_ascii_to_sqlite(source_location, target_location):
 
 
 
-def convert_from_ascii_to_database(source_location, target_location):
+def parse_ascii_line(line):
+    """
+    parse a line of the UCAC4 ascii catalog (like UCAC4_sample.txt) into a star tuple
+    """
+    # https://irsa.ipac.caltech.edu/data/UCAC4/readme_u4.txt
+    zone = int(line[0:3])
+    ucac4_id = line[0:10]
+    mpos1 = int(line[129:138])
+    ucac2 = line[139:149]
+
+    ot = int(line[84:85])
+
+    # 0 = good, clean star (from MPOS), no known problem
+    # 1 = largest flag of any image = near overexposed star (from MPOS)
+    # 2 = largest flag of any image = possible streak object (from MPOS)
+    # 3 = high proper motion (HPM) star, match with external PM file (MPOS)
+    # 4 = actually use external HPM data instead of UCAC4 observ.data (accuracy of positions varies between catalogs)
+    # 5 = poor proper motion solution, report only CCD epoch position
+    # 6 = substitute poor astrometric results by FK6/Hip/Tycho-2 data
+    # 7 = added supplement star (no CCD data) from FK6/Hip/Tycho-2 data, and 2 stars added from high proper motion surveys
+    # 8 = high proper motion solution in UCAC4, star not matched with PPMXL
+    # 9 = high proper motion solution in UCAC4, discrepant PM to PPMXL (see documentation
+
+    ra = float(line[11:22])
+    dec = float(line[22:33])
+
+    # 3e) Additional photometry
+    # -------------------------
+    # The UCAC4 observational data are supplemented with 5-band photometry (B,V,
+    # g,r,i) from the APASS project (Henden, private comm.) as well as with IR
+    # photometry (J,H,K_s) from the Two Micron All Sky Survey, 2MASS (Skrutskie
+    # et al. 2006).  In addition, magnitudes errors and some flags are provided.
+    # For more details see http://www.aavso.org/apass  and
+    # http://www.ipac.caltech.edu/2mass/releases/allsky/ .
+    #
+    # https://iopscience.iop.org/article/10.1088/0004-6256/148/5/81
 
-    def _parse_ascii_line(line):
-        # https://irsa.ipac.caltech.edu/data/UCAC4/readme_u4.txt
-        zone = 1
-        ucac4_id = line[0:10]
-        mpos1 = int(line[129:138])
-        ucac2 = line[139:149]
-
-        ot = int(line[84:85])
-
-        # 0 = good, clean star (from MPOS), no known problem
-        # 1 = largest flag of any image = near overexposed star (from MPOS)
-        # 2 = largest flag of any image = possible streak object (from MPOS)
-        # 3 = high proper motion (HPM) star, match with external PM file (MPOS)
-        # 4 = actually use external HPM data instead of UCAC4 observ.data (accuracy of positions varies between catalogs)
-        # 5 = poor proper motion solution, report only CCD epoch position
-        # 6 = substitute poor astrometric results by FK6/Hip/Tycho-2 data
-        # 7 = added supplement star (no CCD data) from FK6/Hip/Tycho-2 data, and 2 stars added from high proper motion surveys
-        # 8 = high proper motion solution in UCAC4, star not matched with PPMXL
-        # 9 = high proper motion solution in UCAC4, discrepant PM to PPMXL (see documentation
-
-        ra = float(line[11:22])
-        dec = float(line[23:33])
-
-        # 3e) Additional photometry
-        # -------------------------
-        # The UCAC4 observational data are supplemented with 5-band photometry (B,V,
-        # g,r,i) from the APASS project (Henden, private comm.) as well as with IR
-        # photometry (J,H,K_s) from the Two Micron All Sky Survey, 2MASS (Skrutskie
-        # et al. 2006).  In addition, magnitudes errors and some flags are provided.
-        # For more details see http://www.aavso.org/apass  and
-        # http://www.ipac.caltech.edu/2mass/releases/allsky/ .
-        #
-        # https://iopscience.iop.org/article/10.1088/0004-6256/148/5/81
+    try:
+        f_mag = round(float(line[63:69]) * 1000)
+    except:
+        f_mag = None
 
-        try:
-            f_mag = round(float(line[63:69]) * 1000)
-        except:
-            f_mag = None
+    try:
+        a_mag = round(float(line[70:76]) * 1000)
+    except:
+        a_mag = None
 
-        try:
-            a_mag = round(float(line[70:76]) * 1000)
-        except:
-            a_mag = None
+    try:
+        j_mag = round(float(line[174:180]) * 1000)
+    except:
+        j_mag = None
 
-        try:
-            j_mag = round(float(line[174:180]) * 1000)
-        except:
-            j_mag = None
+    try:
+        h_mag = round(float(line[189:195]) * 1000)
+    except:
+        h_mag = None
 
-        try:
-            h_mag = round(float(line[189:195]) * 1000)
-        except:
-            h_mag = None
+    try:
+        k_mag = round(float(line[204:210]) * 1000)
+    except:
+        k_mag = None
 
-        try:
-            k_mag = round(float(line[204:210]) * 1000)
-        except:
-            k_mag = None
+    try:
+        b_mag = round(float(line[219:225]) * 1000)
+    except:
+        b_mag = None
 
-        try:
-            b_mag = round(float(line[219:225]) * 1000)
-        except:
-            b_mag = None
+    try:
+        v_mag = round(float(line[230:236]) * 1000)  # visual magnitude
+    except:
+        v_mag = None
 
-        try:
-            v_mag = round(float(line[230:236]) * 1000)  # visual magnitude
-        except:
-            v_mag = None
+    try:
+        g_mag = round(float(line[241:247]) * 1000)
+    except:
+        g_mag = None
 
-        try:
-            g_mag = round(float(line[241:247]) * 1000)
-        except:
-            g_mag = None
+    try:
+        r_mag = round(float(line[252:258]) * 1000)
+    except:
+        r_mag = None
 
-        try:
-            r_mag = round(float(line[252:258]) * 1000)
-        except:
-            r_mag = None
+    try:
+        i_mag = round(float(line[263:269]) * 1000)
+    except:
+        i_mag = None
 
-        try:
-            i_mag = round(float(line[263:269]) * 1000)
-        except:
-            i_mag = None
+    # save the star
+    star = (zone, mpos1, ucac2, ot, ra, dec, j_mag, h_mag, k_mag, b_mag, v_mag, g_mag, r_mag, i_mag)
 
-        # save the star
-        star = (zone, mpos1, ucac2, ot, ra, dec, j_mag, h_mag, k_mag, b_mag, v_mag, g_mag, r_mag, i_mag)
+    # star = (ucac4_id,ot,ra,dec,j_mag,h_mag,k_mag,b_mag,v_mag,g_mag,r_mag,i_mag )
+    return star
 
-        # star = (ucac4_id,ot,ra,dec,j_mag,h_mag,k_mag,b_mag,v_mag,g_mag,r_mag,i_mag )
-        return star
 
+def convert_from_ascii_to_database(args, source_location, target_location, target_format):
+    """
+    convert an ascii catalog file, the fixed width catalog (like UCAC4_sample.txt) or the comma separated
+    output of u4dump (like z001.asc). The file is parsed in chunks of --batch_size lines with numpy,
+    see ascii_reader.iter_ascii_columns. A u4dump file has all fields of the binary record, so it has --columns.
+    """
     count = 0
 
     db_table_names = target_location.split(':')
     database_name = db_table_names[0]
     table_name = db_table_names[1]
 
-    # create a database connection
-    schema = create_table_schema.replace("replace-with-zone", table_name)
-    conn = open_sqlite_database(database_name, schema, True)
-
-    with open(source_location, "r") as f:
-        # with codecs.open(source_location, 'r', encoding='utf-8', errors='ignore') as f:
-        lines = f.readlines()
-        number_of_stars = len(lines) - 1
-        progress_factor = round(number_of_stars / progressbar_length)
+    columns = select_columns(args.columns)
+    if columns != star_columns and not is_u4dump_file(source_location):
+        raise Exception("--columns is only supported for binary sources and u4dump ascii files (like z001.asc)")
 
-        # skip the first line with the header
-        for line in lines[1:]:
-            star = _parse_ascii_line(line)
-
-            add_star_to_sqlite(conn, table_name, star)
-            count = count + 1
+    # create a database connection, with --bulk_load the indexes are built after loading all stars
+    schema = table_schema(columns, primary_key=not args.bulk_load or target_format == 'sqlite')
+    schema = schema.replace("replace-with-zone", table_name)
+    pragmas = []
 
-            if (count % progress_factor) == 0:
-                sys.stdout.write(".")
+    if target_format == 'sqlite':
+        conn = open_sqlite_database(database_name, schema, True)
+        if args.bulk_load:
+            pragmas = set_sqlite_pragmas(conn, bulk_load_pragmas)
+    else:
+        conn = open_postgres_database(args, database_name, schema)
 
-    # close the database connection
+    if not args.bulk_load:
+        create_indexes(conn, table_name, columns)
+
+    def _star_batches():
+        nonlocal count
+
+        # stream the file in chunks of lines, every chunk is parsed into columns at once
+        for chunk, size in iter_ascii_columns(source_location, args.batch_size, columns):
+            stars = list(zip(*[column_to_list(column) for column in chunk.values()]))
+            count = count + len(stars)
+            progress.current.add(len(stars), size)
+            yield stars
+
+    if target_format == 'postgres-copy':
+        # COPY parses and writes in the same stream and transaction
+        with progress.current.stage('write', transaction=True):
+            copy_stars_to_postgres(conn, table_name, iter_csv_chunks_from_stars(_star_batches()), columns)
+    else:
+        for stars in progress.current.timed('decode', _star_batches()):
+            with progress.current.stage('write', transaction=True):
+                if target_format == 'sqlite':
+                    add_stars_to_sqlite(conn, table_name, stars, args.batch_size, columns)
+                elif target_format == 'postgres':
+                    add_stars_to_postgres(conn, table_name, stars, args.batch_size, columns)
+
+    # put the sqlite settings back, and close the database connection
     if conn:
+        set_sqlite_pragmas(conn, pragmas)
         conn.close()
 
     return count
 
 
+def read_binary_stars_with_struct(zone, source_location, batch_size):
+    """
+    Read the stars from a binary zone file record by record with struct.unpack,
+    and yield them in batches of star tuples.
+    This is the original (slow) decoder, kept to check the numpy decoder against.
+    """
+    # this assumes a naming convention of binary files like z001,z002,z???
+    # and the record size of 78 bytes per star
+    number_of_stars = round(os.path.getsize(source_location) / record_size)
+    count = 0
+    stars = []
+
+    with open(source_location, "rb") as f:
+        pointer = 0
+
+        while count < number_of_stars:
+
+            # ra,dec
+            size = 8
+            f.seek(pointer)
+            bytes = f.read(size)
+
+            # https://docs.python.org/3/library/struct.html
+            ra_mas, spd_mas = struct.unpack('<II', bytes)  # expected: 4117825, 292970
+
+            # convert from milliarcseconds and distance from the south pole
+            ra = ra_mas / 3600000
+            dec = -90 + (spd_mas / 3600000)
+
+            # advance pointer, and skip 5 bytes
+            pointer = pointer + size + 5
+
+            # object_type
+            size = 1
+            f.seek(pointer)
+            bytes = f.read(size)
+            try:
+                ot = struct.unpack('<B', bytes)[0]
+            except:
+                ot = 0
+
+            # advance pointer, and skip 20 bytes
+            pointer = pointer + size + 20
+
+            # j,h,k magnitude
+            size = 6
+            f.seek(pointer)
+            bytes = f.read(size)
+
+            # https://docs.python.org/3/library/struct.html
+            j_mag, h_mag, k_mag = struct.unpack('<hhh', bytes)
+            j_mag = None if j_mag == 20000 else j_mag
+            h_mag = None if h_mag == 20000 else h_mag
+            k_mag = None if k_mag == 20000 else k_mag
+
+            # advance pointer, and skip 6 bytes
+            pointer = pointer + size + 6
+
+            # b,v,g,r,i magnitude
+            size = 10
+            f.seek(pointer)
+            bytes = f.read(size)
+
+            # https://docs.python.org/3/library/struct.html
+            b_mag, v_mag, g_mag, r_mag, i_mag = struct.unpack('<hhhhh', bytes)
+            b_mag = None if b_mag == 20000 else b_mag
+            v_mag = None if v_mag == 20000 else v_mag
+            g_mag = None if g_mag == 20000 else g_mag
+            r_mag = None if r_mag == 20000 else r_mag
+            i_mag = None if i_mag == 20000 else i_mag
+
+            # advance pointer, and skip 12 bytes
+            pointer = pointer + size + 12
+
+            # id
+            size = 10
+            f.seek(pointer)
+            bytes = f.read(size)
+
+            # https://docs.python.org/3/library/struct.html
+            mpos1, zone2, rec = struct.unpack('<IhI', bytes)
+
+            ucac2 = str(zone2).zfill(3) + '-' + str(rec).zfill(6)
+            ucac2 = None if ucac2 == "000-000000" else ucac2
+
+            # advance pointer
+            pointer = pointer + size
+
+            # save the star
+            star = (zone, mpos1, ucac2, ot, ra, dec, j_mag, h_mag, k_mag, b_mag, v_mag, g_mag, r_mag, i_mag)
+            stars.append(star)
+            count = count + 1
+
+            if len(stars) == batch_size:
+                yield stars
+                stars = []
+
+    if stars:
+        yield stars
+
+
+def read_binary_star_batches(args, zone, source_location, start=0):
+    """
+    read and decode a binary zone file into batches of star tuples, with the decoder given by --decoder.
+    With --pipeline_depth the reading and decoding run in their own threads (ZonePipeline).
+    :param start: the number of (already committed) stars to skip
+    """
+    if args.decoder == 'struct':
+        return skip_stars(read_binary_stars_with_struct(zone, source_location, args.batch_size), start)
+
+    selected = select_columns(args.columns)
+
+    if args.pipeline_depth > 0:
+        blocks = iter_binary_blocks(source_location, args.batch_size, start)
+        decode = lambda block: stars_from_columns(zone, decode_columns(records_from_block(block), selected))
+        return ZonePipeline(blocks, decode, args.pipeline_depth)
+
+    # decode the whole zone at once as numpy columns
+    columns = decode_columns(read_binary_zone(source_location), selected)
+    return iter_star_batches(zone, columns, args.batch_size, start)
+
+
+def read_binary_csv_chunks(args, zone, source_location):
+    """
+    read and decode a binary zone file into chunks of csv text for COPY FROM STDIN,
+    with the decoder given by --decoder, and in a ZonePipeline with --pipeline_depth.
+    """
+    if args.decoder == 'struct':
+        return iter_csv_chunks_from_stars(read_binary_stars_with_struct(zone, source_location, args.batch_size))
+
+    selected = select_columns(args.columns)
+
+    if args.pipeline_depth > 0:
+        blocks = iter_binary_blocks(source_location, args.batch_size)
+        decode = lambda block: csv_from_columns(zone, decode_columns(records_from_block(block), selected))
+        return ZonePipeline(blocks, decode, args.pipeline_depth)
+
+    columns = decode_columns(read_binary_zone(source_location), selected)
+    return iter_csv_chunks(zone, columns, args.batch_size)
+
+
+def write_epoch_table(args, conn, target_format, table_name, source_location):
+    """
+    write the stars of a zone with their positions moved to --epoch into a precomputed epoch table
+    (like stars_j2026_5), that can be searched with a cone search just like the table itself.
+    """
+    epoch_table = epoch_table_name(table_name, args.epoch)
+    create_table(conn, table_schema(epoch_columns).replace("replace-with-zone", epoch_table))
+    create_indexes(conn, epoch_table, epoch_columns)
+
+    stars = read_epoch_stars(source_location, args.epoch)
+    if target_format == 'sqlite':
+        add_stars_to_sqlite(conn, epoch_table, stars, args.batch_size, epoch_columns)
+    else:
+        add_stars_to_postgres(conn, epoch_table, stars, args.batch_size, epoch_columns)
+
+
+def create_tier_tables(args, conn, target_format, table_name):
+    """ create the --tiers tables, like stars_v10, stars_v12 and stars_v14 """
+    schema = tier_table_schema(select_columns(args.columns), target_format == 'sqlite')
+    for limit in parse_tiers(args.tiers):
+        create_table(conn, schema.replace("replace-with-zone", tier_table_name(table_name, limit)))
+
+
+def derived_tables(args, conn, target_format, table_name):
+    """
+    the --epoch and --tiers tables of a table, they are created when they do not exist yet
+    :return: (the epoch table or None, the list of tier tables)
+    """
+    epoch_table = None
+    if args.epoch is not None:
+        epoch_table = epoch_table_name(table_name, args.epoch)
+        create_table(conn, table_schema(epoch_columns).replace("replace-with-zone", epoch_table))
+
+    tier_tables = []
+    if args.tiers:
+        create_tier_tables(args, conn, target_format, table_name)
+        tier_tables = [tier_table_name(table_name, limit) for limit in parse_tiers(args.tiers)]
+
+    return epoch_table, tier_tables
+
+
+def read_tier_stars(args, zone, source_location):
+    """ decode a zone and select the stars of the --tiers tables, :return: the rows per tier """
+    columns = decode_columns(read_binary_zone(source_location), select_columns(args.columns))
+    return tier_stars(zone, columns, parse_tiers(args.tiers))
+
+
+def write_tier_tables(args, conn, target_format, table_name, tiers):
+    """
+    write the rows of a zone into the --tiers tables, with the brightest stars sorted on cell and V magnitude
+    :param tiers: the rows per tier, see read_tier_stars
+    """
+    columns = ['cell'] + select_columns(args.columns)
+    for limit, stars in zip(parse_tiers(args.tiers), tiers):
+        tier_table = tier_table_name(table_name, limit)
+        if target_format == 'sqlite':
+            add_stars_to_sqlite(conn, tier_table, stars, args.batch_size, columns)
+        else:
+            add_stars_to_postgres(conn, tier_table, stars, args.batch_size, columns)
+
+
 def convert_from_binary_to_database(args, source_location, target_location, target_format):
     """
             col byte item   fmt unit       explanation                            notes
@@ -286,125 +545,161 @@ def convert_from_binary_to_database(args, source_location, target_location, targ
                  78 = total number of bytes per star record
 
     """
+    if target_format in file_targets:
+        if target_format == 'ucac4pack':
+            count = convert_from_binary_to_pack(args, source_location, target_location)
+        else:
+            count = convert_from_binary_to_columnar(args, source_location, target_location, target_format)
+
+        # the file targets write a whole zone at once, and report it when it is done.
+        # (in the worker processes of a parallel conversion this is their own progress, the main process reports)
+        progress.current.add(count, os.path.getsize(source_location))
+        return count
+
+    if target_format == 'sqlite-shards':
+        # every zone is converted into the sqlite file of its shard
+        args, target_location = shard_target(args, target_location, int(source_location[-3:]))
+        target_format = 'sqlite'
+
     zone = int(source_location[-3:])
     count = 0
 
     # create a database connection
     conn = None
 
-    # construct the correct database schema for this zone
+    # construct the correct database schema for this zone, with the columns given by --columns
 
     db_table_names = target_location.split(':')
     database_name = db_table_names[0]
     table_name = db_table_names[1]
-    schema = create_table_schema.replace("replace-with-zone", table_name)
+    # with --bulk_load the primary key (postgres) and the indexes are built after loading all zones.
+    # sqlite keeps its primary key, because 'mpos1 integer PRIMARY KEY' is the rowid and not an extra index.
+    columns = select_columns(args.columns)
+    schema = table_schema(columns, primary_key=not args.bulk_load or target_format == 'sqlite')
+    schema = schema.replace("replace-with-zone", table_name)
 
     if target_format == 'sqlite':
         # target_location: ../z001.sqlite3
         conn = open_sqlite_database(database_name, schema,args.remove_database)
 
-    elif target_format == 'postgres':
+    elif target_format in ['postgres', 'postgres-copy']:
         conn = open_postgres_database(args, database_name, schema)
 
-    # this assumes a naming convention of binary files like z001,z002,z???
-    # and the record size of 78 bytes per star
-    number_of_stars = round(os.path.getsize(source_location) / 78)
-
-    with open(source_location, "rb") as f:
-        progress_factor = round(number_of_stars / progressbar_length)
-        pointer = 0
-
-        while count < number_of_stars:
-
-            # ra,dec
-            size = 8
-            f.seek(pointer)
-            bytes = f.read(size)
-
-            # https://docs.python.org/3/library/struct.html
-            ra_mas, spd_mas = struct.unpack('<II', bytes)  # expected: 4117825, 292970
-
-            # convert from milliarcseconds and distance from the south pole
-            ra = ra_mas / 3600000
-            dec = -90 + (spd_mas / 3600000)
-
-            # advance pointer, and skip 5 bytes
-            pointer = pointer + size + 5
-
-            # object_type
-            size = 1
-            f.seek(pointer)
-            bytes = f.read(size)
-            try:
-                ot = struct.unpack('<B', bytes)[0]
-            except:
-                ot = 0
-
-            # advance pointer, and skip 20 bytes
-            pointer = pointer + size + 20
-
-            # j,h,k magnitude
-            size = 6
-            f.seek(pointer)
-            bytes = f.read(size)
-
-            # https://docs.python.org/3/library/struct.html
-            j_mag, h_mag, k_mag = struct.unpack('<hhh', bytes)
-            j_mag = None if j_mag == 20000 else j_mag
-            h_mag = None if h_mag == 20000 else h_mag
-            k_mag = None if k_mag == 20000 else k_mag
-
-            # advance pointer, and skip 6 bytes
-            pointer = pointer + size + 6
-
-            # b,v,g,r,i magnitude
-            size = 10
-            f.seek(pointer)
-            bytes = f.read(size)
-
-            # https://docs.python.org/3/library/struct.html
-            b_mag, v_mag, g_mag, r_mag, i_mag = struct.unpack('<hhhhh', bytes)
-            b_mag = None if b_mag == 20000 else b_mag
-            v_mag = None if v_mag == 20000 else v_mag
-            g_mag = None if g_mag == 20000 else g_mag
-            r_mag = None if r_mag == 20000 else r_mag
-            i_mag = None if i_mag == 20000 else i_mag
-
-            # advance pointer, and skip 12 bytes
-            pointer = pointer + size + 12
-
-            # id
-            size = 10
-            f.seek(pointer)
-            bytes = f.read(size)
-
-            # https://docs.python.org/3/library/struct.html
-            mpos1, zone2, rec = struct.unpack('<IhI', bytes)
-
-            ucac2 = str(zone2).zfill(3) + '-' + str(rec).zfill(6)
-            ucac2 = None if ucac2 == "000-000000" else ucac2
+    if not args.bulk_load:
+        create_indexes(conn, table_name, columns)
+
+    # the ledger tells if this zone was (partially) converted before
+    # (the checksum of the source file is only calculated when its size or mtime differ from the ledger)
+    source = os.path.basename(source_location)
+    open_ledger(conn)
+    entry = get_ledger_entry(conn, table_name, source)
+    fingerprint = file_fingerprint(source_location, entry)
+    committed = 0
+
+    if entry and entry[0] == fingerprint[0]:
+        if entry[2]:
+            # already completed, skip the zone. A copy or touch of the same file gets its new mtime in the ledger,
+            # so that the next run skips it without reading it
+            if entry[3:] != fingerprint[1:]:
+                update_ledger(conn, table_name, source, fingerprint, entry[1], True)
+            progress.current.skip(os.path.getsize(source_location))
+            conn.close()
+            return entry[1]
+
+        # continue after the last committed batch
+        committed = entry[1]
+        progress.current.skip(committed * record_size)
+
+    elif entry:
+        # the source file has changed since its last conversion, start over. The epoch and tier rows of the
+        # zone are inserted with 'ignore' like the stars, so the old ones are removed as well (like update.replace_zone)
+        epoch_table, tier_tables = derived_tables(args, conn, target_format, table_name)
+        delete_zone(conn, table_name, zone, epoch_table, tier_tables)
+
+    update_ledger(conn, table_name, source, fingerprint, committed, False)
+
+    pragmas = []
+    if target_format == 'sqlite' and args.bulk_load:
+        pragmas = set_sqlite_pragmas(conn, bulk_load_pragmas)
+
+    if target_format == 'postgres-copy':
+        # COPY loads the whole zone in one transaction, so remove what an interrupted earlier run has left
+        if entry:
+            delete_zone(conn, table_name, zone)
+
+        # stream the whole zone as csv into COPY FROM STDIN, COPY decodes and writes in the same stream and transaction
+        with progress.current.stage('write', transaction=True):
+            reader = read_binary_csv_chunks(args, zone, source_location)
+            committed = copy_stars_to_postgres(conn, table_name, reader, columns)
+        progress.current.add(committed, committed * record_size)
+
+    else:
+        with progress.current.stage('decode'):
+            reader = read_binary_star_batches(args, zone, source_location, committed)
+
+        ledger = ledger_batches(table_name, source, fingerprint, committed)
+        for stars in progress.current.timed('decode', reader):
+
+            # every batch is written in a single transaction, together with its ledger row
+            with progress.current.stage('write', transaction=True):
+                if target_format == 'sqlite':
+                    add_stars_to_sqlite(conn, table_name, stars, args.batch_size, columns, ledger)
+                elif target_format == 'postgres':
+                    add_stars_to_postgres(conn, table_name, stars, args.batch_size, columns, ledger)
+
+            committed = committed + len(stars)
+            progress.current.add(len(stars), len(stars) * record_size)
+
+    if isinstance(reader, ZonePipeline):
+        print(source + " " + reader.report())
+
+    if args.epoch is not None:
+        with progress.current.stage('epoch'):
+            write_epoch_table(args, conn, target_format, table_name, source_location)
+
+    if args.tiers:
+        with progress.current.stage('tiers'):
+            create_tier_tables(args, conn, target_format, table_name)
+            write_tier_tables(args, conn, target_format, table_name, read_tier_stars(args, zone, source_location))
+
+    update_ledger(conn, table_name, source, fingerprint, committed, True)
+    count = committed
+
+    # put the sqlite settings back, and close the database connection
+    if conn:
+        set_sqlite_pragmas(conn, pragmas)
+        conn.close()
 
-            # advance pointer
-            pointer = pointer + size
+    return count
 
-            # save the star
-            star = (zone, mpos1, ucac2, ot, ra, dec, j_mag, h_mag, k_mag, b_mag, v_mag, g_mag, r_mag, i_mag)
 
-            if target_format == 'sqlite':
-                add_star_to_sqlite(conn, table_name, star)
-            elif target_format == 'postgres':
-                add_star_to_postgres(conn, table_name, star)
+def convert_from_binary_to_columnar(args, source_location, target_location, target_format):
+    """
+    Convert a binary zone file to a compressed parquet or arrow file in the target directory,
+    one file per zone (../ucac4_parquet/z001.parquet), with row groups of --batch_size stars.
+    """
+    # pyarrow is an optional dependency, only import it when it is used
+    from ucac4_convert.columnar import \
+        table_from_columns, \
+        table_from_stars, \
+        columnar_path, \
+        write_columnar
 
-            count = count + 1
+    zone = int(source_location[-3:])
 
-            if (count % progress_factor) == 0:
-                sys.stdout.write(".")
+    if args.decoder == 'struct':
+        stars = []
+        for star_batch in read_binary_stars_with_struct(zone, source_location, args.batch_size):
+            stars.extend(star_batch)
+        table = table_from_stars(stars)
+    else:
+        columns = decode_columns(read_binary_zone(source_location), select_columns(args.columns))
+        table = table_from_columns(zone, columns)
 
-    # close the database connection
-    if conn:
-        conn.close()
+    path = columnar_path(target_location, os.path.basename(source_location), target_format)
+    write_columnar(table, path, target_format, args.batch_size)
 
-    return count
+    return table.num_rows
 
 
 class UCAC4_Converter:
@@ -422,15 +717,113 @@ class UCAC4_Converter:
         self.target_location = args.target.split('::')[1]
 
 
+    def report_zone(self, source_name, count, duration, size=0):
+        """
+        print and send the summary of a converted zone (or range of zones), with its throughput
+        :param size: the size of the source file(s) in bytes
+        """
+        message = source_name + ": " + str(count) + " stars"
+        if duration > 0:
+            message = message + " in " + str(round(duration, 2)) + " s (" + str(round(count / duration)) + " stars/sec"
+            if size:
+                message = message + ", " + str(round(size / duration / 1000000, 2)) + " MB/sec"
+            message = message + ")"
+
+        print(message)
+        self.notifier.send(message)
+
+
+    def finish_bulk_load(self):
+        """
+        after a --bulk_load of all stars: add the primary key (postgres, with a report of the duplicate stars),
+        build the indexes once, and update the statistics of the query planner.
+        """
+        database_name, table_name = self.target_location.split(':')
+        columns = select_columns(self.args.columns) if self.source_format == 'binary' else star_columns
+        schema = table_schema(columns).replace("replace-with-zone", table_name)
+
+        print("building the indexes of " + table_name + "...")
+        timestamp = time.time()
+
+        # a sharded target has a database per shard
+        database_names = [database_name]
+        if self.target_format == 'sqlite-shards':
+            database_names = [os.path.join(database_name, shard[0]) for shard in read_manifest(database_name)]
+
+        for database_name in database_names:
+            if self.target_format in ['sqlite', 'sqlite-shards']:
+                conn = open_sqlite_database(database_name, schema, False)
+                pragmas = set_sqlite_pragmas(conn, bulk_load_pragmas)
+                create_indexes(conn, table_name, columns)
+                set_sqlite_pragmas(conn, pragmas)
+            else:
+                conn = open_postgres_database(self.args, database_name, schema)
+                add_primary_key_to_postgres(conn, table_name)
+                create_indexes(conn, table_name, columns)
+
+            cur = conn.cursor()
+            cur.execute("ANALYZE " + table_name)
+            conn.commit()
+            conn.close()
+
+        print("indexes built in " + str(round(time.time() - timestamp, 1)) + " seconds")
+
+
+    def source_size(self):
+        """ the size in bytes of the binary zone file(s) to convert, for the ETA (0 for other sources) """
+        if self.source_format != 'binary':
+            return 0
+
+        if "..z" in self.source_location:
+            source_range = self.source_location[-10:]
+            source_base = self.source_location.replace(source_range, '')
+            source_locations = [os.path.join(source_base, 'z' + str(x).zfill(3))
+                                for x in range(int(source_range[1:4]), int(source_range[7:10]) + 1)]
+        else:
+            source_locations = [self.source_location]
+
+        return sum([os.path.getsize(source_location) for source_location in source_locations
+                    if os.path.exists(source_location)])
+
+
     def convert(self):
+        """ run the conversion, the progress messages are sent to RabbitMQ in the background """
+        self.notifier = RabbitMQNotifier(self.args, 'slack')
+        try:
+            return self._convert()
+        finally:
+            self.notifier.close()
+
+
+    def _convert(self):
+
+        if self.target_format in file_targets + ['sqlite-shards'] and self.source_format != 'binary':
+            raise Exception("target format '" + self.target_format + "' is only supported for binary sources")
+
+        if self.args.epoch is not None and \
+                (self.source_format != 'binary' or self.target_format not in database_targets):
+            raise Exception("--epoch is only supported for binary sources and database targets")
+
+        if self.args.tiers and \
+                (self.source_format != 'binary' or self.target_format not in database_targets):
+            raise Exception("--tiers is only supported for binary sources and database targets")
+
+        if self.args.tiers and 'v_mag' not in select_columns(self.args.columns):
+            raise Exception("--tiers needs the v_mag column")
+
+        # the struct decoder only has the columns of the 'stars' table, the ascii sources are checked when they are read
+        if select_columns(self.args.columns) != star_columns and \
+                (self.source_format not in ['binary', 'ascii'] or self.args.decoder == 'struct'):
+            raise Exception("--columns is only supported for binary sources with the numpy decoder and u4dump ascii files")
 
-        if self.target_format == 'sqlite' or self.target_format == 'postgres':
+        if self.target_format in database_targets + file_targets:
+            progress.start_progress(self.args, self.source_size())
 
             if self.source_format == 'ascii_zonestats':
                 count = convert_zonestats_from_ascii_to_sqlite(self.source_location, self.target_location)
 
             elif self.source_format == 'ascii':
-                count = convert_from_ascii_to_database(self.source_location, self.target_location)
+                count = convert_from_ascii_to_database(self.args, self.source_location, self.target_location, self.target_format)
 
             elif self.source_format == 'binary':
                 count = 0
@@ -444,20 +837,60 @@ class UCAC4_Converter:
                     start = int(source_range[1:4])
                     end =int(source_range[7:10])
 
-                    for x in range(start,end+1):
-                        filename = 'z'+str(x).zfill(3)
-                        source_location = os.path.join(source_base,filename)
-                        subcount = convert_from_binary_to_database(self.args, source_location, self.target_location, self.target_format)
-                        count = count + subcount
+                    range_timestamp = time.time()
+                    range_size = 0
 
-                        message = filename + ": "+str(subcount)+ " stars"
-                        print(message)
-                        send_message_to_rabbitMQ(self.args,'slack',message)
+                    if self.args.workers > 1:
+                        source_locations = [os.path.join(source_base,'z'+str(x).zfill(3)) for x in range(start,end+1)]
+                        for filename, subcount, duration in convert_zones_in_parallel(
+                                self.args, source_locations, self.target_location, self.target_format, self.args.workers):
+                            count = count + subcount
+                            size = os.path.getsize(os.path.join(source_base, filename))
+                            range_size = range_size + size
+
+                            # except for sqlite, the workers write the stars themselves and report nothing
+                            if self.target_format != 'sqlite':
+                                progress.current.add(subcount, size)
+                            self.report_zone(filename, subcount, duration, size)
+
+                    else:
+                        for x in range(start,end+1):
+                            filename = 'z'+str(x).zfill(3)
+                            source_location = os.path.join(source_base,filename)
+                            timestamp = time.time()
+
+                            # with --remove_database the sqlite database is only removed before the first zone,
+                            # like the single writer of the parallel conversion (shards are handled by shard_target)
+                            zone_args = self.args
+                            if self.target_format == 'sqlite':
+                                zone_args = argparse.Namespace(**vars(self.args))
+                                zone_args.remove_database = self.args.remove_database and x == start
+
+                            subcount = convert_from_binary_to_database(zone_args, source_location, self.target_location, self.target_format)
+                            count = count + subcount
+
+                            size = os.path.getsize(source_location)
+                            range_size = range_size + size
+                            self.report_zone(filename, subcount, time.time() - timestamp, size)
+
+                    self.report_zone(source_range, count, time.time() - range_timestamp, range_size)
 
                 else:
+                    timestamp = time.time()
                     count = convert_from_binary_to_database(self.args, self.source_location, self.target_location, self.target_format)
-                    message = self.source_location + ": " + str(count) + " stars"
-                    print(message)
-                    send_message_to_rabbitMQ(self.args,'slack',message)
+                    self.report_zone(self.source_location, count, time.time() - timestamp, os.path.getsize(self.source_location))
+
+            if self.target_format == 'sqlite-shards':
+                # the manifest maps the declination ranges to the shards in the target directory
+                directory = self.target_location.split(':')[0]
+                number_of_shards = write_manifest(directory, self.args.shard_zones, self.args.zones)
+                print("manifest of " + str(number_of_shards) + " shards written to " + directory)
+
+            if self.args.bulk_load and self.source_format in ['ascii', 'binary'] and \
+                    self.target_format in database_targets:
+                with progress.current.stage('indexes'):
+                    self.finish_bulk_load()
+
+            progress.current.finish()
 
         return count
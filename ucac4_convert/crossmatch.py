@@ -0,0 +1,289 @@
+import os
+import csv
+import numpy as np
+
+from ucac4_convert.decoder import read_binary_zone, decode_columns, stars_from_columns, select_columns
+from ucac4_convert.query import zone_height, number_of_zones, angular_distances, open_query_connection
+from ucac4_convert.epoch import propagate, dec_to_zones, max_proper_motion, catalog_epoch
+from ucac4_convert.shards import read_manifest
+from ucac4_convert import cache
+
+# The cross-match finds the nearest catalog star for every position of a list, with one pass over the catalog:
+# the positions are sorted on declination, and every zone of the catalog (sorted on ra) is read once and merged
+# with the positions that can have a match in that zone. The candidates of a position are the stars in its
+# ra window (found with a binary search), which are then checked with their exact angular distance.
+
+# the maximum number of candidate pairs that is checked at once, this limits the memory of dense zones
+max_pairs = 5000000
+
+
+def read_positions(source):
+    """
+    read the positions to cross-match, from a csv file (with the columns ra and dec in degrees, or the first
+    two columns when there is no header) or a numpy .npy file (an array of (ra, dec) rows, or with ra and dec fields)
+    :param source: 'csv::positions.csv' or 'npy::positions.npy'
+    :return: (ra, dec) numpy arrays
+    """
+    source_format, location = source.split('::')
+
+    if source_format == 'npy':
+        positions = np.load(location)
+        if positions.dtype.names:
+            return positions['ra'].astype(np.float64), positions['dec'].astype(np.float64)
+        return positions[:, 0].astype(np.float64), positions[:, 1].astype(np.float64)
+
+    if source_format != 'csv':
+        raise Exception("crossmatch positions can be 'csv::file' or 'npy::file', not '" + source_format + "'")
+
+    with open(location) as f:
+        header = next(csv.reader(f))
+
+    names = [name.strip().lower() for name in header]
+    if 'ra' in names and 'dec' in names:
+        usecols, skiprows = (names.index('ra'), names.index('dec')), 1
+    else:
+        usecols, skiprows = (0, 1), 0
+
+    positions = np.loadtxt(location, delimiter=',', usecols=usecols, skiprows=skiprows, ndmin=2, dtype=np.float64)
+    return positions[:, 0], positions[:, 1]
+
+
+def ra_half_widths(dec, radius):
+    """
+    the half width in ra of the box around cones (see query.cone_to_box), for an array of declinations.
+    :return: the half widths in degrees, 180 for the cones that cover all ra (around the poles)
+    """
+    cos_dec = np.cos(np.radians(dec))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sin_delta = np.sin(np.radians(radius)) / cos_dec
+
+    widths = np.full(len(dec), 180.0)
+    partial = (sin_delta < 1) & (dec - radius > -90) & (dec + radius < 90)
+    widths[partial] = np.degrees(np.arcsin(sin_delta[partial]))
+    return widths
+
+
+def match_zone(ra, dec, catalog_ra, catalog_dec, radius):
+    """
+    find the catalog stars within radius of the positions, for the stars of a single zone.
+    The candidate pairs are checked in chunks of at most max_pairs (or the candidates of a single position).
+    :param ra, dec: the positions (degrees)
+    :param catalog_ra, catalog_dec: the stars of the zone, sorted on ra
+    :return: generator of (position indexes, star indexes, distances) of the pairs within radius, per chunk
+    """
+    widths = ra_half_widths(dec, radius)
+    full = widths >= 180
+
+    # the stars near ra = 0 are repeated after 360, and those near 360 before 0, for the windows that wrap around
+    margin = widths[~full].max() if (~full).any() else 0
+    before = np.flatnonzero(catalog_ra > 360 - margin)
+    after = np.flatnonzero(catalog_ra < margin)
+    extended_ra = np.concatenate([catalog_ra[before] - 360, catalog_ra, catalog_ra[after] + 360])
+    extended_index = np.concatenate([before, np.arange(len(catalog_ra)), after])
+
+    first = np.searchsorted(extended_ra, ra - widths, 'left')
+    last = np.searchsorted(extended_ra, ra + widths, 'right')
+
+    # the cones around the poles take every star of the zone once
+    first[full] = len(before)
+    last[full] = len(before) + len(catalog_ra)
+
+    counts = last - first
+    cumulative = np.cumsum(counts)
+    start = 0
+
+    while start < len(ra):
+        stop = max(int(np.searchsorted(cumulative, cumulative[start] - counts[start] + max_pairs, 'right')), start + 1)
+
+        # all candidate pairs of the chunk, as a position index and an index into the extended stars
+        chunk_counts = counts[start:stop]
+        positions = np.repeat(np.arange(start, stop), chunk_counts)
+        offsets = np.arange(chunk_counts.sum()) - np.repeat(np.cumsum(chunk_counts) - chunk_counts, chunk_counts)
+        stars = extended_index[np.repeat(first[start:stop], chunk_counts) + offsets]
+
+        distances = angular_distances(ra[positions], dec[positions], catalog_ra[stars], catalog_dec[stars])
+        within = distances <= radius
+        yield positions[within], stars[within], distances[within]
+
+        start = stop
+
+
+def zone_reader(args, catalog):
+    """
+    :param catalog: the catalog to match with, 'binary::../u4b' (a directory with the zone files z001..z900),
+                    or a converted database like 'sqlite::UCAC4.sqlite3:stars', 'sqlite-shards::../ucac4_shards:stars'
+                    or 'postgres::ucac4:stars'
+    :return: function(zone) that returns (names, ra, dec, pmrac, pmdc, stars) of the stars of a zone,
+             where stars(indexes) returns the star tuples, or None when the zone is not in the catalog.
+             The decoded zones are kept in the cache.
+    """
+    read_zone = _zone_reader(args, catalog)
+
+    def _read_cached_zone(zone):
+        key = ('zone', catalog, args.columns, zone)
+        if catalog.startswith('binary::'):
+            # a zone file that is replaced is read again
+            source_location = os.path.join(catalog.split('::')[1], 'z' + str(zone).zfill(3))
+            if not os.path.exists(source_location):
+                return None
+            key = key + (os.path.getmtime(source_location),)
+        return cache.current.cached(key, lambda: read_zone(zone))
+
+    return _read_cached_zone
+
+
+def _zone_reader(args, catalog):
+    """ the zone reader of zone_reader, without the cache """
+    catalog_format, location = catalog.split('::')
+
+    if catalog_format == 'binary':
+        columns = select_columns(args.columns)
+
+        def _read_binary_zone(zone):
+            source_location = os.path.join(location, 'z' + str(zone).zfill(3))
+            if not os.path.exists(source_location):
+                return None
+
+            records = read_binary_zone(source_location)
+            decoded = decode_columns(records, columns)
+
+            def _stars(indexes):
+                return stars_from_columns(zone, {name: column[indexes] for name, column in decoded.items()})
+
+            # copies of the proper motions, so that the (cached) zone does not keep all records in memory
+            return ['zone'] + list(decoded.keys()), decoded['ra'], decoded['dec'], \
+                records['pmrac'].copy(), records['pmdc'].copy(), _stars
+
+        return _read_binary_zone
+
+    database_name, table_name = location.split(':')
+
+    if catalog_format == 'sqlite-shards':
+        shards = {}
+        for shard in read_manifest(database_name):
+            for zone in range(shard[1], shard[2] + 1):
+                shards[zone] = os.path.join(database_name, shard[0])
+        connections = {}
+
+        def _connection(zone):
+            if zone not in shards:
+                return None
+            if shards[zone] not in connections:
+                for conn in connections.values():
+                    conn.close()
+                connections.clear()
+                connections[shards[zone]] = open_query_connection(args, 'sqlite', shards[zone])
+            return connections[shards[zone]]
+    else:
+        conn = open_query_connection(args, catalog_format, database_name)
+        _connection = lambda zone: conn
+
+    placeholder = '%s' if catalog_format == 'postgres' else '?'
+    sql = "SELECT * FROM " + table_name + " WHERE zone = " + placeholder
+
+    def _read_database_zone(zone):
+        conn = _connection(zone)
+        if conn is None:
+            return None
+
+        cursor = conn.cursor()
+        cursor.execute(sql, (zone,))
+        names = [description[0] for description in cursor.description]
+        rows = cursor.fetchall()
+        cursor.close()
+        if not rows:
+            return None
+
+        values = list(zip(*rows))
+        column = lambda name: np.array(values[names.index(name)], dtype=np.float64) if name in names else None
+        return names, column('ra'), column('dec'), column('pmrac'), column('pmdc'), \
+            lambda indexes: [rows[index] for index in indexes]
+
+    return _read_database_zone
+
+
+def crossmatch(ra, dec, radius, read_zone, epoch=None):
+    """
+    find the nearest catalog star within radius (degrees) of every position.
+    :param read_zone: function(zone) that reads the stars of a zone, see zone_reader
+    :param epoch: the epoch of the positions (like 2026.5), the stars are moved to it with their proper motions
+    :return: (names, distances, nr_of_matches, stars): the column names of the stars, and per position the distance
+             to the nearest star (nan without a match), the number of stars within radius, and the nearest star (or None)
+    """
+    number_of_positions = len(ra)
+    distances = np.full(number_of_positions, np.nan)
+    nr_of_matches = np.zeros(number_of_positions, dtype=np.int64)
+    stars = [None] * number_of_positions
+    names = None
+
+    # the stars can move into a neighbouring zone, the zones of a position are widened with the largest motion
+    margin = max_proper_motion * abs(epoch - catalog_epoch) if epoch is not None else 0
+
+    # the positions sorted on declination, so the positions of a zone are a range
+    order = np.argsort(dec, kind='stable')
+    sorted_dec = dec[order]
+    first_zone = dec_to_zones(sorted_dec[0] - radius - margin) if number_of_positions else 1
+    last_zone = dec_to_zones(sorted_dec[-1] + radius + margin) if number_of_positions else 0
+
+    for zone in range(int(first_zone), int(last_zone) + 1):
+        zone_min = -90 + (zone - 1) * zone_height
+        zone_max = zone_min + zone_height if zone < number_of_zones else 90
+        start = np.searchsorted(sorted_dec, zone_min - radius - margin, 'left')
+        stop = np.searchsorted(sorted_dec, zone_max + radius + margin, 'right')
+        if start == stop:
+            continue
+
+        zone_stars = read_zone(zone)
+        if zone_stars is None:
+            continue
+        names, catalog_ra, catalog_dec, pmrac, pmdc, read_stars = zone_stars
+
+        if epoch is not None:
+            if pmrac is None or pmdc is None:
+                raise Exception("the table has no proper motions, convert it with --columns default,pmrac,pmdc")
+            catalog_ra, catalog_dec = propagate(catalog_ra, catalog_dec, pmrac, pmdc, epoch)
+
+        # the zone files are sorted on ra, but the positions at another epoch are not
+        ra_order = np.argsort(catalog_ra, kind='stable')
+        catalog_ra, catalog_dec = catalog_ra[ra_order], catalog_dec[ra_order]
+
+        selection = order[start:stop]
+        for positions, matches, pair_distances in match_zone(ra[selection], dec[selection],
+                                                             catalog_ra, catalog_dec, radius):
+            if len(positions) == 0:
+                continue
+
+            positions = selection[positions]
+            np.add.at(nr_of_matches, positions, 1)
+
+            # the nearest star of every position in this zone, and the positions where it is nearer than before
+            nearest = np.lexsort((pair_distances, positions))
+            positions, matches, pair_distances = positions[nearest], matches[nearest], pair_distances[nearest]
+            first = np.concatenate([[True], positions[1:] != positions[:-1]])
+            positions, matches, pair_distances = positions[first], matches[first], pair_distances[first]
+
+            nearer = ~(distances[positions] <= pair_distances)
+            positions, matches = positions[nearer], matches[nearer]
+            distances[positions] = pair_distances[nearer]
+
+            for position, star in zip(positions.tolist(), read_stars(ra_order[matches])):
+                stars[position] = star
+
+    return names, distances, nr_of_matches, stars
+
+
+def write_matches(output, ra, dec, names, distances, nr_of_matches, stars):
+    """
+    write the matches as csv: the index and position of every input position, the distance (arcsec) and the number
+    of stars within the radius, followed by the columns of the nearest star (empty without a match)
+    """
+    names = names or []
+    with open(output, 'w', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(['index', 'ra', 'dec', 'distance', 'nr_of_matches'] + names)
+
+        empty = [''] * len(names)
+        for index, star in enumerate(stars):
+            distance = '' if star is None else round(float(distances[index]) * 3600, 4)
+            writer.writerow([index, ra[index], dec[index], distance, int(nr_of_matches[index])] +
+                            (empty if star is None else ['' if value is None else value for value in star]))
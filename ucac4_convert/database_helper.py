@@ -1,8 +1,13 @@
 import os
+import io
+import csv
+import sys
 import sqlite3
-import psycopg2
+from itertools import islice
 from sqlite3 import Error
 
+from ucac4_convert.decoder import star_columns, field_types
+
 zone_stats = """
 CREATE TABLE IF NOT EXISTS zones (
 	zone integer PRIMARY KEY,
@@ -16,25 +21,51 @@ create_database_schema = """
 CREATE DATABASE replace-with-database
 """
 
-create_table_schema = """
-CREATE TABLE replace-with-zone (
-	zone integer NOT NULL,
-	mpos1 integer PRIMARY KEY,
-	ucac2 text,
-	ot integer NOT NULL,
-	ra float NOT NULL,
-	dec float NOT NULL,
-    j_mag integer,
-    h_mag integer,
-    k_mag integer,
-    b_mag integer,
-    v_mag integer,
-    g_mag integer,
-    r_mag integer,
-    i_mag integer
-);
+
+def table_schema(columns, primary_key=True):
+    """
+    the CREATE TABLE statement for the selected columns of the field registry (see decoder.select_columns)
+    :param primary_key: False to leave out the primary key, for a bulk load that adds it afterwards
+    """
+    definitions = [name + " " + field_types[name] for name in columns]
+    if not primary_key:
+        definitions = [definition.replace(" PRIMARY KEY", "") for definition in definitions]
+    return "\nCREATE TABLE replace-with-zone (\n\t" + ",\n\t".join(definitions) + "\n);\n"
+
+
+def tier_table_schema(columns, without_rowid):
+    """
+    the CREATE TABLE statement of a tier table (see tiers.py): the selected columns plus the cell of every star.
+    The primary key (cell, v_mag, mpos1) clusters the stars per cell, sorted on magnitude.
+    :param without_rowid: True for sqlite, where the table is then stored in the order of its primary key
+    """
+    definitions = ["cell integer NOT NULL"] + \
+                  [name + " " + field_types[name].replace(" PRIMARY KEY", "") for name in columns] + \
+                  ["PRIMARY KEY (cell, v_mag, mpos1)"]
+    return "\nCREATE TABLE replace-with-zone (\n\t" + ",\n\t".join(definitions) + "\n)" + \
+           (" WITHOUT ROWID" if without_rowid else "") + ";\n"
+
+
+create_table_schema = table_schema(star_columns)
+
+# the spatial index that is used by cone searches: zone is a 0.2 degree band in declination, sorted on ra
+create_spatial_index_schema = """
+CREATE INDEX IF NOT EXISTS replace-with-zone_zone_ra ON replace-with-zone (zone, ra)
+"""
+
+# the index for magnitude limited selections, like all stars brighter than V=12
+create_magnitude_index_schema = """
+CREATE INDEX IF NOT EXISTS replace-with-zone_v_mag ON replace-with-zone (v_mag)
 """
 
+# The sqlite settings during a bulk load: a write-ahead log without waiting for the disk on every commit
+# (an interrupted load is resumed from the ledger), and a cache of 256 MB.
+bulk_load_pragmas = [
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'OFF'),
+    ('cache_size', -262144),
+]
+
 def open_sqlite_database(db_file, schema, remove_database):
     """ create a database connection to a SQLite database """
 
@@ -64,8 +95,18 @@ def open_sqlite_database(db_file, schema, remove_database):
     return conn
 
 
+def database_errors():
+    """
+    the exception types of the database drivers, for the functions that work on sqlite and postgres.
+    psycopg2 is only imported for postgres targets (to start faster), without it there are no postgres errors.
+    """
+    psycopg2 = sys.modules.get('psycopg2')
+    return (Error, psycopg2.Error) if psycopg2 else (Error,)
+
+
 def open_postgres_database(args, database_name, schema):
     """ create a database connection to a Postgres database """
+    import psycopg2
 
 
     conn = None
@@ -130,6 +171,101 @@ def open_postgres_database(args, database_name, schema):
     return conn
 
 
+def create_table(conn, schema):
+    """ create a table in an open database, if it does not exist yet """
+    cur = conn.cursor()
+    try:
+        cur.execute(schema)
+        conn.commit()
+    except database_errors() as e:
+        # table already exists, continue
+        # print(e)
+        pass
+
+
+def create_spatial_index(conn, table_name):
+    """ create the (zone, ra) index for cone searches, if it does not exist yet """
+    sql = create_spatial_index_schema.replace("replace-with-zone", table_name)
+    cur = conn.cursor()
+    try:
+        cur.execute(sql)
+        conn.commit()
+    except database_errors() as e:
+        # index already exists (parallel writers), continue
+        # print(e)
+        pass
+
+
+def create_indexes(conn, table_name, columns):
+    """ create the spatial index, and the magnitude index when v_mag is one of the columns """
+    create_spatial_index(conn, table_name)
+
+    if 'v_mag' in columns:
+        sql = create_magnitude_index_schema.replace("replace-with-zone", table_name)
+        cur = conn.cursor()
+        try:
+            cur.execute(sql)
+            conn.commit()
+        except database_errors() as e:
+            # index already exists, continue
+            # print(e)
+            pass
+
+
+def set_sqlite_pragmas(conn, pragmas):
+    """
+    set a list of (name, value) sqlite pragmas
+    :return: the previous values of the pragmas, to put them back afterwards
+    """
+    previous = []
+    cur = conn.cursor()
+    for name, value in pragmas:
+        previous.append((name, cur.execute("PRAGMA " + name).fetchone()[0]))
+        cur.execute("PRAGMA " + name + " = " + str(value))
+    return previous
+
+
+def find_duplicates(conn, table_name):
+    """ :return: the mpos1 values that occur more than once in a table, sorted """
+    sql = "SELECT mpos1 FROM " + table_name + " GROUP BY mpos1 HAVING count(*) > 1 ORDER BY mpos1"
+    cur = conn.cursor()
+    cur.execute(sql)
+    return [row[0] for row in cur.fetchall()]
+
+
+def add_primary_key_to_postgres(conn, table_name):
+    """
+    add the mpos1 primary key to a table that was bulk loaded without it.
+    Duplicate stars are reported, and only the first copy of every duplicate is kept.
+    :return: the number of duplicate mpos1 values
+    """
+    import psycopg2
+    duplicates = find_duplicates(conn, table_name)
+    if duplicates:
+        print(str(len(duplicates)) + " duplicate mpos1 values in " + table_name + ": " +
+              ", ".join([str(mpos1) for mpos1 in duplicates[:10]]) + (" ..." if len(duplicates) > 10 else ""))
+
+    autocommit = conn.autocommit
+    conn.autocommit = False
+
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                if duplicates:
+                    cur.execute("DELETE FROM " + table_name + " WHERE ctid IN (" +
+                                "SELECT ctid FROM (SELECT ctid, row_number() OVER (PARTITION BY mpos1 ORDER BY ctid) AS n" +
+                                " FROM " + table_name + " WHERE mpos1 = ANY(%s)) copies WHERE n > 1)", (duplicates,))
+                cur.execute("ALTER TABLE " + table_name + " ADD PRIMARY KEY (mpos1)")
+    except psycopg2.Error as e:
+        # the table already has a primary key, continue
+        # print(e)
+        pass
+    finally:
+        conn.autocommit = autocommit
+
+    return len(duplicates)
+
+
 def add_zone_to_database(conn, zone):
     sql = ''' INSERT INTO zones(zone,nr_of_stars,accumulated_sum,max_dec)
               VALUES(?,?,?,?) '''
@@ -138,26 +274,162 @@ def add_zone_to_database(conn, zone):
     conn.commit()
 
 
-def add_star_to_sqlite(conn, table_name, star):
-    base_sql = ''' INSERT INTO replace-with-zone(zone,mpos1,ucac2,ot,ra,dec,j_mag,h_mag,k_mag,b_mag,v_mag,g_mag,r_mag,i_mag)
-              VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?) '''
+def iter_batches(stars, batch_size):
+    """ split an iterable of stars into lists of at most batch_size stars """
+    iterator = iter(stars)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def add_stars_to_sqlite(conn, table_name, stars, batch_size, columns=star_columns, ledger=None):
+    """
+    insert an iterable of star tuples with executemany, one transaction per batch.
+    Stars that already exist (same mpos1) are skipped and reported per batch.
+    :param columns: the names of the columns in the star tuples
+    :param ledger: function(conn, batch) that records a batch in the ledger, in the transaction of the batch
+    :return: the number of inserted stars
+    """
+    base_sql = ''' INSERT OR IGNORE INTO replace-with-zone(replace-with-columns)
+              VALUES(replace-with-values) '''
     sql = base_sql.replace("replace-with-zone",table_name)
+    sql = sql.replace("replace-with-columns", ",".join(columns)).replace("replace-with-values", ",".join(["?"] * len(columns)))
+    count = 0
     cur = conn.cursor()
+
+    for batch in iter_batches(stars, batch_size):
+        # the connection as context manager commits the transaction at the end of the batch
+        with conn:
+            changes = conn.total_changes
+            cur.executemany(sql, batch)
+            inserted = conn.total_changes - changes
+            if ledger:
+                ledger(conn, batch)
+
+        if inserted < len(batch):
+            print(str(len(batch) - inserted) + ' stars already exist... continue')
+        count = count + inserted
+
+    return count
+
+
+def add_stars_to_postgres(conn, table_name, stars, batch_size, columns=star_columns, ledger=None):
+    """
+    insert an iterable of star tuples with execute_values, one transaction per batch.
+    Stars that already exist (same mpos1) are skipped and reported per batch.
+    :param columns: the names of the columns in the star tuples
+    :param ledger: function(conn, batch) that records a batch in the ledger, in the transaction of the batch
+    :return: the number of inserted stars
+    """
+    from psycopg2.extras import execute_values
+
+    # without a conflict target, this also works for a bulk load into a table without the primary key
+    base_sql = ''' INSERT INTO replace-with-zone(replace-with-columns)
+              VALUES %s ON CONFLICT DO NOTHING RETURNING mpos1 '''
+    sql = base_sql.replace("replace-with-zone",table_name).replace("replace-with-columns", ",".join(columns))
+    count = 0
+
+    # use explicit transactions instead of committing every statement
+    autocommit = conn.autocommit
+    conn.autocommit = False
+
     try:
-        cur.execute(sql, star)
-        conn.commit()
-    except Error as e:
-        #print(e)
-        print(str(star[1]) + ' already exists... continue')
+        for batch in iter_batches(stars, batch_size):
+            with conn:
+                with conn.cursor() as cur:
+                    inserted = len(execute_values(cur, sql, batch, page_size=len(batch), fetch=True))
+                if ledger:
+                    ledger(conn, batch)
 
+            if inserted < len(batch):
+                print(str(len(batch) - inserted) + ' stars already exist... continue')
+            count = count + inserted
+    finally:
+        conn.autocommit = autocommit
+
+    return count
+
+
+def insert_stars(conn, cur, table_name, stars, batch_size, columns=star_columns):
+    """
+    insert star tuples with a cursor of an open transaction, without committing it.
+    Stars that already exist (same mpos1) are skipped, like in the batch writers.
+    :return: the number of inserted stars
+    """
+    if isinstance(conn, sqlite3.Connection):
+        sql = "INSERT OR IGNORE INTO " + table_name + "(" + ",".join(columns) + ") VALUES(" + ",".join(["?"] * len(columns)) + ")"
+        changes = conn.total_changes
+        cur.executemany(sql, stars)
+        return conn.total_changes - changes
+
+    from psycopg2.extras import execute_values
+    sql = "INSERT INTO " + table_name + "(" + ",".join(columns) + ") VALUES %s ON CONFLICT DO NOTHING RETURNING mpos1"
+    inserted = 0
+    for batch in iter_batches(stars, batch_size):
+        inserted = inserted + len(execute_values(cur, sql, batch, page_size=len(batch), fetch=True))
+    return inserted
+
+
+class CopyStream:
+    """
+    Readonly file-like object that lets psycopg2's copy_expert read from an iterator of text chunks,
+    so that the data for COPY FROM STDIN is streamed instead of built in memory first.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = ''
+        self.offset = 0
+
+    def read(self, size=-1):
+        """
+        read from the current chunk, without copying the rest of it. copy_expert keeps reading until
+        it gets an empty string, so a read can return less than size at the end of a chunk.
+        """
+        if size < 0:
+            data = self.buffer[self.offset:] + ''.join(self.chunks)
+            self.buffer, self.offset = '', 0
+            return data
+
+        while self.offset >= len(self.buffer):
+            try:
+                self.buffer, self.offset = next(self.chunks), 0
+            except StopIteration:
+                return ''
+
+        data = self.buffer[self.offset:self.offset + size]
+        self.offset = self.offset + len(data)
+        return data
+
+
+def iter_csv_chunks_from_stars(star_batches):
+    """ convert batches of star tuples to csv text for COPY FROM STDIN, None becomes an empty field (NULL) """
+    for stars in star_batches:
+        text = io.StringIO()
+        csv.writer(text, lineterminator='\n').writerows(stars)
+        yield text.getvalue()
+
+
+def copy_stars_to_postgres(conn, table_name, csv_chunks, columns=star_columns):
+    """
+    bulk load csv text with COPY FROM STDIN in a single transaction.
+    :param columns: the names of the columns in the csv rows
+    :return: the number of copied stars
+    """
+    sql = "COPY replace-with-zone(replace-with-columns) FROM STDIN WITH (FORMAT csv)"
+    sql = sql.replace("replace-with-zone",table_name).replace("replace-with-columns", ",".join(columns))
+
+    autocommit = conn.autocommit
+    conn.autocommit = False
 
-def add_star_to_postgres(conn, table_name, star):
-    base_sql = ''' INSERT INTO replace-with-zone(zone,mpos1,ucac2,ot,ra,dec,j_mag,h_mag,k_mag,b_mag,v_mag,g_mag,r_mag,i_mag)
-              VALUES(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s) '''
-    sql = base_sql.replace("replace-with-zone",table_name)
-    cur = conn.cursor()
     try:
-        cur.execute(sql, star)
-        conn.commit()
-    except:
-        print(str(star[1]) + ' already exists... continue')
\ No newline at end of file
+        with conn:
+            with conn.cursor() as cur:
+                cur.copy_expert(sql, CopyStream(csv_chunks))
+                count = cur.rowcount
+    finally:
+        conn.autocommit = autocommit
+
+    return count
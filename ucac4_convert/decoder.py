@@ -0,0 +1,262 @@
+import numpy as np
+
+# the record size of 78 bytes per star in the binary zone files (z001..z900)
+record_size = 78
+
+# the 'no data' value for magnitudes in the binary zone files
+missing_magnitude = 20000
+
+# numpy structured dtype of a 78 byte star record, following the layout that is documented in
+# convert_from_binary_to_database. All values are little endian.
+ucac4_dtype = np.dtype([
+    ('ra', '<u4'),          # mas, right ascension at epoch J2000.0 (ICRS)
+    ('spd', '<u4'),         # mas, south pole distance epoch J2000.0 (ICRS)
+    ('magm', '<i2'),        # millimag, UCAC fit model magnitude
+    ('maga', '<i2'),        # millimag, UCAC aperture magnitude
+    ('sigmag', 'u1'),       # 1/100 mag, error of UCAC magnitude
+    ('objt', 'i1'),         # object type
+    ('cdf', 'i1'),          # combined double star flag
+    ('sigra', 'u1'),        # mas, s.e. at central epoch in RA (*cos Dec)
+    ('sigdc', 'u1'),        # mas, s.e. at central epoch in Dec
+    ('na1', 'i1'),          # total # of CCD images of this star
+    ('nu1', 'i1'),          # # of CCD images used for this star
+    ('cu1', 'i1'),          # # catalogs (epochs) used for proper motions
+    ('cepra', '<u2'),       # 0.01 yr, central epoch for mean RA, minus 1900
+    ('cepdc', '<u2'),       # 0.01 yr, central epoch for mean Dec,minus 1900
+    ('pmrac', '<i2'),       # 0.1 mas/yr, proper motion in RA*cos(Dec)
+    ('pmdc', '<i2'),        # 0.1 mas/yr, proper motion in Dec
+    ('sigpmr', 'u1'),       # 0.1 mas/yr, s.e. of pmRA * cos Dec
+    ('sigpmd', 'u1'),       # 0.1 mas/yr, s.e. of pmDec
+    ('pts_key', '<u4'),     # 2MASS unique star identifier
+    ('j_m', '<i2'),         # millimag, 2MASS J magnitude
+    ('h_m', '<i2'),         # millimag, 2MASS H magnitude
+    ('k_m', '<i2'),         # millimag, 2MASS K_s magnitude
+    ('icqflg', 'u1', (3,)), # 2MASS cc_flg*10 + ph_qual flag for J, H, K_s
+    ('e2mpho', 'u1', (3,)), # 1/100 mag, error 2MASS J, H, K_s magnitude
+    ('apasm', '<i2', (5,)), # millimag, B, V, g, r, i magnitude from APASS
+    ('apase', 'u1', (5,)),  # 1/100 mag, error of B, V, g, r, i magnitude from APASS
+    ('gcflg', 'i1'),        # Yale SPM g-flag*10  c-flag
+    ('icf', '<u4'),         # FK6-Hipparcos-Tycho source flag and catalog match flags (9 decimal digits)
+    ('leda', 'i1'),         # LEDA galaxy match flag
+    ('x2m', 'i1'),          # 2MASS extend.source flag
+    ('rnm', '<u4'),         # unique star identification number (mpos1)
+    ('zn2', '<i2'),         # zone number of UCAC2 (0 = no match)
+    ('rn2', '<u4'),         # running record number along UCAC2 zone
+])
+
+assert ucac4_dtype.itemsize == record_size
+
+def _field(name, index=None):
+    """ decoder of a raw field (or an element of a field) of the records, in its own units """
+    if index is None:
+        return lambda records: records[name]
+    return lambda records: records[name][:, index]
+
+
+def _magnitude(name, index=None):
+    """ decoder of a magnitude (millimag), where the 20000 'no data' value is masked """
+    values = _field(name, index)
+    return lambda records: np.ma.masked_equal(values(records).astype(np.int64), missing_magnitude)
+
+
+def _ucac2(records):
+    """ UCAC2 id formatted as zzz-nnnnnn, None when there is no match (000-000000) """
+    zn2 = records['zn2']
+    rn2 = records['rn2']
+    ucac2 = np.char.add(np.char.add(np.char.zfill(zn2.astype(str), 3), '-'),
+                        np.char.zfill(rn2.astype(str), 6)).astype(object)
+    ucac2[(zn2 == 0) & (rn2 == 0)] = None
+    return ucac2
+
+
+# The field registry: the columns that can be decoded from a binary record, in the order of the table.
+# Every field has its sql type (for the DDL) and a function that decodes the column from the records.
+# 'zone' is not in the record, it is the number of the zone file.
+fields = [
+    ('zone', 'integer NOT NULL', None),
+    ('mpos1', 'integer PRIMARY KEY', lambda records: records['rnm'].astype(np.int64)),
+    ('ucac2', 'text', _ucac2),
+    ('ot', 'integer NOT NULL', lambda records: records['objt'].astype(np.int64)),
+    # convert from milliarcseconds and distance from the south pole
+    ('ra', 'float NOT NULL', lambda records: records['ra'] / 3600000),
+    ('dec', 'float NOT NULL', lambda records: -90 + (records['spd'] / 3600000)),
+    ('j_mag', 'integer', _magnitude('j_m')),
+    ('h_mag', 'integer', _magnitude('h_m')),
+    ('k_mag', 'integer', _magnitude('k_m')),
+    ('b_mag', 'integer', _magnitude('apasm', 0)),
+    ('v_mag', 'integer', _magnitude('apasm', 1)),
+    ('g_mag', 'integer', _magnitude('apasm', 2)),
+    ('r_mag', 'integer', _magnitude('apasm', 3)),
+    ('i_mag', 'integer', _magnitude('apasm', 4)),
+
+    # the other fields of the record, in their original units (see ucac4_dtype)
+    ('magm', 'integer', _magnitude('magm')),
+    ('maga', 'integer', _magnitude('maga')),
+    ('sigmag', 'integer', _field('sigmag')),
+    ('cdf', 'integer', _field('cdf')),
+    ('sigra', 'integer', _field('sigra')),
+    ('sigdc', 'integer', _field('sigdc')),
+    ('na1', 'integer', _field('na1')),
+    ('nu1', 'integer', _field('nu1')),
+    ('cu1', 'integer', _field('cu1')),
+    ('cepra', 'integer', _field('cepra')),
+    ('cepdc', 'integer', _field('cepdc')),
+    ('pmrac', 'integer', _field('pmrac')),
+    ('pmdc', 'integer', _field('pmdc')),
+    ('sigpmr', 'integer', _field('sigpmr')),
+    ('sigpmd', 'integer', _field('sigpmd')),
+    ('pts_key', 'bigint', _field('pts_key')),
+    ('icqflg_j', 'integer', _field('icqflg', 0)),
+    ('icqflg_h', 'integer', _field('icqflg', 1)),
+    ('icqflg_k', 'integer', _field('icqflg', 2)),
+    ('e2mpho_j', 'integer', _field('e2mpho', 0)),
+    ('e2mpho_h', 'integer', _field('e2mpho', 1)),
+    ('e2mpho_k', 'integer', _field('e2mpho', 2)),
+    ('apase_b', 'integer', _field('apase', 0)),
+    ('apase_v', 'integer', _field('apase', 1)),
+    ('apase_g', 'integer', _field('apase', 2)),
+    ('apase_r', 'integer', _field('apase', 3)),
+    ('apase_i', 'integer', _field('apase', 4)),
+    ('gcflg', 'integer', _field('gcflg')),
+    ('icf', 'integer', _field('icf')),
+    ('leda', 'integer', _field('leda')),
+    ('x2m', 'integer', _field('x2m')),
+]
+
+field_names = [name for name, sql_type, decode in fields]
+field_types = {name: sql_type for name, sql_type, decode in fields}
+field_decoders = {name: decode for name, sql_type, decode in fields}
+
+# the columns of the 'stars' table, in the order of a star tuple (--columns default)
+star_columns = field_names[:14]
+
+# the columns that are always converted: the primary key and the columns of the spatial index
+required_columns = ['zone', 'mpos1', 'ra', 'dec']
+
+
+def select_columns(selection):
+    """
+    the columns of a --columns selection, in the order of the field registry.
+    :param selection: 'default' (the columns of the 'stars' table), 'all', or a comma separated list of
+                      field names that can include 'default', like 'default,pmrac,pmdc'.
+                      zone, mpos1, ra and dec are always selected.
+    """
+    if not selection or selection == 'default':
+        return star_columns
+
+    names = []
+    for name in selection.split(','):
+        name = name.strip()
+        if name == 'default':
+            names.extend(star_columns)
+        elif name == 'all':
+            names.extend(field_names)
+        elif name in field_types:
+            names.append(name)
+        else:
+            raise Exception("unknown column '" + name + "', choose from: " + ", ".join(field_names))
+
+    return [name for name in field_names if name in names or name in required_columns]
+
+
+def read_binary_zone(source_location):
+    """
+    read a whole binary zone file (z001..z900) into a numpy structured array of 78 byte records
+    """
+    return np.fromfile(source_location, dtype=ucac4_dtype)
+
+
+def iter_binary_blocks(source_location, records_per_block, start=0):
+    """
+    read a binary zone file in large sequential blocks of whole 78 byte records
+    :param start: the number of records to skip at the start of the file
+    """
+    with open(source_location, "rb") as f:
+        f.seek(start * record_size)
+        while True:
+            block = f.read(records_per_block * record_size)
+            if not block:
+                return
+            yield block
+
+
+def records_from_block(block):
+    """ view a block of raw bytes as records, without copying """
+    return np.frombuffer(block, dtype=ucac4_dtype, count=len(block) // record_size)
+
+
+def decode_columns(records, columns=star_columns):
+    """
+    convert the raw records of a zone into the selected columns, only the selected fields are decoded.
+    Positions are converted from milliarcseconds to degrees, magnitudes are returned as masked arrays
+    where the 20000 'no data' value is masked, and ucac2 is None when there is no UCAC2 match.
+
+    :param records: numpy array with ucac4_dtype
+    :param columns: the names of the columns, see select_columns
+    :return: dict with a numpy array per column (except zone), in the order of the table
+    """
+    return {name: field_decoders[name](records) for name in columns if name != 'zone'}
+
+
+def column_to_list(column):
+    """
+    convert a (masked) numpy column to a list of python values, with None for masked values
+    """
+    if np.ma.isMaskedArray(column):
+        return np.where(np.ma.getmaskarray(column), None, column.data.astype(object)).tolist()
+    return column.tolist()
+
+
+def stars_from_columns(zone, columns, start=0, stop=None):
+    """
+    build the star tuples (zone and then the decoded columns) for the rows start..stop of the decoded columns
+    """
+    lists = [column_to_list(column[start:stop]) for column in columns.values()]
+    size = len(lists[0])
+    return list(zip([zone] * size, *lists))
+
+
+def iter_star_batches(zone, columns, batch_size, start=0):
+    """
+    yield the decoded columns of a zone in batches of star tuples
+    :param start: the number of stars to skip
+    """
+    for position in range(start, len(columns['mpos1']), batch_size):
+        yield stars_from_columns(zone, columns, position, position + batch_size)
+
+
+def column_to_text(column):
+    """
+    convert a (masked) numpy column to an array of strings, with empty strings for masked values and None
+    """
+    if np.ma.isMaskedArray(column):
+        text = column.data.astype(str)
+        text[np.ma.getmaskarray(column)] = ''
+    elif column.dtype == object:
+        text = np.where(np.equal(column, None), '', column).astype(str)
+    else:
+        text = column.astype(str)
+    return text
+
+
+def csv_from_columns(zone, columns, start=0, stop=None):
+    """
+    convert the rows start..stop of the decoded columns into csv text (zone and then the decoded columns)
+    for COPY FROM STDIN. The rows are built column by column with numpy string operations,
+    without a python tuple per star. Empty fields are NULL in the csv format.
+    """
+    number_of_stars = len(columns['mpos1'][start:stop])
+    if number_of_stars == 0:
+        return ''
+
+    rows = np.full(number_of_stars, str(zone))
+    for column in columns.values():
+        rows = np.char.add(np.char.add(rows, ','), column_to_text(column[start:stop]))
+
+    return '\n'.join(rows.tolist()) + '\n'
+
+
+def iter_csv_chunks(zone, columns, batch_size):
+    """ convert the decoded columns of a zone into chunks of csv text with batch_size rows """
+    for start in range(0, len(columns['mpos1']), batch_size):
+        yield csv_from_columns(zone, columns, start, start + batch_size)
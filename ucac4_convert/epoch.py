@@ -0,0 +1,102 @@
+import numpy as np
+
+from ucac4_convert.decoder import read_binary_zone, field_decoders
+from ucac4_convert.query import zone_height, number_of_zones
+
+# The positions in the catalog are at epoch J2000.0, the proper motions move them to other epochs.
+catalog_epoch = 2000.0
+
+# the proper motions (pmrac, pmdc) are in 0.1 mas/yr
+proper_motion_unit = 0.1 / 3600000
+
+# the largest possible proper motion (degrees/yr) of the 16 bit pmrac and pmdc fields,
+# a cone search at another epoch is widened with the distance that a star can move in the meantime
+max_proper_motion = 32767 * proper_motion_unit * np.sqrt(2)
+
+# the columns of an epoch table, the zone is the zone of the position at the epoch
+epoch_columns = ['zone', 'mpos1', 'ra', 'dec']
+
+
+def propagate(ra, dec, pmrac, pmdc, epoch, reference_epoch=catalog_epoch):
+    """
+    move positions with their proper motion from the reference epoch to another epoch.
+
+    The motion is applied along the tangent plane at every star, and the result is projected back on the
+    sphere, which is also correct near the poles and across ra = 0/360. Radial velocity and parallax are not
+    in the catalog, so they are not taken into account. Works on numpy arrays (whole zones) and on scalars.
+
+    :param ra, dec: positions in degrees
+    :param pmrac, pmdc: proper motions in 0.1 mas/yr, pmrac is the motion in ra * cos(dec)
+    :param epoch: the epoch to move to, in (julian) years like 2026.5
+    :return: (ra, dec) in degrees at the epoch
+    """
+    years = epoch - reference_epoch
+    ra = np.radians(ra)
+    dec = np.radians(dec)
+    motion_ra = np.radians(np.asarray(pmrac, dtype=np.float64) * proper_motion_unit * years)
+    motion_dec = np.radians(np.asarray(pmdc, dtype=np.float64) * proper_motion_unit * years)
+
+    sin_ra, cos_ra = np.sin(ra), np.cos(ra)
+    sin_dec, cos_dec = np.sin(dec), np.cos(dec)
+
+    # the unit vector of the position, plus the motion along the east (ra) and north (dec) directions
+    x = cos_dec * cos_ra - motion_ra * sin_ra - motion_dec * sin_dec * cos_ra
+    y = cos_dec * sin_ra + motion_ra * cos_ra - motion_dec * sin_dec * sin_ra
+    z = sin_dec + motion_dec * cos_dec
+
+    ra_epoch = np.degrees(np.arctan2(y, x)) % 360
+    dec_epoch = np.degrees(np.arctan2(z, np.hypot(x, y)))
+    return ra_epoch, dec_epoch
+
+
+def dec_to_zones(dec):
+    """ the zones (1..900) that contain an array of declinations """
+    zones = np.floor((np.asarray(dec) + 90) / zone_height).astype(np.int64) + 1
+    return np.clip(zones, 1, number_of_zones)
+
+
+def epoch_stars(records, epoch):
+    """
+    the rows of an epoch table (zone, mpos1, ra, dec) for the raw records of a zone.
+    Stars near the border of a zone can move into a neighbouring zone, so the zone is recalculated.
+    """
+    ra, dec = propagate(field_decoders['ra'](records), field_decoders['dec'](records),
+                        records['pmrac'], records['pmdc'], epoch)
+    mpos1 = field_decoders['mpos1'](records)
+    return list(zip(dec_to_zones(dec).tolist(), mpos1.tolist(), ra.tolist(), dec.tolist()))
+
+
+def read_epoch_stars(source_location, epoch):
+    """ read a binary zone file and move its stars to the epoch, as rows of an epoch table """
+    return epoch_stars(read_binary_zone(source_location), epoch)
+
+
+def epoch_table_name(table_name, epoch):
+    """ the name of the precomputed epoch table of a table, like stars_j2026_5 for epoch 2026.5 """
+    return table_name + "_j" + ('%g' % epoch).replace('.', '_').replace('-', 'm')
+
+
+def stars_at_epoch(stars, names, epoch):
+    """
+    move the positions of query results to an epoch.
+    :param stars: rows with (at least) the ra, dec, pmrac and pmdc columns
+    :param names: the column names of the rows
+    :return: the rows with ra and dec at the epoch
+    """
+    if not stars:
+        return stars
+
+    if 'pmrac' not in names or 'pmdc' not in names:
+        raise Exception("the table has no proper motions, convert it with --columns default,pmrac,pmdc")
+
+    columns = list(zip(*stars))
+    ra_index = names.index('ra')
+    dec_index = names.index('dec')
+    ra, dec = propagate(np.array(columns[ra_index], dtype=np.float64),
+                        np.array(columns[dec_index], dtype=np.float64),
+                        np.array(columns[names.index('pmrac')], dtype=np.float64),
+                        np.array(columns[names.index('pmdc')], dtype=np.float64),
+                        epoch)
+    columns[ra_index] = ra.tolist()
+    columns[dec_index] = dec.tolist()
+    return list(zip(*columns))
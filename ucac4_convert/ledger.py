@@ -0,0 +1,157 @@
+import os
+import hashlib
+import sqlite3
+
+from ucac4_convert.database_helper import database_errors
+
+# The ledger records per target table which source zones are converted, so that an interrupted conversion
+# of a range of zones can be resumed. 'nr_of_stars' is the number of stars committed so far, and the
+# checksum of the source file tells whether the zone in the database still matches the file.
+# The size and the mtime (in ns) of the source file are kept with the checksum, the checksum is only calculated
+# again when one of them has changed, so that a rerun does not read all completed zones.
+ledger_schema = """
+CREATE TABLE IF NOT EXISTS conversion_ledger (
+	target_table text NOT NULL,
+	source text NOT NULL,
+	checksum text NOT NULL,
+	size bigint NOT NULL,
+	mtime bigint NOT NULL,
+	nr_of_stars integer NOT NULL,
+	completed integer NOT NULL,
+	PRIMARY KEY (target_table, source)
+);
+"""
+
+
+def file_checksum(source_location, block_size=1024 * 1024):
+    """ sha1 checksum of a source file, read in blocks """
+    checksum = hashlib.sha1()
+    with open(source_location, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+def file_fingerprint(source_location, entry=None):
+    """
+    the (checksum, size, mtime) of a source file. The checksum of the ledger entry is used when the size and
+    the mtime of the file are still those of the entry, then the file is not read.
+    :param entry: the ledger entry of the source file, or None
+    """
+    stat = os.stat(source_location)
+    if entry and entry[3] == stat.st_size and entry[4] == stat.st_mtime_ns:
+        return entry[0], stat.st_size, stat.st_mtime_ns
+    return file_checksum(source_location), stat.st_size, stat.st_mtime_ns
+
+
+def placeholder(conn):
+    """ the parameter placeholder of the database driver of this connection """
+    return '?' if isinstance(conn, sqlite3.Connection) else '%s'
+
+
+def open_ledger(conn):
+    """ create the ledger table, if it does not exist yet """
+    cur = conn.cursor()
+    try:
+        cur.execute(ledger_schema)
+        conn.commit()
+    except database_errors() as e:
+        # table already exists (parallel writers), continue
+        # print(e)
+        conn.rollback()
+
+    # a ledger of an earlier version has no size and mtime, its files get a checksum once (mtime 0 never matches)
+    if isinstance(conn, sqlite3.Connection):
+        existing = [row[1] for row in cur.execute("PRAGMA table_info(conversion_ledger)")]
+        add_column = "ALTER TABLE conversion_ledger ADD COLUMN "
+    else:
+        cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name = 'conversion_ledger'")
+        existing = [row[0] for row in cur.fetchall()]
+        add_column = "ALTER TABLE conversion_ledger ADD COLUMN IF NOT EXISTS "
+
+    for column in ['size', 'mtime']:
+        if column not in existing:
+            cur.execute(add_column + column + " bigint NOT NULL DEFAULT 0")
+    conn.commit()
+
+
+def get_ledger_entry(conn, table_name, source):
+    """
+    :return: (checksum, nr_of_stars, completed, size, mtime) of a source zone, or None when it was never converted
+    """
+    sql = "SELECT checksum, nr_of_stars, completed, size, mtime FROM conversion_ledger WHERE target_table = {0} AND source = {0}"
+    cur = conn.cursor()
+    cur.execute(sql.format(placeholder(conn)), (table_name, source))
+    entry = cur.fetchone()
+    cur.close()
+
+    if entry:
+        return entry[0], entry[1], bool(entry[2]), entry[3], entry[4]
+    return None
+
+
+def update_ledger(conn, table_name, source, fingerprint, nr_of_stars, completed, commit=True):
+    """
+    record the progress of a source zone, and commit it
+    :param fingerprint: the (checksum, size, mtime) of the source file
+    :param commit: False to leave the commit to a transaction that the caller has started
+    """
+    sql = """INSERT INTO conversion_ledger(target_table, source, checksum, size, mtime, nr_of_stars, completed)
+             VALUES({0},{0},{0},{0},{0},{0},{0})
+             ON CONFLICT (target_table, source) DO UPDATE SET
+             checksum = excluded.checksum, size = excluded.size, mtime = excluded.mtime,
+             nr_of_stars = excluded.nr_of_stars, completed = excluded.completed"""
+    checksum, size, mtime = fingerprint
+    cur = conn.cursor()
+    cur.execute(sql.format(placeholder(conn)), (table_name, source, checksum, size, mtime, nr_of_stars, int(completed)))
+    if commit:
+        conn.commit()
+
+
+def ledger_batches(table_name, source, fingerprint, committed):
+    """
+    the ledger function of the batch writers for a source zone. It records the stars of every batch in the
+    transaction of the batch, so that the ledger is never behind the committed stars after a crash.
+    :param committed: the number of stars of the zone that were committed before
+    """
+    position = [committed]
+
+    def record_batch(conn, batch):
+        position[0] = position[0] + len(batch)
+        update_ledger(conn, table_name, source, fingerprint, position[0], False, commit=False)
+
+    return record_batch
+
+
+def delete_zone(conn, table_name, zone, epoch_table=None, tier_tables=(), commit=True):
+    """
+    remove the (partially loaded) stars of a zone from the target table, and from its epoch and tier tables
+    :param epoch_table: the --epoch table of the target table, or None
+    :param tier_tables: the --tiers tables of the target table
+    :param commit: False to leave the commit to a transaction that the caller has started
+    """
+    p = placeholder(conn)
+    cur = conn.cursor()
+
+    # the stars in an epoch table can have moved to another zone, they are found by their mpos1,
+    # so they are removed before the stars of the zone in the target table
+    if epoch_table:
+        cur.execute("DELETE FROM " + epoch_table + " WHERE mpos1 IN (SELECT mpos1 FROM " + table_name +
+                    " WHERE zone = " + p + ")", (zone,))
+
+    for tier_table in tier_tables:
+        cur.execute("DELETE FROM " + tier_table + " WHERE zone = " + p, (zone,))
+
+    cur.execute("DELETE FROM " + table_name + " WHERE zone = " + p, (zone,))
+    cur.close()
+    if commit:
+        conn.commit()
+
+
+def skip_stars(star_batches, number_of_stars):
+    """ skip the first number_of_stars stars of a stream of star batches (the already committed stars) """
+    position = 0
+    for stars in star_batches:
+        if position + len(stars) > number_of_stars:
+            yield stars[max(number_of_stars - position, 0):]
+        position = position + len(stars)
@@ -1,31 +1,20 @@
-
 import argparse
-import math
-from ucac4_convert.converters import UCAC4_Converter
-
-def cone_to_box(ra, dec, radius):
-    # ra_min, ra_max, dec_min, dec_max
-    dec_min = dec - radius
-    dec_max = dec + radius
-    dec_factor = 1 / math.cos(math.radians(dec))
-
-    ra_min = ra - (radius * dec_factor)
-    ra_max = ra + (radius * dec_factor)
+import time
+from ucac4_convert import cache
 
-
-    box = [ra_min,ra_max,dec_min,dec_max]
-    return box
+# The backends of the operations (numpy, the database drivers, multiprocessing...) are imported in the branch
+# of their operation, so that the cli starts fast and an operation only loads what it uses.
 
 def main():
     parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
     parser.add_argument("--operation",
-                        default="convert",help="convert, cone_search")
+                        default="convert",help="convert, update (reload only the changed zones of a converted database), cone, box, id (a star by its UCAC4 id, or the zone of --dec), serve (answer cone, box and id queries over http from one long running process), crossmatch (the nearest star of every position in a csv or npy file), brightest (the brightest stars in a cone, from a tier table)")
     parser.add_argument("--source",
                         default="binary:../z001",
-                        help="source format:location. Source can be 'ascii','ascii_zonestats','binary'")
+                        help="source format:location. Source can be 'ascii' (the fixed width catalog like UCAC4_sample.txt, or the comma separated output of u4dump like z001.asc),'ascii_zonestats','binary'")
     parser.add_argument("--target",
                         default="mysqlite:UCAC4_sample.sqlite3",
-                        help="format:location of the output. Format can be 'sqlite' or 'postgres'. The output is either a path or a database url")
+                        help="format:location of the output. Format can be 'sqlite', 'sqlite-shards' (a directory with a sqlite file per zone or band of zones, like sqlite-shards::../ucac4_shards:stars), 'postgres', 'postgres-copy' (bulk load with COPY), 'parquet', 'arrow' or 'ucac4pack' (a directory with a file per zone, ucac4pack is a compact format for cone searches with mmap). The output is either a path or a database url")
     parser.add_argument("--host",
                         default="localhost",
                         help="database host")
@@ -57,16 +46,201 @@ def main():
                         default=False,
                         help="First remove existing database (sqlite only).",
                         action="store_true")
+    parser.add_argument("--bulk_load",
+                        default=False,
+                        help="load the stars without indexes (and without the primary key in postgres), and build them once after loading all zones. Duplicate stars are reported.",
+                        action="store_true")
+    parser.add_argument("--decoder",
+                        default="numpy",
+                        help="decoder for binary zone files. 'numpy' (decode whole zones at once) or 'struct' (record by record)")
+    parser.add_argument("--columns",
+                        default="default",
+                        help="columns to decode from binary zone files: 'default' (the 14 columns of the stars table), 'all' (every column of the field registry: zone and the 44 columns of the 53 items of a record, with zn2 and rn2 merged into ucac2, rnm as mpos1 and the 9 icf flags as a single icf column), or a comma separated list like 'default,pmrac,pmdc,sigpmr,sigpmd'")
+    parser.add_argument("--batch_size",
+                        default=10000,
+                        type=int,
+                        help="number of stars that is written to the database in a single transaction")
+    parser.add_argument("--workers",
+                        default=1,
+                        type=int,
+                        help="number of processes that convert a range of binary zones (z001..z900) in parallel")
+    parser.add_argument("--pipeline_depth",
+                        default=0,
+                        type=int,
+                        help="read, decode and write a zone in a pipeline of threads, with queues of this depth (0 = no pipeline)")
+    parser.add_argument("--ra",
+                        default=None,
+                        type=float,
+                        help="ra of the center of a cone search (degrees)")
+    parser.add_argument("--dec",
+                        default=None,
+                        type=float,
+                        help="dec of the center of a cone search (degrees)")
+    parser.add_argument("--epoch",
+                        default=None,
+                        type=float,
+                        help="epoch (like 2026.5) to move the stars to with their proper motions. convert: also write a table with the positions at this epoch (like stars_j2026_5). cone: search at this epoch (the table needs the pmrac and pmdc columns)")
+    parser.add_argument("--shard_zones",
+                        default=1,
+                        type=int,
+                        help="number of zones per sqlite file of a sqlite-shards target")
+    parser.add_argument("--zones",
+                        default=None,
+                        help="sqlite database with the 'zones' table (from an ascii_zonestats conversion), for the declination ranges in the manifest of a sqlite-shards target, and for the running numbers and declinations of the id operation")
+    parser.add_argument("--id",
+                        default=None,
+                        help="id: the UCAC4 id of a star (like 451-133336), or its running number along the whole catalog (needs --zones)")
+    parser.add_argument("--box",
+                        default=None,
+                        help="box: the box to search in as 'ra_min,ra_max,dec_min,dec_max' (degrees), ra_min > ra_max wraps around ra 0/360")
+    parser.add_argument("--tiers",
+                        default=None,
+                        help="convert: also write tables with the stars brighter than these V magnitudes, like '10,12,14' for the tables stars_v10, stars_v12 and stars_v14")
+    parser.add_argument("--limit",
+                        default=20,
+                        type=int,
+                        help="brightest: the maximum number of stars")
+    parser.add_argument("--radius",
+                        default=0.1,
+                        type=float,
+                        help="radius of a cone search or crossmatch (degrees)")
+    parser.add_argument("--output",
+                        default=None,
+                        help="crossmatch: csv file to write the matches to (default: print them)")
+    parser.add_argument("--progress_interval",
+                        default=10.0,
+                        type=float,
+                        help="seconds between two progress lines of a conversion (stars/sec, MB/sec, ETA and the time per stage)")
+    parser.add_argument("--metrics_file",
+                        default=None,
+                        help="write the metrics of a conversion to this file in the Prometheus text format, like ucac4.prom (for the textfile collector of node_exporter)")
+    parser.add_argument("--profile",
+                        default=None,
+                        help="profile the decode and write stages of a conversion with cProfile, and write the statistics to this file (like ucac4.prof)")
+    parser.add_argument("--listen",
+                        default="localhost:8040",
+                        help="serve: the address to answer the queries on, host:port or 'unix:' and the path of a unix socket (like unix:/tmp/ucac4.sock)")
+    parser.add_argument("--cache_size",
+                        default=cache.default_cache_size,
+                        type=float,
+                        help="MB of memory for the cache of the query operations (decoded zones and the results of recent cone and box searches, evicted least recently used first), 0 for no cache")
     args = args = parser.parse_args()
+    cache.start_cache(args)
 
     print("--- UCAC4 Converter (version 27 july 2022) ---")
     print("source : " + args.source)
     print("target : " + args.target)
 
-    if args.operation == 'cone':
-        box = cone_to_box(10,50,10)
-        print(box)
+    if args.operation == 'brightest':
+        # the target is a tier table of a converted database, like sqlite::UCAC4.sqlite3:stars_v12
+        from ucac4_convert.query import open_query_connection
+        from ucac4_convert.tiers import brightest_stars
+        target_format = args.target.split('::')[0]
+        database_name, table_name = args.target.split('::')[1].split(':')
+        placeholder = '?' if target_format == 'sqlite' else '%s'
+
+        conn = open_query_connection(args, target_format, database_name)
+        timestamp = time.time()
+        results = brightest_stars(conn, table_name, args.ra, args.dec, args.radius, args.limit, placeholder)
+        duration = time.time() - timestamp
+        conn.close()
+
+        for distance, star in results:
+            print(str(round(distance * 3600, 3)) + '" ' + str(star))
+        print("found " + str(len(results)) + " stars in " + str(round(duration * 1000, 1)) + " ms")
+
+    elif args.operation == 'box':
+        # the target is the converted database to search in, like sqlite::UCAC4.sqlite3:stars
+        from ucac4_convert.search import search_box
+        box = [float(value) for value in args.box.split(',')]
+
+        timestamp = time.time()
+        results = search_box(args, args.target, box)
+        duration = time.time() - timestamp
+
+        for star in results:
+            print(str(star))
+        print("found " + str(len(results)) + " stars in " + str(round(duration * 1000, 1)) + " ms")
+
+    elif args.operation == 'id':
+        # the target is the binary catalog (binary::../u4b), or a converted database with the zone files as --source
+        from ucac4_convert.zone_index import ZoneIndex, format_ucac4_id, record_offset
+        from ucac4_convert.search import search_ucac4_id
+        zone_index = ZoneIndex(args.zones)
+
+        if args.id is None:
+            # the zone of a declination
+            zone = zone_index.dec_to_zone(args.dec)
+            print("dec " + str(args.dec) + " is in zone " + str(zone))
+            nr_of_stars = zone_index.nr_of_stars[zone_index.zones == zone] if zone_index.zones is not None else []
+            if len(nr_of_stars) and nr_of_stars[0] > 0:
+                print("running numbers " + str(zone_index.running_number(zone, 1)) + ".." +
+                      str(zone_index.running_number(zone, int(nr_of_stars[0]))))
+        else:
+            try:
+                timestamp = time.time()
+                zone, number, star = search_ucac4_id(args, args.target, args.id, zone_index)
+                duration = time.time() - timestamp
+
+                position = "zone " + str(zone) + ", star " + str(number) + ", byte " + str(record_offset(number))
+                if zone_index.zones is not None:
+                    position = position + ", running number " + str(zone_index.running_number(zone, number))
+                print(format_ucac4_id(zone, number) + ": " + position)
+                print(str(star))
+                print("found " + str(0 if star is None else 1) + " stars in " + str(round(duration * 1000, 1)) + " ms")
+            except Exception as error:
+                print(error)
+
+    elif args.operation == 'serve':
+        # the target is the converted database to search in, like sqlite::UCAC4.sqlite3:stars
+        # http.server is only imported for this operation, it takes a noticeable part of the startup time
+        from ucac4_convert.server import QueryServer
+        QueryServer(args).serve_forever()
+
+    elif args.operation == 'update':
+        # the source is the (corrected) zone files, the target the converted database, like sqlite::UCAC4.sqlite3:stars
+        from ucac4_convert.update import update_catalog
+        try:
+            timestamp = time.time()
+            changed, count = update_catalog(args)
+            print("updated " + str(changed) + " zones with " + str(count) + " stars in " +
+                  str(round(time.time() - timestamp, 1)) + " seconds")
+        except Exception as error:
+            print(error)
+
+    elif args.operation == 'crossmatch':
+        # the source is the list of positions, like csv::detections.csv or npy::detections.npy,
+        # the target is the catalog: the binary zone files (binary::../u4b) or a converted database (sqlite::UCAC4.sqlite3:stars)
+        from ucac4_convert.crossmatch import read_positions, zone_reader, crossmatch, write_matches
+        ra, dec = read_positions(args.source)
+
+        timestamp = time.time()
+        names, distances, nr_of_matches, stars = crossmatch(ra, dec, args.radius, zone_reader(args, args.target), args.epoch)
+        duration = time.time() - timestamp
+
+        if args.output:
+            write_matches(args.output, ra, dec, names, distances, nr_of_matches, stars)
+        else:
+            for index, star in enumerate(stars):
+                if star is not None:
+                    print(str(index) + ': ' + str(round(distances[index] * 3600, 3)) + '" ' + str(star))
+
+        matched = len([star for star in stars if star is not None])
+        print("matched " + str(matched) + " of " + str(len(stars)) + " positions in " + str(round(duration, 2)) + " seconds")
+        cache.current.report()
+
+    elif args.operation in ['cone', 'cone_search']:
+        # the target is the converted database to search in, like sqlite::UCAC4.sqlite3:stars
+        from ucac4_convert.search import search_cone
+        timestamp = time.time()
+        results = search_cone(args, args.target, args.ra, args.dec, args.radius, args.epoch)
+        duration = time.time() - timestamp
+
+        for distance, star in results:
+            print(str(round(distance * 3600, 3)) + '" ' + str(star))
+        print("found " + str(len(results)) + " stars in " + str(round(duration * 1000, 1)) + " ms")
     else:
+        from ucac4_convert.converters import UCAC4_Converter
         try:
             converter = UCAC4_Converter(args)
             count = converter.convert()
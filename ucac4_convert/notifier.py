@@ -0,0 +1,136 @@
+import time
+import queue
+import threading
+
+
+class RabbitMQNotifier:
+    """
+    Send progress messages to a RabbitMQ fanout exchange without ever blocking the conversion.
+
+    send() only puts the message on a bounded queue, and drops it when the queue is full.
+    A background thread keeps one connection to the broker, and publishes the waiting messages as a single
+    message at most once per interval. When the broker can not be reached, the messages are dropped and
+    the connection is retried after retry_interval seconds.
+
+    Usage:
+        notifier = RabbitMQNotifier(args, 'slack')
+        notifier.send("z001: 206 stars")
+        notifier.close()
+    """
+
+    def __init__(self, args, exchange, queue_size=100, interval=1.0, retry_interval=60.0):
+        """
+        Constructor.
+        :param args: the parameters with rabbit_host, rabbit_port, rabbit_user and rabbit_password
+        :param exchange: the fanout exchange to publish to
+        :param queue_size: the maximum number of waiting messages, more messages are dropped
+        :param interval: the minimum time between two publishes (seconds)
+        :param retry_interval: the time to wait after a failed connection before connecting again (seconds)
+        """
+        self.args = args
+        self.exchange = exchange
+        self.interval = interval
+        self.retry_interval = retry_interval
+
+        self.messages = queue.Queue(queue_size)
+        self.stop = threading.Event()
+        self.connection = None
+        self.channel = None
+        self.retry_at = 0
+
+        # the number of messages that were published, dropped because the queue was full, or failed to publish
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+
+        # only send messages if all parameters are given, otherwise just ignore them
+        self.enabled = bool(args.rabbit_host and args.rabbit_password)
+        self.thread = None
+        if self.enabled:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def send(self, message):
+        """ queue a message for the background thread, this never blocks """
+        if not self.enabled:
+            return
+
+        try:
+            self.messages.put_nowait(message)
+        except queue.Full:
+            self.dropped = self.dropped + 1
+
+    def _connect(self):
+        # pika is only imported when messages are sent, so that the conversions without RabbitMQ start faster
+        import pika
+        credentials = pika.PlainCredentials(self.args.rabbit_user, self.args.rabbit_password)
+        parameters = pika.ConnectionParameters(self.args.rabbit_host, self.args.rabbit_port, '/', credentials,
+                                               connection_attempts=1, socket_timeout=5,
+                                               blocked_connection_timeout=5)
+        self.connection = pika.BlockingConnection(parameters)
+        self.channel = self.connection.channel()
+        self.channel.exchange_declare(exchange=self.exchange, exchange_type='fanout')
+
+    def _disconnect(self):
+        try:
+            if self.connection and self.connection.is_open:
+                self.connection.close()
+        except Exception:
+            pass
+        self.connection = None
+        self.channel = None
+
+    def _publish(self, batch):
+        """ publish a batch of messages as a single message, reconnect when needed """
+        if time.time() < self.retry_at:
+            self.failed = self.failed + len(batch)
+            return
+
+        try:
+            if not self.connection or not self.connection.is_open:
+                self._connect()
+            self.channel.basic_publish(exchange=self.exchange, routing_key='', body='\n'.join(batch))
+            self.sent = self.sent + len(batch)
+        except Exception:
+            # the broker can not be reached, try again later
+            self._disconnect()
+            self.retry_at = time.time() + self.retry_interval
+            self.failed = self.failed + len(batch)
+
+    def _run(self):
+        while True:
+            try:
+                batch = [self.messages.get(timeout=self.interval)]
+            except queue.Empty:
+                batch = []
+
+            # everything that is waiting goes into the same message
+            while True:
+                try:
+                    batch.append(self.messages.get_nowait())
+                except queue.Empty:
+                    break
+
+            if batch:
+                self._publish(batch)
+            elif self.connection and self.connection.is_open:
+                # keep the heartbeats of the idle connection going
+                try:
+                    self.connection.process_data_events()
+                except Exception:
+                    self._disconnect()
+
+            if self.stop.is_set() and self.messages.empty():
+                break
+
+            # rate limit: at most one publish per interval
+            if batch and not self.stop.is_set():
+                self.stop.wait(self.interval)
+
+        self._disconnect()
+
+    def close(self, timeout=5.0):
+        """ publish the waiting messages and close the connection, but wait at most timeout seconds """
+        if self.thread:
+            self.stop.set()
+            self.thread.join(timeout)
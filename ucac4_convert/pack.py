@@ -0,0 +1,366 @@
+import os
+import numpy as np
+
+from ucac4_convert.decoder import \
+    field_decoders, \
+    missing_magnitude, \
+    read_binary_zone, \
+    select_columns, \
+    stars_from_columns
+from ucac4_convert.query import zone_height, dec_to_zone, angular_distance, angular_distances, cone_to_box, box_to_ra_ranges
+from ucac4_convert.epoch import max_proper_motion, catalog_epoch, stars_at_epoch
+from ucac4_convert import cache
+
+# The ucac4pack format: a compact columnar file per zone (../ucac4_pack/z001.ucac4pack) that is read with mmap.
+#
+#   header        64 bytes, see header_dtype
+#   columns       32 bytes per column: name, numpy type, masked flag and the offset of its data in the file
+#   index         the cells of the zone (uint32) and the number of the first star of every cell (uint32, + the end)
+#   column data   every column as one contiguous array, aligned on 8 bytes
+#
+# The columns are stored as integers: ra and dec in mas (int32), magnitudes in millimag (int16) with the
+# 20000 'no data' value, ucac2 as zone * 1000000 + number (int32), and the other fields in their type in the record.
+# The stars are sorted on a Morton (Z-order) curve over (ra, south pole distance), so the stars of a cell are
+# together in the file, and a cone search only touches the pages of the cells that it overlaps.
+pack_extension = '.ucac4pack'
+pack_magic = b'UCAC4PK1'
+pack_version = 1
+
+header_dtype = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u2'),
+    ('zone', '<u2'),
+    ('curve_level', 'u1'),      # bits per axis of the Morton curve that the stars are sorted on
+    ('index_level', 'u1'),      # bits per axis of the cells of the index
+    ('reserved', 'V2'),
+    ('nr_of_stars', '<u4'),
+    ('nr_of_columns', '<u4'),
+    ('nr_of_cells', '<u4'),
+    ('index_offset', '<u8'),
+    ('padding', 'V28'),
+])
+
+column_dtype = np.dtype([
+    ('name', 'S16'),
+    ('dtype', 'S4'),
+    ('masked', 'u1'),           # 1 for magnitudes, where 20000 is 'no data'
+    ('reserved', 'V3'),
+    ('offset', '<u8'),
+])
+
+assert header_dtype.itemsize == 64 and column_dtype.itemsize == 32
+
+# 2^16 steps of 20 arcsec in ra, 10 arcsec in south pole distance
+curve_level = 16
+
+# 2^12 cells of 0.088 degrees in ra, 0.044 degrees in dec
+index_level = 12
+
+mas_per_degree = 3600000
+
+
+def pack_path(target_location, filename):
+    """ the file of a zone in the target directory, like ../ucac4_pack/z001.ucac4pack """
+    return os.path.join(target_location, filename + pack_extension)
+
+
+def _spread_bits(values):
+    """ put the bits of 16 bit integers on the even bit positions of 32 bit integers """
+    values = values.astype(np.uint32) & 0x0000ffff
+    values = (values | (values << 8)) & 0x00ff00ff
+    values = (values | (values << 4)) & 0x0f0f0f0f
+    values = (values | (values << 2)) & 0x33333333
+    values = (values | (values << 1)) & 0x55555555
+    return values
+
+
+def morton_codes(ra_mas, spd_mas, level):
+    """ the Morton (Z-order) codes of positions in mas on a grid of 2^level x 2^level cells over the sky """
+    x = (np.asarray(ra_mas, dtype=np.int64) * (1 << level)) // (360 * mas_per_degree)
+    y = (np.asarray(spd_mas, dtype=np.int64) * (1 << level)) // (180 * mas_per_degree)
+    x = np.clip(x, 0, (1 << level) - 1)
+    y = np.clip(y, 0, (1 << level) - 1)
+    return _spread_bits(x) | (_spread_bits(y) << 1)
+
+
+def pack_columns(records, columns):
+    """
+    the stored (integer) arrays of the selected columns of the raw records of a zone
+    :return: list of (name, array, masked)
+    """
+    packed = []
+    for name in columns:
+        if name == 'zone':
+            continue
+        elif name == 'mpos1':
+            packed.append((name, records['rnm'].astype('<u4'), False))
+        elif name == 'ucac2':
+            packed.append((name, (records['zn2'].astype(np.int64) * 1000000 + records['rn2']).astype('<i4'), False))
+        elif name == 'ot':
+            packed.append((name, records['objt'].astype('i1'), False))
+        elif name == 'ra':
+            packed.append((name, records['ra'].astype('<i4'), False))
+        elif name == 'dec':
+            packed.append((name, (records['spd'].astype(np.int64) - 90 * mas_per_degree).astype('<i4'), False))
+        else:
+            column = field_decoders[name](records)
+            if np.ma.isMaskedArray(column):
+                # the 20000 'no data' values are kept in the data of the masked array
+                packed.append((name, column.data.astype('<i2'), True))
+            else:
+                packed.append((name, np.ascontiguousarray(column), False))
+    return packed
+
+
+def unpack_column(name, values, masked):
+    """ decode a stored column into the same values as decoder.decode_columns """
+    if name == 'ra':
+        return values / mas_per_degree
+    if name == 'dec':
+        return -90 + ((values.astype(np.int64) + 90 * mas_per_degree) / mas_per_degree)
+    if name == 'ucac2':
+        return field_decoders['ucac2']({'zn2': values // 1000000, 'rn2': values % 1000000})
+    if name in ['mpos1', 'ot']:
+        return values.astype(np.int64)
+    if masked:
+        return np.ma.masked_equal(values.astype(np.int64), missing_magnitude)
+    return np.asarray(values)
+
+
+def write_pack(path, zone, records, columns):
+    """
+    write the selected columns of the raw records of a zone into a ucac4pack file, sorted on the Morton curve
+    :return: the number of stars
+    """
+    codes = morton_codes(records['ra'], records['spd'], curve_level)
+    order = np.lexsort((records['ra'], codes))
+    records = records[order]
+
+    # the index: the first star of every (non empty) cell
+    cells = codes[order] >> (2 * (curve_level - index_level))
+    starts = np.flatnonzero(np.concatenate([[True], cells[1:] != cells[:-1]])) if len(cells) else np.array([], dtype=np.int64)
+    index_cells = cells[starts].astype('<u4')
+    index_offsets = np.concatenate([starts, [len(records)]]).astype('<u4')
+
+    packed = pack_columns(records, columns)
+
+    header = np.zeros(1, dtype=header_dtype)
+    header['magic'] = pack_magic
+    header['version'] = pack_version
+    header['zone'] = zone
+    header['curve_level'] = curve_level
+    header['index_level'] = index_level
+    header['nr_of_stars'] = len(records)
+    header['nr_of_columns'] = len(packed)
+    header['nr_of_cells'] = len(index_cells)
+    header['index_offset'] = header_dtype.itemsize + column_dtype.itemsize * len(packed)
+
+    # the column data starts after the index, every column aligned on 8 bytes
+    column_table = np.zeros(len(packed), dtype=column_dtype)
+    offset = int(header['index_offset'][0]) + index_cells.nbytes + index_offsets.nbytes
+    for i, (name, values, masked) in enumerate(packed):
+        offset = (offset + 7) // 8 * 8
+        column_table[i] = (name.encode(), values.dtype.str.encode(), masked, b'\0' * 3, offset)
+        offset = offset + values.nbytes
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(header.tobytes())
+        f.write(column_table.tobytes())
+        f.write(index_cells.tobytes())
+        f.write(index_offsets.tobytes())
+        for (name, values, masked), entry in zip(packed, column_table):
+            f.write(b'\0' * (int(entry['offset']) - f.tell()))
+            f.write(values.tobytes())
+
+    return len(records)
+
+
+class PackFile:
+    """
+    A ucac4pack file, read with mmap: only the pages of the index and of the stars that are read are loaded.
+
+    Usage:
+        pack = PackFile('../ucac4_pack/z451.ucac4pack')
+        names, stars = pack.read_box([10, 11, 0, 0.2])
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.data = np.memmap(path, dtype=np.uint8, mode='r')
+
+        self.header = np.frombuffer(self.data, dtype=header_dtype, count=1)[0]
+        if self.header['magic'] != pack_magic or self.header['version'] != pack_version:
+            raise Exception(path + " is not a ucac4pack file (version " + str(pack_version) + ")")
+
+        self.zone = int(self.header['zone'])
+        self.nr_of_stars = int(self.header['nr_of_stars'])
+        self.curve_level = int(self.header['curve_level'])
+        self.index_level = int(self.header['index_level'])
+
+        number_of_columns = int(self.header['nr_of_columns'])
+        number_of_cells = int(self.header['nr_of_cells'])
+        table = np.frombuffer(self.data, dtype=column_dtype, count=number_of_columns, offset=header_dtype.itemsize)
+
+        self.columns = {}
+        for entry in table:
+            name = entry['name'].decode()
+            dtype = np.dtype(entry['dtype'].decode())
+            values = np.frombuffer(self.data, dtype=dtype, count=self.nr_of_stars, offset=int(entry['offset']))
+            self.columns[name] = (values, bool(entry['masked']))
+
+        index_offset = int(self.header['index_offset'])
+        self.cells = np.frombuffer(self.data, dtype='<u4', count=number_of_cells, offset=index_offset)
+        self.offsets = np.frombuffer(self.data, dtype='<u4', count=number_of_cells + 1,
+                                     offset=index_offset + 4 * number_of_cells)
+
+    def names(self):
+        """ the column names of the stars, starting with zone """
+        return ['zone'] + list(self.columns.keys())
+
+    def read_rows(self, rows):
+        """ :return: the decoded columns (like decoder.decode_columns) of an array of row numbers """
+        return {name: unpack_column(name, values[rows], masked) for name, (values, masked) in self.columns.items()}
+
+    def box_rows(self, box):
+        """ the row numbers of the stars in the cells that overlap a box [ra_min, ra_max, dec_min, dec_max] """
+        cells_per_axis = 1 << self.index_level
+
+        # only the rows of cells within the declination band of the zone can have stars
+        band_min = -90 + (self.zone - 1) * zone_height
+        dec_min, dec_max = max(box[2], band_min), min(box[3], band_min + zone_height)
+        if dec_min > dec_max:
+            return np.array([], dtype=np.int64)
+        y_min, y_max = [min(int((dec + 90) * cells_per_axis / 180), cells_per_axis - 1) for dec in [dec_min, dec_max]]
+
+        rows = []
+        for ra_min, ra_max in box_to_ra_ranges(box):
+            x_min, x_max = [min(int(ra * cells_per_axis / 360), cells_per_axis - 1) for ra in [ra_min, ra_max]]
+            x, y = np.meshgrid(np.arange(x_min, x_max + 1), np.arange(y_min, y_max + 1))
+            cells = np.unique(_spread_bits(x.ravel()) | (_spread_bits(y.ravel()) << 1))
+
+            # the cells that are in the index, and the ranges of their stars
+            if len(self.cells) == 0:
+                continue
+            found = np.searchsorted(self.cells, cells)
+            found = found[(found < len(self.cells)) & (self.cells[np.minimum(found, len(self.cells) - 1)] == cells)]
+            for first, last in zip(self.offsets[found].tolist(), self.offsets[found + 1].tolist()):
+                rows.append(np.arange(first, last))
+
+        return np.unique(np.concatenate(rows)) if rows else np.array([], dtype=np.int64)
+
+    def read_stars(self, rows):
+        """ :return: the star tuples of an array of row numbers """
+        if len(rows) == 0:
+            return []
+        return stars_from_columns(self.zone, self.read_rows(rows))
+
+    def box_selection(self, box):
+        """
+        the stars in a box [ra_min, ra_max, dec_min, dec_max] (ra_min > ra_max wraps around ra = 0/360),
+        only ra and dec are decoded
+        :return: (row numbers, ra, dec)
+        """
+        rows = self.box_rows(box)
+        ra = unpack_column('ra', self.columns['ra'][0][rows], False)
+        dec = unpack_column('dec', self.columns['dec'][0][rows], False)
+
+        inside = np.zeros(len(rows), dtype=bool)
+        for ra_min, ra_max in box_to_ra_ranges(box):
+            inside |= (ra >= ra_min) & (ra <= ra_max)
+        inside &= (dec >= box[2]) & (dec <= box[3])
+
+        return rows[inside], ra[inside], dec[inside]
+
+    def read_box(self, box):
+        """ :return: (names, star tuples) of the stars in a box, see box_selection """
+        rows, ra, dec = self.box_selection(box)
+        return self.names(), self.read_stars(rows)
+
+    def read_cone(self, ra, dec, radius):
+        """
+        read the stars within radius (degrees) of ra, dec, only the stars in the cone are decoded completely
+        :return: (names, distances, star tuples)
+        """
+        rows, star_ra, star_dec = self.box_selection(cone_to_box(ra, dec, radius))
+        distances = angular_distances(ra, dec, star_ra, star_dec)
+        within = distances <= radius
+        return self.names(), distances[within].tolist(), self.read_stars(rows[within])
+
+
+def open_pack(path):
+    """
+    open a ucac4pack file, the opened files are kept in the cache (with their modification time, so that
+    a file that is written again is opened again). Only the index counts for the budget, the column
+    data is in the page cache.
+    :return: PackFile, or None when the file does not exist
+    """
+    if not os.path.exists(path):
+        return None
+
+    return cache.current.cached(('ucac4pack', path, os.path.getmtime(path)), lambda: PackFile(path),
+                                lambda pack: pack.cells.nbytes + pack.offsets.nbytes)
+
+
+def convert_from_binary_to_pack(args, source_location, target_location):
+    """
+    Convert a binary zone file to a ucac4pack file in the target directory (../ucac4_pack/z001.ucac4pack),
+    with the columns given by --columns.
+    """
+    zone = int(source_location[-3:])
+    path = pack_path(target_location, os.path.basename(source_location))
+    return write_pack(path, zone, read_binary_zone(source_location), select_columns(args.columns))
+
+
+def cone_search_pack(directory, ra, dec, radius, epoch=None):
+    """
+    cone search (see query.cone_search) in a directory of ucac4pack files, only the zones of the cone are opened
+    :return: list of (distance, star) sorted on distance
+    """
+    margin = 0
+    if epoch is not None:
+        margin = max_proper_motion * abs(epoch - catalog_epoch)
+
+    box = cone_to_box(ra, dec, radius + margin)
+    results = []
+
+    for zone in range(dec_to_zone(box[2]), dec_to_zone(box[3]) + 1):
+        pack = open_pack(pack_path(directory, 'z' + str(zone).zfill(3)))
+        if pack is None:
+            continue
+
+        if epoch is None:
+            names, distances, stars = pack.read_cone(ra, dec, radius)
+            results.extend(zip(distances, stars))
+            continue
+
+        # with an epoch the stars of the widened box are moved first
+        names, stars = pack.read_box(box)
+        stars = stars_at_epoch(stars, names, epoch)
+        ra_index = names.index('ra')
+        dec_index = names.index('dec')
+        for star in stars:
+            distance = angular_distance(ra, dec, star[ra_index], star[dec_index])
+            if distance <= radius:
+                results.append((distance, star))
+
+    results.sort(key=lambda result: result[0])
+    return results
+
+
+def box_search_pack(directory, box):
+    """
+    box search (see query.box_search) in a directory of ucac4pack files
+    :return: list of stars sorted on zone and ra
+    """
+    results = []
+    for zone in range(dec_to_zone(box[2]), dec_to_zone(box[3]) + 1):
+        pack = open_pack(pack_path(directory, 'z' + str(zone).zfill(3)))
+        if pack is None:
+            continue
+
+        names, stars = pack.read_box(box)
+        ra_index = names.index('ra')
+        results.extend(sorted(stars, key=lambda star: star[ra_index]))
+
+    return results
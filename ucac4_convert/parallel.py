@@ -0,0 +1,300 @@
+import os
+import time
+import queue
+import multiprocessing
+
+from ucac4_convert.database_helper import \
+    open_sqlite_database, \
+    add_stars_to_sqlite, \
+    create_indexes, \
+    set_sqlite_pragmas, \
+    bulk_load_pragmas, \
+    table_schema
+
+from ucac4_convert.decoder import record_size, select_columns
+from ucac4_convert.epoch import epoch_columns, read_epoch_stars
+from ucac4_convert.shards import shard_zones
+from ucac4_convert import progress
+
+from ucac4_convert.ledger import \
+    file_fingerprint, \
+    open_ledger, \
+    get_ledger_entry, \
+    update_ledger, \
+    ledger_batches, \
+    delete_zone
+
+# the queue between the decoding workers and the sqlite writer, set in every worker process by _init_worker
+star_queue = None
+
+
+# the time to wait for a message or result, before checking that the workers are still alive (seconds)
+wait_interval = 1.0
+
+
+def _init_worker(messages):
+    global star_queue
+    star_queue = messages
+
+
+def _start_pool(workers, **kwargs):
+    """
+    :return: (a pool of worker processes, the pids of its workers)
+    """
+    children = set([process.pid for process in multiprocessing.active_children()])
+    pool = multiprocessing.Pool(workers, **kwargs)
+    return pool, set([process.pid for process in multiprocessing.active_children()]) - children
+
+
+def _check_workers(pids):
+    """
+    raise when a worker of a pool has died. A worker that is killed (by the OOM killer, or SIGKILL) does not
+    report an error, the pool quietly replaces it and its task is lost, so the conversion would wait forever.
+    The workers only exit when their pool is closed.
+    """
+    dead = pids - set([process.pid for process in multiprocessing.active_children()])
+    if dead:
+        raise Exception("worker process " + ",".join([str(pid) for pid in sorted(dead)]) +
+                        " has died, its zones are lost")
+
+
+def _imap_results(pool, pids, function, tasks):
+    """ the results of pool.imap, in the order of the tasks, that raises when a worker has died """
+    results = pool.imap(function, tasks)
+    while True:
+        try:
+            yield results.next(wait_interval)
+        except StopIteration:
+            return
+        except multiprocessing.TimeoutError:
+            _check_workers(pids)
+
+
+def _convert_zone(task):
+    """
+    worker: convert a single zone directly into the database (postgres can handle parallel writers)
+    """
+    # avoid a circular import, the converters module uses this module
+    from ucac4_convert.converters import convert_from_binary_to_database
+
+    args, source_location, target_location, target_format = task
+    timestamp = time.time()
+    count = convert_from_binary_to_database(args, source_location, target_location, target_format)
+    return os.path.basename(source_location), count, time.time() - timestamp
+
+
+def _convert_shard(task):
+    """
+    worker: convert the zones of a shard of a sqlite-shards target one after the other,
+    so that every shard file has a single writer
+    :return: list of (filename, count, duration) per zone
+    """
+    args, source_locations, target_location, target_format = task
+    return [_convert_zone((args, source_location, target_location, target_format))
+            for source_location in source_locations]
+
+
+def _decode_zone(task):
+    """
+    worker: decode a single zone and put its stars in batches on the queue to the sqlite writer.
+    The stars that were already committed by an earlier (interrupted) run are skipped.
+    Every zone ends with a 'done' message (or 'failed'), so that the writer knows when a zone is complete.
+    """
+    from ucac4_convert.converters import read_binary_star_batches, read_tier_stars
+
+    args, source_location, committed = task
+    filename = os.path.basename(source_location)
+    zone = int(source_location[-3:])
+
+    try:
+        for stars in read_binary_star_batches(args, zone, source_location, committed):
+            star_queue.put(('stars', filename, stars))
+
+        if args.epoch is not None:
+            star_queue.put(('epoch', filename, read_epoch_stars(source_location, args.epoch)))
+
+        if args.tiers:
+            star_queue.put(('tiers', filename, read_tier_stars(args, zone, source_location)))
+
+        star_queue.put(('done', filename))
+
+    except Exception as error:
+        star_queue.put(('failed', filename, str(error)))
+
+
+def _next_message(messages, decoded, pids):
+    """
+    wait for the next message of the decoding workers, and raise when they stopped without sending it:
+    when a worker has died, when the decoding failed, or when all zones are decoded and no message is left
+    :param decoded: the AsyncResult of the decoding tasks
+    """
+    finished = False
+    while True:
+        try:
+            return messages.get(timeout=wait_interval)
+        except queue.Empty:
+            _check_workers(pids)
+            if decoded.ready():
+                # the error of a task that failed outside _decode_zone
+                decoded.get()
+
+                # the last messages can still be on their way when the result arrives, so wait once more
+                if finished:
+                    raise Exception("the decoding workers have finished, but not all zones are complete")
+                finished = True
+
+
+def _write_zones_to_sqlite(args, source_locations, target_location, workers):
+    """
+    decode the zones in a pool of worker processes and write them with a single writer (this process),
+    because sqlite does not allow parallel writers. The queue is bounded, so that fast decoders
+    can not run out of memory when the writer is slower.
+    The writer keeps the ledger, so completed zones are skipped and partial zones are continued.
+    """
+    # avoid a circular import, the converters module uses this module
+    from ucac4_convert.converters import derived_tables, write_tier_tables
+
+    db_table_names = target_location.split(':')
+    database_name = db_table_names[0]
+    table_name = db_table_names[1]
+    columns = select_columns(args.columns)
+    schema = table_schema(columns).replace("replace-with-zone", table_name)
+    conn = open_sqlite_database(database_name, schema, args.remove_database)
+    open_ledger(conn)
+
+    # with --bulk_load the indexes are built after loading all zones
+    pragmas = []
+    if args.bulk_load:
+        pragmas = set_sqlite_pragmas(conn, bulk_load_pragmas)
+    else:
+        create_indexes(conn, table_name, columns)
+
+    # the precomputed table with the positions at --epoch, and the tables with the brightest stars
+    epoch_table, tier_tables = derived_tables(args, conn, 'sqlite', table_name)
+    if epoch_table:
+        create_indexes(conn, epoch_table, epoch_columns)
+
+    messages = multiprocessing.Queue(maxsize=workers * 2)
+    pool, pids = _start_pool(workers, initializer=_init_worker, initargs=(messages,))
+
+    # the checksums of the files whose size or mtime differ from the ledger are calculated by the workers
+    filenames = [os.path.basename(source_location) for source_location in source_locations]
+    entries = [get_ledger_entry(conn, table_name, filename) for filename in filenames]
+    fingerprints = dict(zip(filenames, pool.starmap(file_fingerprint, zip(source_locations, entries))))
+    committed = {}
+    ledgers = {}
+    timestamps = {}
+    results = {}
+    tasks = []
+
+    for source_location, filename, entry in zip(source_locations, filenames, entries):
+        if entry and entry[0] == fingerprints[filename][0] and entry[2]:
+            # already completed, skip the zone. A copy or touch of the same file gets its new mtime in the ledger,
+            # so that the next run skips it without reading it
+            if entry[3:] != fingerprints[filename][1:]:
+                update_ledger(conn, table_name, filename, fingerprints[filename], entry[1], True)
+            results[filename] = (filename, entry[1], 0)
+            progress.current.skip(os.path.getsize(source_location))
+            continue
+
+        if entry and entry[0] == fingerprints[filename][0]:
+            # continue after the last committed batch
+            committed[filename] = entry[1]
+            progress.current.skip(entry[1] * record_size)
+        else:
+            if entry:
+                # the source file has changed since its last conversion, start over (also in the epoch and tier tables)
+                delete_zone(conn, table_name, int(filename[-3:]), epoch_table, tier_tables)
+            committed[filename] = 0
+
+        update_ledger(conn, table_name, filename, fingerprints[filename], committed[filename], False)
+        ledgers[filename] = ledger_batches(table_name, filename, fingerprints[filename], committed[filename])
+        tasks.append((args, source_location, committed[filename]))
+
+    decoded = pool.map_async(_decode_zone, tasks)
+    next_zone = 0
+    check_at = time.time() + wait_interval
+
+    try:
+        while True:
+            # report the finished zones in zone order, so that the summary is deterministic
+            while next_zone < len(filenames) and filenames[next_zone] in results:
+                yield results.pop(filenames[next_zone])
+                next_zone = next_zone + 1
+
+            if next_zone == len(filenames):
+                break
+
+            # the time that the writer waits for the decoding workers
+            with progress.current.stage('decode'):
+                message = _next_message(messages, decoded, pids)
+
+            # the other workers can keep the queue busy, while the zone of a dead worker never completes
+            if time.time() > check_at:
+                _check_workers(pids)
+                check_at = time.time() + wait_interval
+            kind, filename = message[0], message[1]
+            timestamps.setdefault(filename, time.time())
+
+            if kind == 'stars':
+                # every batch is written in a single transaction, together with its ledger row
+                with progress.current.stage('write', transaction=True):
+                    add_stars_to_sqlite(conn, table_name, message[2], args.batch_size, columns, ledgers[filename])
+                committed[filename] = committed[filename] + len(message[2])
+                progress.current.add(len(message[2]), len(message[2]) * record_size)
+
+            elif kind == 'epoch':
+                with progress.current.stage('epoch'):
+                    add_stars_to_sqlite(conn, epoch_table, message[2], args.batch_size, epoch_columns)
+
+            elif kind == 'tiers':
+                with progress.current.stage('tiers'):
+                    write_tier_tables(args, conn, 'sqlite', table_name, message[2])
+
+            elif kind == 'done':
+                update_ledger(conn, table_name, filename, fingerprints[filename], committed[filename], True)
+                results[filename] = (filename, committed[filename], time.time() - timestamps[filename])
+
+            elif kind == 'failed':
+                raise Exception(filename + ": " + message[2])
+
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+        if conn:
+            set_sqlite_pragmas(conn, pragmas)
+            conn.close()
+
+
+def convert_zones_in_parallel(args, source_locations, target_location, target_format, workers):
+    """
+    convert a range of binary zones with a pool of worker processes.
+
+    For postgres every worker decodes and writes its own zones.
+    For sqlite the workers only decode, and a single writer gets the stars through a bounded queue.
+    For sqlite-shards every worker writes the zones of its own shards.
+
+    :return: generator of (filename, count, duration) per zone, in the order of source_locations
+    """
+    if target_format == 'sqlite':
+        yield from _write_zones_to_sqlite(args, source_locations, target_location, workers)
+
+    elif target_format == 'sqlite-shards':
+        shards = {}
+        for source_location in source_locations:
+            shards.setdefault(shard_zones(int(source_location[-3:]), args.shard_zones), []).append(source_location)
+
+        tasks = [(args, shard, target_location, target_format) for shard in shards.values()]
+        pool, pids = _start_pool(workers)
+        with pool:
+            for results in _imap_results(pool, pids, _convert_shard, tasks):
+                yield from results
+
+    else:
+        tasks = [(args, source_location, target_location, target_format) for source_location in source_locations]
+        pool, pids = _start_pool(workers)
+        with pool:
+            # imap returns the results in the order of the tasks
+            yield from _imap_results(pool, pids, _convert_zone, tasks)
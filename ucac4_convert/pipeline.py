@@ -0,0 +1,241 @@
+import time
+import queue
+import threading
+
+# marks the end of the stream in the queues between the stages
+_end = object()
+
+
+class StageStats:
+    """
+    The time that a pipeline stage spends working (busy) and waiting for its neighbours.
+    The stage with the highest utilization is the bottleneck.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.busy = 0.0
+        self.cpu = 0.0
+        self.waiting = 0.0
+        self.items = 0
+        # the (start, end) of every busy period, in order
+        self.intervals = []
+
+    def add_busy(self, start, end, cpu):
+        """
+        Add a busy period of the stage.
+        :param start: perf_counter at the start of the work
+        :param end: perf_counter at the end of the work
+        :param cpu: the thread_time that the thread of the stage used for the work
+        """
+        self.busy = self.busy + end - start
+        self.cpu = self.cpu + cpu
+        self.intervals.append((start, end))
+
+    def utilization(self):
+        total = self.busy + self.waiting
+        return self.busy / total if total > 0 else 0.0
+
+
+def overlap(intervals, others):
+    """
+    The time that a stage is busy while at least one of the other stages is busy as well.
+    :param intervals: the sorted busy periods of the stage
+    :param others: the sorted busy periods of each of the other stages
+    :return: the overlapping time in seconds
+    """
+    # the union of the busy periods of the other stages
+    union = []
+    for start, end in sorted([interval for stage in others for interval in stage]):
+        if union and start <= union[-1][1]:
+            union[-1] = (union[-1][0], max(union[-1][1], end))
+        else:
+            union.append((start, end))
+
+    total = 0.0
+    index = 0
+    for start, end in intervals:
+        while index < len(union) and union[index][1] <= start:
+            index = index + 1
+        x = index
+        while x < len(union) and union[x][0] < end:
+            total = total + min(end, union[x][1]) - max(start, union[x][0])
+            x = x + 1
+    return total
+
+
+class QueueStats:
+    """ the average occupancy of a bounded queue, sampled every time that an item is put on it """
+
+    def __init__(self, name, maxsize):
+        self.name = name
+        self.maxsize = maxsize
+        self.total = 0
+        self.samples = 0
+
+    def sample(self, size):
+        self.total = self.total + size
+        self.samples = self.samples + 1
+
+    def occupancy(self):
+        return self.total / self.samples if self.samples else 0.0
+
+
+class ZonePipeline:
+    """
+    Run the conversion of a zone as a pipeline of three stages, connected by bounded queues:
+
+        reader thread  --(raw blocks)-->  decoder thread  --(decoded batches)-->  writer
+
+    The writer is the thread that iterates over the pipeline (the thread that owns the database connection).
+    The file reads and the database round trips release the GIL, so reading and writing really overlap.
+    The decoder does not: most of its time goes to building the star tuples (tolist, the object arrays of
+    the nullable fields and zip), which holds the GIL, so it takes turns with the Python part of the writer.
+    report() shows how much of the busy time of each stage overlapped with the other stages, and the cpu time
+    of each stage (a stage that waits for the GIL or for I/O is busy without using the cpu).
+
+    Usage:
+        pipeline = ZonePipeline(iter_binary_blocks(source_location, 10000), decode, depth=4)
+        for stars in pipeline:
+            add_stars_to_sqlite(conn, table_name, stars, 10000)
+        print(pipeline.report())
+    """
+
+    def __init__(self, blocks, decode, depth):
+        """
+        Constructor.
+        :param blocks: iterable with the raw blocks, this is consumed by the reader thread
+        :param decode: function that converts a raw block into a batch for the writer
+        :param depth: the maximum number of items in each queue
+        """
+        self.blocks = blocks
+        self.decode = decode
+        self.depth = depth
+
+        self.reader = StageStats('reader')
+        self.decoder = StageStats('decoder')
+        self.writer = StageStats('writer')
+        self.raw_queue = queue.Queue(depth)
+        self.decoded_queue = queue.Queue(depth)
+        self.raw_stats = QueueStats('read->decode', depth)
+        self.decoded_stats = QueueStats('decode->write', depth)
+
+        self.stop = threading.Event()
+        self.errors = []
+        self.started = None
+        self.finished = None
+
+    def _put(self, q, queue_stats, stage, item):
+        """ put an item on a queue, wait while it is full unless the pipeline is stopped """
+        timestamp = time.perf_counter()
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        stage.waiting = stage.waiting + time.perf_counter() - timestamp
+        queue_stats.sample(q.qsize())
+
+    def _get(self, q, stage):
+        """ get an item from a queue, wait while it is empty unless the pipeline is stopped """
+        timestamp = time.perf_counter()
+        item = _end
+        while not self.stop.is_set():
+            try:
+                item = q.get(timeout=0.1)
+                break
+            except queue.Empty:
+                pass
+        stage.waiting = stage.waiting + time.perf_counter() - timestamp
+        return item
+
+    def _read(self):
+        try:
+            timestamp = time.perf_counter()
+            cpu = time.thread_time()
+            for block in self.blocks:
+                self.reader.add_busy(timestamp, time.perf_counter(), time.thread_time() - cpu)
+                self.reader.items = self.reader.items + 1
+                self._put(self.raw_queue, self.raw_stats, self.reader, block)
+                if self.stop.is_set():
+                    return
+                timestamp = time.perf_counter()
+                cpu = time.thread_time()
+        except Exception as error:
+            self.errors.append(error)
+        finally:
+            self._put(self.raw_queue, self.raw_stats, self.reader, _end)
+
+    def _decode(self):
+        try:
+            while not self.stop.is_set():
+                block = self._get(self.raw_queue, self.decoder)
+                if block is _end:
+                    break
+
+                timestamp = time.perf_counter()
+                cpu = time.thread_time()
+                batch = self.decode(block)
+                self.decoder.add_busy(timestamp, time.perf_counter(), time.thread_time() - cpu)
+                self.decoder.items = self.decoder.items + 1
+
+                self._put(self.decoded_queue, self.decoded_stats, self.decoder, batch)
+        except Exception as error:
+            self.errors.append(error)
+        finally:
+            self._put(self.decoded_queue, self.decoded_stats, self.decoder, _end)
+
+    def __iter__(self):
+        self.started = time.perf_counter()
+        threads = [threading.Thread(target=self._read, daemon=True),
+                   threading.Thread(target=self._decode, daemon=True)]
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                batch = self._get(self.decoded_queue, self.writer)
+                if batch is _end:
+                    break
+
+                # the time until the next batch is asked for, is the time the writer spends on this batch
+                timestamp = time.perf_counter()
+                cpu = time.thread_time()
+                yield batch
+                self.writer.add_busy(timestamp, time.perf_counter(), time.thread_time() - cpu)
+                self.writer.items = self.writer.items + 1
+        finally:
+            # also stop the reader and decoder when the writer fails
+            self.stop.set()
+            for thread in threads:
+                thread.join()
+
+        self.finished = time.perf_counter()
+        if self.errors:
+            raise self.errors[0]
+
+    def report(self):
+        """
+        The utilization, cpu time and overlap of the stages and the average occupancy of the queues, as a single line.
+        The overlap of a stage is the part of its busy time during which another stage was busy as well,
+        and busy/wall is the total busy time of the stages divided by the time of the whole pipeline
+        (above 1.0 the stages ran at the same time).
+        """
+        stages = [self.reader, self.decoder, self.writer]
+        parts = []
+        for stage in stages:
+            others = [other.intervals for other in stages if other is not stage]
+            overlapped = overlap(stage.intervals, others) / stage.busy if stage.busy > 0 else 0.0
+            cpu = stage.cpu / stage.busy if stage.busy > 0 else 0.0
+            parts.append(stage.name + " " + str(round(stage.utilization() * 100)) + "% busy " +
+                         str(round(cpu * 100)) + "% cpu " + str(round(overlapped * 100)) + "% overlapped")
+
+        wall = (self.finished or time.perf_counter()) - self.started if self.started else 0.0
+        busy = sum([stage.busy for stage in stages])
+        ratio = busy / wall if wall > 0 else 0.0
+
+        queues = [queue_stats.name + " " + str(round(queue_stats.occupancy(), 1)) + "/" + str(queue_stats.maxsize)
+                  for queue_stats in [self.raw_stats, self.decoded_stats]]
+        return "pipeline: " + ", ".join(parts) + "; busy/wall " + str(round(ratio, 2)) + \
+            "; queues: " + ", ".join(queues)
@@ -0,0 +1,255 @@
+import os, sys
+import time
+import pstats
+import cProfile
+from contextlib import contextmanager
+
+# the upper bounds (seconds) of the buckets of the transaction latency histogram
+latency_buckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+# the stages that are profiled with --profile
+profiled_stages = ['decode', 'write']
+
+
+class Progress:
+    """
+    Instrumentation of a conversion: the number of stars and source bytes, the time per stage
+    (like decode, write and epoch), a histogram of the latency of the database transactions and the ETA.
+
+    Every interval seconds a progress line is printed (as key=value pairs) and the metrics file
+    is written in the Prometheus text format. With a profile file, the decode and write stages run
+    under cProfile, and the statistics are written at the end.
+
+    Usage:
+        progress = Progress(total_bytes, interval=10, metrics_file='ucac4.prom')
+        for stars in progress.timed('decode', star_batches):
+            with progress.stage('write', transaction=True):
+                add_stars_to_sqlite(conn, table_name, stars, batch_size)
+            progress.add(len(stars), len(stars) * record_size)
+        progress.finish()
+    """
+
+    def __init__(self, total_bytes=0, interval=None, metrics_file=None, profile_file=None):
+        """
+        Constructor.
+        :param total_bytes: the size of all source files, for the ETA (0 for unknown)
+        :param interval: seconds between two progress lines, None for no output
+        :param metrics_file: file to write the metrics to in the Prometheus text format
+        :param profile_file: file to write the cProfile statistics of the decode and write stages to
+        """
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.metrics_file = metrics_file
+        self.profile_file = profile_file
+        self.profiler = cProfile.Profile() if profile_file else None
+
+        # only the process that started the conversion reports, not the worker processes
+        self.pid = os.getpid()
+
+        self.started = time.time()
+        self.stars = 0
+        self.bytes = 0
+        self.skipped_bytes = 0
+        self.stages = {}
+        self.latency_counts = [0] * (len(latency_buckets) + 1)
+        self.latency_sum = 0.0
+
+        self.reported = self.started
+        self.reported_stars = 0
+        self.reported_bytes = 0
+
+    @contextmanager
+    def stage(self, name, transaction=False):
+        """
+        time a stage of the conversion
+        :param transaction: True when the stage is a database transaction, its latency goes into the histogram
+        """
+        profile = self.profiler is not None and name in profiled_stages
+        if profile:
+            self.profiler.enable()
+
+        timestamp = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - timestamp
+            if profile:
+                self.profiler.disable()
+
+            seconds, calls = self.stages.get(name, (0.0, 0))
+            self.stages[name] = (seconds + duration, calls + 1)
+
+            if transaction:
+                bucket = 0
+                while bucket < len(latency_buckets) and duration > latency_buckets[bucket]:
+                    bucket = bucket + 1
+                self.latency_counts[bucket] = self.latency_counts[bucket] + 1
+                self.latency_sum = self.latency_sum + duration
+
+    def timed(self, name, iterable):
+        """ iterate over a (lazy) iterable, and time the production of every item as a stage """
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def add(self, stars, size):
+        """ count the converted stars and source bytes, and report when the interval has passed """
+        self.stars = self.stars + stars
+        self.bytes = self.bytes + size
+
+        if self.interval is not None and time.time() - self.reported >= self.interval:
+            self.report()
+
+    def skip(self, size):
+        """ source bytes that do not have to be converted (like completed zones), they do not count for the ETA """
+        self.skipped_bytes = self.skipped_bytes + size
+
+    def eta(self):
+        """ the estimated number of seconds until all source bytes are converted, None when unknown """
+        remaining = self.total_bytes - self.skipped_bytes - self.bytes
+        elapsed = time.time() - self.started
+        if not self.total_bytes or self.bytes == 0 or elapsed <= 0:
+            return None
+        return max(remaining, 0) / (self.bytes / elapsed)
+
+    def report(self, final=False):
+        """
+        print a progress line, and write the metrics file
+        :param final: report the speed of the whole conversion instead of the last interval
+        """
+        if os.getpid() != self.pid:
+            return
+
+        now = time.time()
+        elapsed = now - self.started
+        if final:
+            self.reported, self.reported_stars, self.reported_bytes = self.started, 0, 0
+        interval = now - self.reported
+        values = [
+            ('elapsed', round(elapsed, 1)),
+            ('stars', self.stars),
+            ('stars_per_sec', round((self.stars - self.reported_stars) / interval) if interval > 0 else 0),
+            ('mb_per_sec', round((self.bytes - self.reported_bytes) / interval / 1000000, 2) if interval > 0 else 0),
+        ]
+
+        if self.total_bytes:
+            done = (self.bytes + self.skipped_bytes) / self.total_bytes
+            values.append(('done', str(round(done * 100, 1)) + '%'))
+        eta = self.eta()
+        if eta is not None:
+            values.append(('eta', str(round(eta)) + 's'))
+
+        # the share of every stage in the measured time
+        total = sum([seconds for seconds, calls in self.stages.values()])
+        for name, (seconds, calls) in sorted(self.stages.items()):
+            values.append((name, str(round(seconds / total * 100)) + '%' if total > 0 else '0%'))
+
+        latency = self.latency_percentile(0.95)
+        if latency is not None:
+            values.append(('transaction_p95', '<=' + str(latency) + 's'))
+
+        print("progress " + " ".join([name + "=" + str(value) for name, value in values]))
+        sys.stdout.flush()
+
+        self.reported = now
+        self.reported_stars = self.stars
+        self.reported_bytes = self.bytes
+
+        if self.metrics_file:
+            self.write_metrics()
+
+    def latency_percentile(self, fraction):
+        """ the upper bound of the histogram bucket that contains the percentile, None without transactions """
+        count = sum(self.latency_counts)
+        if count == 0:
+            return None
+
+        cumulative = 0
+        for bucket, bucket_count in enumerate(self.latency_counts):
+            cumulative = cumulative + bucket_count
+            if cumulative >= fraction * count:
+                return latency_buckets[bucket] if bucket < len(latency_buckets) else float('inf')
+
+    def metrics(self):
+        """ the metrics in the Prometheus text format """
+        elapsed = time.time() - self.started
+        lines = [
+            "# HELP ucac4_stars_total Stars converted.",
+            "# TYPE ucac4_stars_total counter",
+            "ucac4_stars_total " + str(self.stars),
+            "# HELP ucac4_source_bytes_total Bytes of the source files converted.",
+            "# TYPE ucac4_source_bytes_total counter",
+            "ucac4_source_bytes_total " + str(self.bytes),
+            "# HELP ucac4_stars_per_second Average conversion speed.",
+            "# TYPE ucac4_stars_per_second gauge",
+            "ucac4_stars_per_second " + str(round(self.stars / elapsed, 1) if elapsed > 0 else 0),
+            "# HELP ucac4_stage_seconds_total Time spent per stage of the conversion.",
+            "# TYPE ucac4_stage_seconds_total counter",
+        ]
+        for name, (seconds, calls) in sorted(self.stages.items()):
+            lines.append('ucac4_stage_seconds_total{stage="' + name + '"} ' + str(round(seconds, 6)))
+
+        lines.extend([
+            "# HELP ucac4_stage_calls_total Number of times a stage ran.",
+            "# TYPE ucac4_stage_calls_total counter",
+        ])
+        for name, (seconds, calls) in sorted(self.stages.items()):
+            lines.append('ucac4_stage_calls_total{stage="' + name + '"} ' + str(calls))
+
+        lines.extend([
+            "# HELP ucac4_transaction_seconds Latency of the database transactions (one per batch).",
+            "# TYPE ucac4_transaction_seconds histogram",
+        ])
+        cumulative = 0
+        for bound, count in zip(latency_buckets + ['+Inf'], self.latency_counts):
+            cumulative = cumulative + count
+            lines.append('ucac4_transaction_seconds_bucket{le="' + str(bound) + '"} ' + str(cumulative))
+        lines.append("ucac4_transaction_seconds_sum " + str(round(self.latency_sum, 6)))
+        lines.append("ucac4_transaction_seconds_count " + str(cumulative))
+
+        eta = self.eta()
+        if eta is not None:
+            lines.extend([
+                "# HELP ucac4_eta_seconds Estimated time until the conversion is done.",
+                "# TYPE ucac4_eta_seconds gauge",
+                "ucac4_eta_seconds " + str(round(eta, 1)),
+            ])
+
+        return "\n".join(lines) + "\n"
+
+    def write_metrics(self):
+        """ write the metrics file, via a temporary file so that a scraper never reads half a file """
+        temporary = self.metrics_file + '.tmp'
+        with open(temporary, 'w') as f:
+            f.write(self.metrics())
+        os.replace(temporary, self.metrics_file)
+
+    def finish(self):
+        """ the last report, and the profile of the decode and write stages """
+        if os.getpid() != self.pid:
+            return
+
+        if self.interval is not None or self.metrics_file:
+            self.report(final=True)
+
+        if self.profiler:
+            self.profiler.dump_stats(self.profile_file)
+            print("profile of the " + " and ".join(profiled_stages) + " stages written to " + self.profile_file)
+            pstats.Stats(self.profiler).sort_stats('cumulative').print_stats(15)
+
+
+# The instrumentation of the running conversion. Without a started conversion it measures, but reports nothing.
+# Worker processes inherit it, but only the process that started the conversion reports.
+current = Progress()
+
+
+def start_progress(args, total_bytes):
+    """ start the instrumentation of a conversion with --progress_interval, --metrics_file and --profile """
+    global current
+    current = Progress(total_bytes, args.progress_interval, args.metrics_file, args.profile)
+    return current
@@ -0,0 +1,178 @@
+import math
+import sqlite3
+import numpy as np
+
+# the catalog is divided in 900 zones of 0.2 degrees in declination, zone 1 starts at the south pole
+zone_height = 0.2
+number_of_zones = 900
+
+
+def dec_to_zone(dec):
+    """ the zone (1..900) that contains the declination """
+    zone = int((dec + 90) / zone_height) + 1
+    return min(max(zone, 1), number_of_zones)
+
+
+def angular_distance(ra1, dec1, ra2, dec2):
+    """ angular distance in degrees between two positions (haversine formula, accurate for small distances) """
+    ra1, dec1, ra2, dec2 = map(math.radians, [ra1, dec1, ra2, dec2])
+    a = math.sin((dec2 - dec1) / 2) ** 2 + math.cos(dec1) * math.cos(dec2) * math.sin((ra2 - ra1) / 2) ** 2
+    return math.degrees(2 * math.asin(min(1, math.sqrt(a))))
+
+
+def angular_distances(ra1, dec1, ra2, dec2):
+    """ angular distances in degrees between arrays of positions (see angular_distance) """
+    ra1, dec1, ra2, dec2 = np.radians(ra1), np.radians(dec1), np.radians(ra2), np.radians(dec2)
+    a = np.sin((dec2 - dec1) / 2) ** 2 + np.cos(dec1) * np.cos(dec2) * np.sin((ra2 - ra1) / 2) ** 2
+    return np.degrees(2 * np.arcsin(np.minimum(1, np.sqrt(a))))
+
+
+def cone_to_box(ra, dec, radius):
+    """
+    the box around a cone, all in degrees.
+    ra is normalized to 0..360, so ra_min > ra_max means that the box wraps around ra = 0/360.
+    When the cone contains a pole the box covers all ra.
+
+    :return: [ra_min, ra_max, dec_min, dec_max]
+    """
+    dec_min = max(dec - radius, -90)
+    dec_max = min(dec + radius, 90)
+
+    if dec_min == -90 or dec_max == 90:
+        return [0, 360, dec_min, dec_max]
+
+    # the largest ra offset of a cone is not at its center declination,
+    # but where a great circle through the pole touches the cone
+    sin_delta = math.sin(math.radians(radius)) / math.cos(math.radians(dec))
+    if sin_delta >= 1:
+        return [0, 360, dec_min, dec_max]
+
+    delta = math.degrees(math.asin(sin_delta))
+    if delta >= 180:
+        return [0, 360, dec_min, dec_max]
+
+    ra_min = (ra - delta) % 360
+    ra_max = (ra + delta) % 360
+
+    box = [ra_min,ra_max,dec_min,dec_max]
+    return box
+
+
+def box_to_ra_ranges(box):
+    """ split the ra of a box in 1 or 2 ranges that do not wrap around ra = 0/360 """
+    ra_min, ra_max = box[0], box[1]
+    if ra_min <= ra_max:
+        return [(ra_min, ra_max)]
+    return [(ra_min, 360), (0, ra_max)]
+
+
+def open_query_connection(args, target_format, database_name):
+    """ open a connection to an existing (converted) database for queries """
+    if target_format == 'sqlite':
+        return sqlite3.connect(database_name, check_same_thread=False)
+
+    # psycopg2 is only imported for postgres, so that the sqlite queries start faster
+    import psycopg2
+    return psycopg2.connect(
+        database=database_name,
+        user=args.user,
+        password=args.password,
+        host=args.host,
+        port=args.port
+    )
+
+
+def cone_search(conn, table_name, ra, dec, radius, placeholder='?', epoch=None):
+    """
+    find the stars within radius (degrees) of ra, dec.
+
+    The candidates are selected per zone and ra range, which uses the (zone, ra) index of the table.
+    Then the candidates in the corners of the box are removed by their exact angular distance.
+
+    With an epoch, the positions of the stars are moved to that epoch with their proper motions (the table needs
+    the pmrac and pmdc columns). The box is widened with the distance that the fastest star can move until then.
+
+    :param placeholder: the parameter placeholder of the database driver, '?' for sqlite, '%s' for postgres
+    :param epoch: the epoch of ra, dec (like 2026.5), None for the epoch of the table
+    :return: list of (distance, star) sorted on distance, with the star in the order of the columns of the table
+    """
+    margin = 0
+    if epoch is not None:
+        # avoid a circular import, the epoch module uses this module
+        from ucac4_convert.epoch import max_proper_motion, catalog_epoch, stars_at_epoch
+        margin = max_proper_motion * abs(epoch - catalog_epoch)
+
+    box = cone_to_box(ra, dec, radius + margin)
+    zones = list(range(dec_to_zone(box[2]), dec_to_zone(box[3]) + 1))
+
+    sql = "SELECT * FROM " + table_name + \
+          " WHERE zone IN (" + ",".join([placeholder] * len(zones)) + ")" + \
+          " AND ra BETWEEN " + placeholder + " AND " + placeholder
+
+    results = []
+    cursor = conn.cursor()
+
+    for ra_min, ra_max in box_to_ra_ranges(box):
+        cursor.execute(sql, zones + [ra_min, ra_max])
+
+        # the table can have any selection of columns (--columns)
+        names = [description[0] for description in cursor.description]
+        ra_index = names.index('ra')
+        dec_index = names.index('dec')
+
+        stars = cursor.fetchall()
+        if epoch is not None:
+            stars = stars_at_epoch(stars, names, epoch)
+
+        for star in stars:
+            distance = angular_distance(ra, dec, star[ra_index], star[dec_index])
+            if distance <= radius:
+                results.append((distance, star))
+
+    cursor.close()
+    results.sort(key=lambda result: result[0])
+    return results
+
+
+def box_search(conn, table_name, box, placeholder='?'):
+    """
+    find the stars within a box [ra_min, ra_max, dec_min, dec_max] in degrees, ra_min > ra_max wraps around ra = 0/360.
+    The candidates are selected per zone and ra range with the (zone, ra) index, like the cone search.
+
+    :param placeholder: the parameter placeholder of the database driver, '?' for sqlite, '%s' for postgres
+    :return: list of stars sorted on zone and ra
+    """
+    zones = list(range(dec_to_zone(box[2]), dec_to_zone(box[3]) + 1))
+
+    sql = "SELECT * FROM " + table_name + \
+          " WHERE zone IN (" + ",".join([placeholder] * len(zones)) + ")" + \
+          " AND ra BETWEEN " + placeholder + " AND " + placeholder + \
+          " AND dec BETWEEN " + placeholder + " AND " + placeholder
+
+    results = []
+    cursor = conn.cursor()
+
+    for ra_min, ra_max in box_to_ra_ranges(box):
+        cursor.execute(sql, zones + [ra_min, ra_max, box[2], box[3]])
+
+        names = [description[0] for description in cursor.description]
+        zone_index = names.index('zone')
+        ra_index = names.index('ra')
+        results.extend(cursor.fetchall())
+
+    cursor.close()
+    if results:
+        results.sort(key=lambda star: (star[zone_index], star[ra_index]))
+    return results
+
+
+def id_search(conn, table_name, mpos1, placeholder='?'):
+    """
+    find a star by its unique star identification number (mpos1, the primary key of the table)
+    :return: the star, or None when it is not in the table
+    """
+    cursor = conn.cursor()
+    cursor.execute("SELECT * FROM " + table_name + " WHERE mpos1 = " + placeholder, (mpos1,))
+    star = cursor.fetchone()
+    cursor.close()
+    return star
@@ -0,0 +1,261 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+import numpy as np
+
+from ucac4_convert.query import open_query_connection, cone_search, box_search, id_search
+from ucac4_convert.shards import cone_search_shards, box_search_shards, id_search_shards
+from ucac4_convert.pack import cone_search_pack, box_search_pack, open_pack, pack_path
+from ucac4_convert.zone_index import read_zone_record, read_zone_star
+from ucac4_convert.decoder import select_columns
+from ucac4_convert import cache
+
+# The cone, box and id searches of the query operations, for every target format. The results of recent searches
+# are kept in the cache, so a search that is repeated (like the same survey tile) is answered from memory.
+# The cache keys include the version of the target (see target_version), so that a long running process
+# (like the server) does not keep returning the results from before a conversion or update of the target.
+
+# the version of a postgres target takes a few queries, and that of a directory a stat of every zone file,
+# so they are checked at most once per version_interval seconds
+version_interval = 1.0
+_versions = {}
+
+
+class ConnectionPool:
+    """
+    Keeps the database connections of the searches open, so that a long running process (like the server)
+    does not connect for every search. Every thread takes its own connection from the pool, and gives it back
+    when the search is done. A connection that failed is closed instead.
+
+    Usage:
+        pool = ConnectionPool(args)
+        results = search_cone(args, 'sqlite::UCAC4.sqlite3:stars', 10.5, 41.2, 0.1, pool=pool)
+        pool.close()
+    """
+
+    def __init__(self, args):
+        """
+        Constructor.
+        :param args: the parameters with the postgres host, port, user and password
+        """
+        self.args = args
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def connection(self, target_format, database_name):
+        """ an open connection to a database, from the pool or a new one """
+        key = (target_format, database_name)
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            conn = idle.pop() if idle else None
+
+        if conn is None:
+            conn = open_query_connection(self.args, target_format, database_name)
+
+        try:
+            yield conn
+            # end the (read) transaction, so that an idle connection does not keep a snapshot open
+            conn.rollback()
+        except Exception:
+            conn.close()
+            raise
+
+        with self.lock:
+            self.idle[key].append(conn)
+
+    def close(self):
+        """ close all idle connections """
+        with self.lock:
+            for idle in self.idle.values():
+                for conn in idle:
+                    conn.close()
+            self.idle.clear()
+
+
+@contextmanager
+def _connection(args, target_format, database_name, pool):
+    """ a connection from the pool, or a new connection that is closed after the search when there is no pool """
+    if pool is not None:
+        with pool.connection(target_format, database_name) as conn:
+            yield conn
+        return
+
+    conn = open_query_connection(args, target_format, database_name)
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+def split_target(target):
+    """
+    :param target: the target to search in, like sqlite::UCAC4.sqlite3:stars, sqlite-shards::../ucac4_shards:stars
+                   or ucac4pack::../ucac4_pack (without a table)
+    :return: (target_format, database_name, table_name, placeholder)
+    """
+    target_format = target.split('::')[0]
+    database_name, table_name = (target.split('::')[1] + ':').split(':')[:2]
+    placeholder = '?' if target_format == 'sqlite' else '%s'
+    return target_format, database_name, table_name, placeholder
+
+
+def _file_version(path):
+    """ (modification time, size) of a file, or None when it does not exist """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _directory_version(location):
+    """ the number of files, their total size and the latest modification time in the directory of a location """
+    directory = location if os.path.isdir(location) else os.path.dirname(location) or '.'
+    count, size, mtime = 0, 0, 0
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            stat = entry.stat()
+            count, size, mtime = count + 1, size + stat.st_size, max(mtime, stat.st_mtime_ns)
+    return count, size, mtime
+
+
+def _postgres_version(conn, table_name):
+    """
+    the writes to a postgres table (from the statistics collector, which can lag a moment behind)
+    and the state of its zones in the ledger (which is committed with the stars of a zone by an update)
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT (SELECT n_tup_ins + n_tup_upd + n_tup_del FROM pg_stat_user_tables WHERE relname = %s), " +
+                "to_regclass('conversion_ledger') IS NOT NULL", (table_name.lower(),))
+    writes, has_ledger = cur.fetchone()
+
+    zones = None
+    if has_ledger:
+        cur.execute("SELECT count(*), sum(nr_of_stars), md5(string_agg(checksum, ',' ORDER BY source)) " +
+                    "FROM conversion_ledger WHERE target_table = %s", (table_name,))
+        zones = cur.fetchone()
+    cur.close()
+    return writes, zones
+
+
+def target_version(args, target, pool=None):
+    """
+    a value that changes when the target is converted into or updated, it is part of the cache keys of the searches.
+    sqlite: the database file and its write-ahead log, postgres: see _postgres_version,
+    ucac4pack, sqlite-shards and binary: the files in the directory (these two once per version_interval).
+    """
+    target_format, database_name, table_name, placeholder = split_target(target)
+    if target_format == 'sqlite':
+        # with a write-ahead log the commits only change the log, until it is checkpointed into the database
+        return _file_version(database_name), _file_version(database_name + '-wal')
+
+    timestamp, version = _versions.get(target, (None, None))
+    if timestamp is None or time.monotonic() - timestamp >= version_interval:
+        if target_format in ['postgres', 'postgres-copy']:
+            with _connection(args, target_format, database_name, pool) as conn:
+                version = _postgres_version(conn, table_name)
+        else:
+            version = _directory_version(database_name)
+        _versions[target] = (time.monotonic(), version)
+    return version
+
+
+def search_cone(args, target, ra, dec, radius, epoch=None, pool=None):
+    """
+    cone search (see query.cone_search) in a converted target
+    :param pool: the ConnectionPool to take the database connection from, None to connect for this search
+    :return: list of (distance, star) sorted on distance
+    """
+    target_format, database_name, table_name, placeholder = split_target(target)
+
+    def _search():
+        if target_format == 'ucac4pack':
+            # a directory with a ucac4pack file per zone, like ucac4pack::../ucac4_pack
+            return cone_search_pack(database_name, ra, dec, radius, epoch)
+        if target_format == 'sqlite-shards':
+            # only the shards of the cone are opened
+            return cone_search_shards(database_name, table_name, ra, dec, radius, epoch)
+
+        with _connection(args, target_format, database_name, pool) as conn:
+            return cone_search(conn, table_name, ra, dec, radius, placeholder, epoch)
+
+    version = target_version(args, target, pool)
+    return cache.current.cached(('cone', target, version, ra, dec, radius, epoch), _search)
+
+
+def search_box(args, target, box, pool=None):
+    """
+    box search (see query.box_search) in a converted target
+    :param box: [ra_min, ra_max, dec_min, dec_max] in degrees
+    :return: list of stars sorted on zone and ra
+    """
+    target_format, database_name, table_name, placeholder = split_target(target)
+
+    def _search():
+        if target_format == 'ucac4pack':
+            return box_search_pack(database_name, box)
+        if target_format == 'sqlite-shards':
+            # only the shards of the box are opened
+            return box_search_shards(database_name, table_name, box)
+
+        with _connection(args, target_format, database_name, pool) as conn:
+            return box_search(conn, table_name, box, placeholder)
+
+    version = target_version(args, target, pool)
+    return cache.current.cached(('box', target, version, tuple(box)), _search)
+
+
+def search_id(args, target, mpos1, pool=None):
+    """
+    find a star by its mpos1 (see query.id_search) in a converted database
+    :return: the star, or None when it is not in the target
+    """
+    target_format, database_name, table_name, placeholder = split_target(target)
+
+    def _search():
+        if target_format == 'ucac4pack':
+            raise Exception("the ucac4pack files have no index on mpos1, search a database target")
+        if target_format == 'sqlite-shards':
+            return id_search_shards(database_name, table_name, mpos1)
+
+        with _connection(args, target_format, database_name, pool) as conn:
+            return id_search(conn, table_name, mpos1, placeholder)
+
+    version = target_version(args, target, pool)
+    return cache.current.cached(('id', target, version, mpos1), _search)
+
+
+def search_ucac4_id(args, target, ucac4_id, zone_index, pool=None):
+    """
+    find a star by its UCAC4 id 'ZZZ-NNNNNN' or its running number along the catalog (see zone_index.ZoneIndex).
+    The record of the star is read at its byte offset in its zone file: in the target when that is the binary
+    catalog (binary::../u4b), otherwise in --source, and then the star is found in the target by its mpos1.
+    :param zone_index: the ZoneIndex that resolves the ids
+    :return: (zone, number in the zone, star), the star is None when it is not in the target
+    """
+    zone, number = zone_index.resolve(ucac4_id)
+    target_format, database_name, table_name, placeholder = split_target(target)
+
+    def _search():
+        if target_format == 'binary':
+            return read_zone_star(database_name, zone, number, select_columns(args.columns))
+
+        source_format, source_location = (args.source.split('::') + [''])[:2]
+        if source_format != 'binary':
+            raise Exception("an id lookup in a " + target_format + " target needs the zone files for the mpos1 " +
+                            "of the star, like --source binary::../u4b")
+        mpos1 = int(read_zone_record(source_location, zone, number)['rnm'][0])
+
+        if target_format == 'ucac4pack':
+            # only the file of the zone of the star is searched
+            pack = open_pack(pack_path(database_name, 'z' + str(zone).zfill(3)))
+            stars = pack.read_stars(np.flatnonzero(pack.columns['mpos1'][0] == mpos1)) if pack else []
+            return stars[0] if stars else None
+        if target_format == 'sqlite-shards':
+            return id_search_shards(database_name, table_name, mpos1, zone)
+        return search_id(args, target, mpos1, pool)
+
+    version = target_version(args, target, pool)
+    return zone, number, cache.current.cached(('ucac4_id', target, version, zone, number), _search)
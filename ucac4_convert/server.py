@@ -0,0 +1,198 @@
+import os
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from urllib.parse import urlparse, parse_qs
+
+from ucac4_convert.search import ConnectionPool, search_cone, search_box, search_id, search_ucac4_id
+from ucac4_convert.zone_index import ZoneIndex, format_ucac4_id
+from ucac4_convert import cache
+
+# The serve operation answers queries over HTTP, on a local port or a unix socket, from a single long running
+# process: the database connections stay open (in a pool), and the decoded zones and recent results stay in the
+# cache. Every client connection is handled by its own thread, and the connections are kept alive (HTTP/1.1).
+#
+#   GET /cone?ra=10.5&dec=41.2&radius=0.1[&epoch=2026.5]   the stars in a cone, sorted on distance (arcsec)
+#   GET /box?box=10,11,41,41.5                              the stars in a box, sorted on zone and ra
+#   GET /id?id=451-133336                                   a star by its UCAC4 id, or its running number along
+#                                                           the catalog (needs --zones), see zone_index
+#   GET /id?mpos1=102165057                                 a star by its mpos1
+#   GET /metrics                                            the requests and the cache in the Prometheus text format
+#
+# The answers are json, with the column names of the target and the time of the search in ms.
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """ the http requests of the server, see the comment at the top of this module """
+
+    protocol_version = 'HTTP/1.1'
+
+    # the headers and the body are written separately, without TCP_NODELAY every answer on a kept alive
+    # connection waits for the delayed ack of the client (40 ms)
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parameters = {name: values[-1] for name, values in parse_qs(url.query).items()}
+
+        timestamp = time.perf_counter()
+        status = 200
+        try:
+            if url.path == '/metrics':
+                body = self.server.metrics().encode()
+                content_type = 'text/plain; version=0.0.4'
+            elif url.path in self.server.queries:
+                result = self.server.queries[url.path](parameters)
+                result['ms'] = round((time.perf_counter() - timestamp) * 1000, 3)
+                body = json.dumps(result, default=str).encode()
+                content_type = 'application/json'
+            else:
+                status, body, content_type = 404, json.dumps({'error': 'unknown path ' + url.path}).encode(), 'application/json'
+
+        except (KeyError, ValueError) as error:
+            # a missing or invalid parameter
+            status = 400
+            body = json.dumps({'error': 'invalid request: ' + str(error)}).encode()
+            content_type = 'application/json'
+        except Exception as error:
+            status = 500
+            body = json.dumps({'error': str(error)}).encode()
+            content_type = 'application/json'
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+        self.server.count_request(url.path, status, time.perf_counter() - timestamp)
+
+    def address_string(self):
+        # the clients of a unix socket have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        # no line per request, the requests are counted in /metrics
+        pass
+
+
+class UnixQueryHandler(QueryHandler):
+    """ the requests on a unix socket, which has no TCP options """
+    disable_nagle_algorithm = False
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    """ an http server on a unix socket, with a thread per connection like ThreadingHTTPServer """
+    daemon_threads = True
+
+
+class QueryServer:
+    """
+    The state of the server that is shared by the request threads: the connection pool and the request counters.
+    The cache is the cache of the process (cache.current).
+
+    Usage:
+        server = QueryServer(args)
+        server.serve_forever()
+    """
+
+    def __init__(self, args):
+        """
+        Constructor.
+        :param args: the parameters with the target, the database credentials and --listen
+        """
+        self.args = args
+        self.target = args.target
+        self.pool = ConnectionPool(args)
+        self.zone_index = ZoneIndex(args.zones)
+        self.requests = {}
+        self.lock = threading.Lock()
+
+        self.queries = {
+            '/cone': self.cone,
+            '/box': self.box,
+            '/id': self.id,
+        }
+
+        if args.listen.startswith('unix:'):
+            self.address = args.listen[len('unix:'):]
+            if os.path.exists(self.address):
+                os.remove(self.address)
+            self.httpd = ThreadingUnixHTTPServer(self.address, UnixQueryHandler)
+        else:
+            host, port = args.listen.rsplit(':', 1)
+            self.address = (host, int(port))
+            self.httpd = ThreadingHTTPServer(self.address, QueryHandler)
+
+        # the handlers reach the queries and the counters through their server
+        self.httpd.queries = self.queries
+        self.httpd.metrics = self.metrics
+        self.httpd.count_request = self.count_request
+
+    def cone(self, parameters):
+        epoch = float(parameters['epoch']) if 'epoch' in parameters else None
+        radius = float(parameters.get('radius', self.args.radius))
+        results = search_cone(self.args, self.target, float(parameters['ra']), float(parameters['dec']),
+                              radius, epoch, self.pool)
+        return {'count': len(results),
+                'stars': [{'distance': round(distance * 3600, 3), 'star': star} for distance, star in results]}
+
+    def box(self, parameters):
+        box = [float(value) for value in parameters['box'].split(',')]
+        if len(box) != 4:
+            raise ValueError("box has to be ra_min,ra_max,dec_min,dec_max")
+        results = search_box(self.args, self.target, box, self.pool)
+        return {'count': len(results), 'stars': results}
+
+    def id(self, parameters):
+        if 'mpos1' in parameters:
+            star = search_id(self.args, self.target, int(parameters['mpos1']), self.pool)
+            return {'count': 0 if star is None else 1, 'star': star}
+
+        zone, number, star = search_ucac4_id(self.args, self.target, parameters['id'], self.zone_index, self.pool)
+        return {'count': 0 if star is None else 1, 'id': format_ucac4_id(zone, number), 'star': star}
+
+    def count_request(self, path, status, duration):
+        """ count a request and its duration per path and status """
+        with self.lock:
+            count, seconds = self.requests.get((path, status), (0, 0.0))
+            self.requests[(path, status)] = (count + 1, seconds + duration)
+
+    def metrics(self):
+        """ the request counters and the cache counters in the Prometheus text format """
+        lines = [
+            "# HELP ucac4_requests_total Requests answered by the server.",
+            "# TYPE ucac4_requests_total counter",
+        ]
+        with self.lock:
+            requests = sorted(self.requests.items())
+        for (path, status), (count, seconds) in requests:
+            lines.append('ucac4_requests_total{path="' + path + '",status="' + str(status) + '"} ' + str(count))
+
+        lines.extend([
+            "# HELP ucac4_request_seconds_total Time spent answering requests.",
+            "# TYPE ucac4_request_seconds_total counter",
+        ])
+        for (path, status), (count, seconds) in requests:
+            lines.append('ucac4_request_seconds_total{path="' + path + '",status="' + str(status) + '"} ' +
+                         str(round(seconds, 6)))
+
+        return "\n".join(lines) + "\n" + cache.current.metrics()
+
+    def serve_forever(self):
+        """ answer requests until the process is interrupted (ctrl-c) """
+        print("serving " + self.target + " on " + self.args.listen)
+        try:
+            self.httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        self.httpd.server_close()
+        self.pool.close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
@@ -0,0 +1,198 @@
+import os
+import argparse
+import sqlite3
+
+from ucac4_convert.query import zone_height, number_of_zones, cone_to_box, cone_search, box_search, id_search
+
+# The sqlite-shards target writes a sqlite file per zone, or per band of --shard_zones zones, into a directory:
+#
+#   ../ucac4_shards/z001.sqlite3, z002.sqlite3, ...        (--shard_zones 1)
+#   ../ucac4_shards/z001-z010.sqlite3, z011-z020.sqlite3   (--shard_zones 10)
+#
+# Every shard is a complete database with the tables of its zones, so the shards can be written in parallel.
+# The manifest in the same directory maps the declination range of every shard to its file,
+# so that a query only opens the shards that it touches.
+manifest_name = 'manifest.sqlite3'
+
+manifest_schema = """
+CREATE TABLE IF NOT EXISTS shards (
+	shard text PRIMARY KEY,
+	first_zone integer NOT NULL,
+	last_zone integer NOT NULL,
+	min_dec float NOT NULL,
+	max_dec float NOT NULL,
+	nr_of_stars integer
+);
+"""
+
+# sqlite can attach at most 10 databases to a connection (by default)
+max_attached = 10
+
+
+def shard_zones(zone, zones_per_shard):
+    """ :return: (first_zone, last_zone) of the shard that contains a zone """
+    first_zone = ((zone - 1) // zones_per_shard) * zones_per_shard + 1
+    return first_zone, min(first_zone + zones_per_shard - 1, number_of_zones)
+
+
+def shard_filename(first_zone, last_zone):
+    """ the file of a shard, like z001.sqlite3 or z001-z010.sqlite3 """
+    name = 'z' + str(first_zone).zfill(3)
+    if last_zone != first_zone:
+        name = name + '-z' + str(last_zone).zfill(3)
+    return name + '.sqlite3'
+
+
+def shard_target(args, target_location, zone):
+    """
+    the sqlite target of a zone in a sharded target, like ../ucac4_shards:stars -> ../ucac4_shards/z001.sqlite3:stars.
+    With --remove_database, a shard is only removed before its first zone is converted.
+    :return: (args, target_location) for converting the zone into a plain sqlite database
+    """
+    directory, table_name = target_location.split(':')
+    first_zone, last_zone = shard_zones(zone, args.shard_zones)
+    os.makedirs(directory, exist_ok=True)
+
+    shard_args = argparse.Namespace(**vars(args))
+    shard_args.remove_database = args.remove_database and zone == first_zone
+    return shard_args, os.path.join(directory, shard_filename(first_zone, last_zone)) + ':' + table_name
+
+
+def read_zone_stats(zones_location):
+    """
+    read the 'zones' table that is written by the ascii_zonestats conversion
+    :return: dict with (nr_of_stars, max_dec) per zone
+    """
+    conn = sqlite3.connect(zones_location)
+    rows = conn.execute("SELECT zone, nr_of_stars, max_dec FROM zones").fetchall()
+    conn.close()
+    return {zone: (nr_of_stars, max_dec) for zone, nr_of_stars, max_dec in rows}
+
+
+def write_manifest(directory, zones_per_shard, zones_location=None):
+    """
+    write the manifest of the shards that exist in the directory.
+    The declination ranges and numbers of stars come from the 'zones' table (--zones), without it the
+    declination ranges are calculated from the zone numbers and the number of stars is unknown.
+    :return: the number of shards in the manifest
+    """
+    zone_stats = read_zone_stats(zones_location) if zones_location else {}
+
+    def _max_dec(zone):
+        if zone == 0:
+            return -90.0
+        if zone in zone_stats:
+            return zone_stats[zone][1]
+        return -90 + zone * zone_height
+
+    shards = []
+    for first_zone in range(1, number_of_zones + 1, zones_per_shard):
+        first_zone, last_zone = shard_zones(first_zone, zones_per_shard)
+        shard = shard_filename(first_zone, last_zone)
+        if not os.path.exists(os.path.join(directory, shard)):
+            continue
+
+        nr_of_stars = None
+        if zone_stats:
+            nr_of_stars = sum([zone_stats.get(zone, (0, 0))[0] for zone in range(first_zone, last_zone + 1)])
+
+        shards.append((shard, first_zone, last_zone, _max_dec(first_zone - 1), _max_dec(last_zone), nr_of_stars))
+
+    conn = sqlite3.connect(os.path.join(directory, manifest_name))
+    with conn:
+        conn.execute(manifest_schema)
+        conn.execute("DELETE FROM shards")
+        conn.executemany("INSERT INTO shards VALUES (?,?,?,?,?,?)", shards)
+    conn.close()
+
+    return len(shards)
+
+
+def read_manifest(directory):
+    """ :return: list of (shard, first_zone, last_zone, min_dec, max_dec, nr_of_stars) sorted on declination """
+    conn = sqlite3.connect(os.path.join(directory, manifest_name))
+    shards = conn.execute("SELECT * FROM shards ORDER BY first_zone").fetchall()
+    conn.close()
+    return shards
+
+
+def shards_in_dec_range(directory, dec_min, dec_max):
+    """ the files of the shards that overlap a declination range """
+    return [os.path.join(directory, shard[0]) for shard in read_manifest(directory)
+            if shard[3] <= dec_max and shard[4] >= dec_min]
+
+
+def search_shards(directory, dec_min, dec_max, search):
+    """
+    run a search on every shard that overlaps a declination range.
+    The shards are attached to an in-memory database, at most max_attached at a time.
+    :param search: function (conn, schema_name) that searches one attached shard and returns a list
+    """
+    shards = shards_in_dec_range(directory, dec_min, dec_max)
+    conn = sqlite3.connect(':memory:')
+    results = []
+
+    for start in range(0, len(shards), max_attached):
+        group = shards[start:start + max_attached]
+        names = ['shard' + str(i) for i in range(len(group))]
+
+        for shard, name in zip(group, names):
+            conn.execute("ATTACH DATABASE ? AS " + name, (shard,))
+
+        for name in names:
+            results.extend(search(conn, name))
+
+        for name in names:
+            conn.execute("DETACH DATABASE " + name)
+
+    conn.close()
+    return results
+
+
+def cone_search_shards(directory, table_name, ra, dec, radius, epoch=None):
+    """
+    cone search (see query.cone_search) in a sharded target, only the shards of the cone are opened
+    :return: list of (distance, star) sorted on distance
+    """
+    # the cone search widens the box for other epochs, include the shards of that box too
+    box = cone_to_box(ra, dec, radius)
+    if epoch is not None:
+        from ucac4_convert.epoch import max_proper_motion, catalog_epoch
+        box = cone_to_box(ra, dec, radius + max_proper_motion * abs(epoch - catalog_epoch))
+
+    def _search(conn, name):
+        return cone_search(conn, name + '.' + table_name, ra, dec, radius, '?', epoch)
+
+    results = search_shards(directory, box[2], box[3], _search)
+    results.sort(key=lambda result: result[0])
+    return results
+
+
+def box_search_shards(directory, table_name, box):
+    """
+    box search (see query.box_search) in a sharded target, only the shards of the box are opened
+    :return: list of stars sorted on zone and ra (the shards are searched in zone order)
+    """
+    def _search(conn, name):
+        return box_search(conn, name + '.' + table_name, box, '?')
+
+    return search_shards(directory, box[2], box[3], _search)
+
+
+def id_search_shards(directory, table_name, mpos1, zone=None):
+    """
+    find a star by its mpos1 (see query.id_search) in a sharded target
+    :param zone: the zone of the star when it is known, then only its shard is searched instead of all shards
+    :return: the star, or None when it is not in any shard
+    """
+    def _search(conn, name):
+        star = id_search(conn, name + '.' + table_name, mpos1, '?')
+        return [star] if star else []
+
+    dec_min, dec_max = -90, 90
+    if zone is not None:
+        dec_min = -90 + (zone - 1) * zone_height
+        dec_max = dec_min + zone_height
+
+    stars = search_shards(directory, dec_min, dec_max, _search)
+    return stars[0] if stars else None
@@ -0,0 +1,88 @@
+import numpy as np
+
+from ucac4_convert.decoder import stars_from_columns
+from ucac4_convert.query import dec_to_zone, angular_distance, cone_to_box, box_to_ra_ranges
+
+# The stars of a tier table are clustered per cell: a zone (0.2 degrees in dec) and 1 degree in ra.
+# The cells of a zone are numbered consecutively in ra, so the cells of an ra range are a range of cell numbers.
+cell_width = 1.0
+cells_per_zone = 360
+
+
+def ra_to_cells(zone, ra):
+    """ the cell numbers of an array of ra (degrees) in a zone """
+    ra_cells = np.minimum(np.floor(np.asarray(ra) / cell_width).astype(np.int64), cells_per_zone - 1)
+    return (zone - 1) * cells_per_zone + ra_cells
+
+
+def parse_tiers(tiers):
+    """ the V magnitude limits of --tiers '10,12,14', sorted """
+    return sorted([float(limit) for limit in tiers.split(',')])
+
+
+def tier_table_name(table_name, limit):
+    """ the name of the tier table with the stars brighter than limit, like stars_v12 or stars_v12_5 """
+    return table_name + "_v" + ('%g' % limit).replace('.', '_')
+
+
+def tier_stars(zone, columns, limits):
+    """
+    the rows of the tier tables for the decoded columns of a zone.
+    The stars are sorted on cell and V magnitude once, every tier is the selection of that sorted zone
+    with the stars brighter than its limit. Stars without a V magnitude are in no tier.
+
+    :param limits: the V magnitude limits of the tiers
+    :return: a list with the rows (cell, zone, columns...) per limit
+    """
+    v_mag = columns['v_mag']
+    bright = ~np.ma.getmaskarray(v_mag) & (v_mag.data < max(limits) * 1000)
+    selection = np.flatnonzero(bright)
+
+    cells = ra_to_cells(zone, columns['ra'][selection])
+    magnitudes = v_mag.data[selection]
+    order = np.lexsort((columns['mpos1'][selection], magnitudes, cells))
+    selection, cells, magnitudes = selection[order], cells[order], magnitudes[order]
+
+    tiers = []
+    for limit in limits:
+        in_tier = magnitudes < limit * 1000
+        subset = {name: column[selection[in_tier]] for name, column in columns.items()}
+        stars = stars_from_columns(zone, subset)
+        tiers.append([(cell,) + star for cell, star in zip(cells[in_tier].tolist(), stars)])
+
+    return tiers
+
+
+def brightest_stars(conn, table_name, ra, dec, radius, number_of_stars, placeholder='?'):
+    """
+    find the brightest stars within radius (degrees) of ra, dec in a tier table.
+    The candidates are read per zone as a range of cells, which are clustered in the table.
+
+    :return: list of (distance, star) sorted on V magnitude, at most number_of_stars
+    """
+    box = cone_to_box(ra, dec, radius)
+    zones = range(dec_to_zone(box[2]), dec_to_zone(box[3]) + 1)
+
+    sql = "SELECT * FROM " + table_name + " WHERE cell BETWEEN " + placeholder + " AND " + placeholder
+
+    results = []
+    cursor = conn.cursor()
+
+    for zone in zones:
+        for ra_min, ra_max in box_to_ra_ranges(box):
+            first, last = ra_to_cells(zone, [ra_min, ra_max]).tolist()
+            cursor.execute(sql, (first, last))
+
+            names = [description[0] for description in cursor.description]
+            ra_index = names.index('ra')
+            dec_index = names.index('dec')
+            v_mag_index = names.index('v_mag')
+
+            for star in cursor.fetchall():
+                distance = angular_distance(ra, dec, star[ra_index], star[dec_index])
+                if distance <= radius:
+                    results.append((star[v_mag_index], distance, star))
+
+    cursor.close()
+    results.sort(key=lambda result: result[:2])
+    return [(distance, star) for v_mag, distance, star in results[:number_of_stars]]
@@ -0,0 +1,222 @@
+import os
+import time
+import multiprocessing
+
+from ucac4_convert.database_helper import \
+    open_sqlite_database, \
+    open_postgres_database, \
+    create_table, \
+    create_indexes, \
+    insert_stars, \
+    table_schema, \
+    tier_table_schema
+
+from ucac4_convert.decoder import select_columns, read_binary_zone, decode_columns, stars_from_columns
+from ucac4_convert.ledger import file_fingerprint, placeholder, open_ledger, get_ledger_entry, update_ledger, delete_zone
+from ucac4_convert.epoch import epoch_columns, epoch_table_name, epoch_stars
+from ucac4_convert.tiers import parse_tiers, tier_table_name, tier_stars
+from ucac4_convert.shards import shard_target, write_manifest
+from ucac4_convert.converters import database_targets
+from ucac4_convert import progress
+
+# The update operation compares the checksum of every source zone with the checksum in the ledger of the target,
+# (calculated only for the files whose size or mtime differ from the ledger) and only reloads the zones that have changed (or were never completely converted). The old rows of a zone are
+# replaced by the new rows in a single transaction, so a query never sees a zone half updated.
+
+
+def source_zones(source_location):
+    """ the source files of a single zone (../z001) or a range of zones (../z001..z900) """
+    if "..z" not in source_location:
+        return [source_location]
+
+    source_range = source_location[-10:]
+    source_base = source_location.replace(source_range, '')
+    return [os.path.join(source_base, 'z' + str(x).zfill(3))
+            for x in range(int(source_range[1:4]), int(source_range[7:10]) + 1)]
+
+
+def table_columns(conn, table_name):
+    """ the column names of an existing table, or None when it does not exist """
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT * FROM " + table_name + " WHERE 1 = 0")
+        return [description[0] for description in cur.description]
+    except Exception:
+        conn.rollback()
+        return None
+    finally:
+        cur.close()
+
+
+def open_update_target(args, target_format, target_location, columns):
+    """
+    open the target database of a zone, with the tables (and indexes) of a conversion with the same options
+    :return: (conn, table_name)
+    """
+    database_name, table_name = target_location.split(':')
+    schema = table_schema(columns).replace("replace-with-zone", table_name)
+
+    if target_format == 'sqlite':
+        conn = open_sqlite_database(database_name, schema, False)
+    else:
+        conn = open_postgres_database(args, database_name, schema)
+
+    existing = table_columns(conn, table_name)
+    if existing != columns:
+        conn.close()
+        raise Exception("table " + table_name + " has the columns " + ",".join(existing) +
+                        ", update it with the same --columns as its conversion")
+
+    create_indexes(conn, table_name, columns)
+    open_ledger(conn)
+
+    if args.epoch is not None:
+        epoch_table = epoch_table_name(table_name, args.epoch)
+        create_table(conn, table_schema(epoch_columns).replace("replace-with-zone", epoch_table))
+        create_indexes(conn, epoch_table, epoch_columns)
+
+    if args.tiers:
+        schema = tier_table_schema(columns, target_format == 'sqlite')
+        for limit in parse_tiers(args.tiers):
+            create_table(conn, schema.replace("replace-with-zone", tier_table_name(table_name, limit)))
+
+    return conn, table_name
+
+
+def replace_zone(args, conn, table_name, zone, source, fingerprint, columns, records):
+    """
+    replace the rows of a zone in the table (and in its epoch and tier tables) by the stars of the new
+    source file, and mark the zone as completed in the ledger, all in a single transaction.
+    :param fingerprint: the (checksum, size, mtime) of the new source file
+    :param records: the raw records of the new source file
+    :return: the number of stars of the zone
+    """
+    with progress.current.stage('decode'):
+        decoded = decode_columns(records, columns)
+        stars = stars_from_columns(zone, decoded)
+
+        if args.epoch is not None:
+            moved = epoch_stars(records, args.epoch)
+        if args.tiers:
+            tiers = tier_stars(zone, decoded, parse_tiers(args.tiers))
+
+    p = placeholder(conn)
+
+    # postgres: use an explicit transaction instead of committing every statement
+    postgres = p == '%s'
+    if postgres:
+        autocommit = conn.autocommit
+        conn.autocommit = False
+
+    try:
+        with progress.current.stage('write', transaction=True):
+            # the connection as context manager commits the transaction at the end, or rolls it back on an error
+            with conn:
+                epoch_table = epoch_table_name(table_name, args.epoch) if args.epoch is not None else None
+                tier_tables = [tier_table_name(table_name, limit) for limit in parse_tiers(args.tiers)] if args.tiers else []
+                delete_zone(conn, table_name, zone, epoch_table, tier_tables, commit=False)
+
+                cur = conn.cursor()
+                if epoch_table:
+                    insert_stars(conn, cur, epoch_table, moved, args.batch_size, epoch_columns)
+
+                if args.tiers:
+                    for tier_table, tier in zip(tier_tables, tiers):
+                        insert_stars(conn, cur, tier_table, tier, args.batch_size, ['cell'] + columns)
+
+                count = insert_stars(conn, cur, table_name, stars, args.batch_size, columns)
+
+                update_ledger(conn, table_name, source, fingerprint, count, True, commit=False)
+                cur.close()
+    finally:
+        if postgres:
+            conn.autocommit = autocommit
+
+    return count
+
+
+def update_catalog(args):
+    """
+    update a converted database with the changed zones of its source, see the comment at the top of this module.
+    The options (--columns, --epoch, --tiers, --shard_zones) have to be the same as those of the conversion.
+    :return: (number of changed zones, number of stars in the changed zones)
+    """
+    source_format, source_location = args.source.split('::')
+    target_format, target_location = args.target.split('::')
+
+    if source_format != 'binary' or target_format not in database_targets:
+        raise Exception("update is only supported for binary sources and database targets")
+
+    columns = select_columns(args.columns)
+    source_locations = [location for location in source_zones(source_location) if os.path.exists(location)]
+    progress.start_progress(args, sum([os.path.getsize(location) for location in source_locations]))
+
+    connections = {}
+
+    def zone_target(location):
+        """ a sharded target has a database per shard, the connections are kept open for the zones of a shard """
+        nonlocal connections
+        zone_format, zone_location = target_format, target_location
+        if target_format == 'sqlite-shards':
+            zone_location = shard_target(args, target_location, int(location[-3:]))[1]
+            zone_format = 'sqlite'
+        elif target_format == 'postgres-copy':
+            zone_format = 'postgres'
+
+        if zone_location not in connections:
+            for conn, table_name in connections.values():
+                conn.close()
+            connections = {zone_location: open_update_target(args, zone_format, zone_location, columns)}
+        return connections[zone_location]
+
+    changed = 0
+    count = 0
+
+    try:
+        entries = []
+        for location in source_locations:
+            conn, table_name = zone_target(location)
+            entries.append(get_ledger_entry(conn, table_name, os.path.basename(location)))
+
+        # the checksums of the files whose size or mtime differ from the ledger are calculated in parallel with --workers
+        with progress.current.stage('checksum'):
+            if args.workers > 1:
+                with multiprocessing.Pool(args.workers) as pool:
+                    fingerprints = pool.starmap(file_fingerprint, zip(source_locations, entries))
+            else:
+                fingerprints = [file_fingerprint(location, entry) for location, entry in zip(source_locations, entries)]
+
+        for location, entry, fingerprint in zip(source_locations, entries, fingerprints):
+            zone = int(location[-3:])
+            source = os.path.basename(location)
+            size = os.path.getsize(location)
+            conn, table_name = zone_target(location)
+
+            if entry and entry[0] == fingerprint[0] and entry[2]:
+                if entry[3:] != fingerprint[1:]:
+                    # the same file with another mtime, so that the next update does not calculate its checksum again
+                    update_ledger(conn, table_name, source, fingerprint, entry[1], True)
+                progress.current.skip(size)
+                continue
+
+            timestamp = time.time()
+            with progress.current.stage('decode'):
+                records = read_binary_zone(location)
+            stars = replace_zone(args, conn, table_name, zone, source, fingerprint, columns, records)
+            progress.current.add(stars, size)
+
+            changed = changed + 1
+            count = count + stars
+            print(source + ": " + ("changed" if entry else "new") + ", " + str(stars) + " stars replaced in " +
+                  str(round(time.time() - timestamp, 2)) + " s")
+    finally:
+        for conn, table_name in connections.values():
+            conn.close()
+
+    if target_format == 'sqlite-shards' and changed:
+        # new zones can add shards to the manifest
+        write_manifest(target_location.split(':')[0], args.shard_zones, args.zones)
+
+    print(str(len(source_locations)) + " zones checked, " + str(changed) + " changed")
+    progress.current.finish()
+    return changed, count
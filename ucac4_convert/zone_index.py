@@ -0,0 +1,136 @@
+import os
+import sqlite3
+import numpy as np
+
+from ucac4_convert.decoder import record_size, decode_columns, stars_from_columns
+from ucac4_convert.query import number_of_zones, dec_to_zone
+from ucac4_convert.zone_reader import ZoneReader
+
+# A UCAC4 id is the zone and the running number of the star in that zone, like 451-133336. The stars of a zone
+# are the 78 byte records of its zone file in that order, so the record of a star is at a known byte offset.
+# The 'zones' table of an ascii_zonestats conversion (the zone_stats file of the u4i directory) has the number of
+# stars per zone and their accumulated sum, which maps a running number along the whole catalog to its zone
+# (1 = the first star of z001), and the largest declination per zone.
+
+
+def parse_ucac4_id(ucac4_id):
+    """
+    :param ucac4_id: a UCAC4 id 'ZZZ-NNNNNN', or a running number along the whole catalog
+    :return: (zone, number in the zone) of a UCAC4 id, or (None, running number)
+    """
+    ucac4_id = str(ucac4_id).strip()
+    if '-' in ucac4_id:
+        zone, number = ucac4_id.split('-')
+        return int(zone), int(number)
+    return None, int(ucac4_id)
+
+
+def format_ucac4_id(zone, number):
+    """ the UCAC4 id of the star with a running number in a zone, like 451-133336 """
+    return str(zone).zfill(3) + '-' + str(number).zfill(6)
+
+
+def record_offset(number):
+    """ the byte offset of the record of a star in its zone file, by its (1 based) running number in the zone """
+    return (number - 1) * record_size
+
+
+def zone_file(location, zone):
+    """
+    the zone file of a zone in a binary catalog
+    :param location: the directory with the zone files (../u4b), or a zone file or range in it (../z001..z900)
+    """
+    directory = location if os.path.isdir(location) else os.path.dirname(location)
+    return os.path.join(directory, 'z' + str(zone).zfill(3))
+
+
+class ZoneIndex:
+    """
+    The number of stars, their accumulated sum and the largest declination of every zone, from the 'zones' table.
+    Maps UCAC4 ids and running numbers along the catalog to a zone and a record, and declinations to zones,
+    with a binary search over the 900 zones.
+
+    Without the 'zones' table only 'ZZZ-NNNNNN' ids can be resolved, and the zones are 0.2 degrees high.
+
+    Usage:
+        index = ZoneIndex('UCAC4_zones.sqlite3')
+        zone, number = index.resolve('451-133336')
+        zone, number = index.resolve(113780093)
+    """
+
+    def __init__(self, zones_location=None):
+        """
+        Constructor.
+        :param zones_location: sqlite database with the 'zones' table (from an ascii_zonestats conversion), or None
+        """
+        self.zones = None
+        if zones_location:
+            conn = sqlite3.connect(zones_location)
+            rows = conn.execute("SELECT zone, nr_of_stars, accumulated_sum, max_dec FROM zones ORDER BY zone").fetchall()
+            conn.close()
+
+            self.zones = np.array([row[0] for row in rows], dtype=np.int64)
+            self.nr_of_stars = np.array([row[1] for row in rows], dtype=np.int64)
+            self.accumulated_sum = np.array([row[2] for row in rows], dtype=np.int64)
+            self.max_dec = np.array([row[3] for row in rows], dtype=np.float64)
+
+    def resolve(self, ucac4_id):
+        """
+        :param ucac4_id: a UCAC4 id 'ZZZ-NNNNNN', or a running number along the whole catalog
+        :return: (zone, number in the zone)
+        """
+        zone, number = parse_ucac4_id(ucac4_id)
+
+        if zone is None:
+            if self.zones is None:
+                raise Exception("a running number along the catalog needs the 'zones' table (--zones)")
+
+            # the first zone with an accumulated sum >= number
+            index = int(np.searchsorted(self.accumulated_sum, number, 'left'))
+            if number < 1 or index >= len(self.zones):
+                raise Exception("star " + str(number) + " is not in the catalog")
+            zone = int(self.zones[index])
+            number = number - int(self.accumulated_sum[index] - self.nr_of_stars[index])
+
+        if zone < 1 or zone > number_of_zones:
+            raise Exception("zone " + str(zone) + " is not a UCAC4 zone")
+
+        if self.zones is not None:
+            index = int(np.searchsorted(self.zones, zone))
+            if index >= len(self.zones) or self.zones[index] != zone or not 1 <= number <= self.nr_of_stars[index]:
+                raise Exception("star " + format_ucac4_id(zone, number) + " is not in the catalog")
+
+        return zone, number
+
+    def running_number(self, zone, number):
+        """ the running number along the whole catalog of the star with a running number in a zone """
+        if self.zones is None:
+            raise Exception("a running number along the catalog needs the 'zones' table (--zones)")
+
+        index = int(np.searchsorted(self.zones, zone))
+        return int(self.accumulated_sum[index] - self.nr_of_stars[index]) + number
+
+    def dec_to_zone(self, dec):
+        """ the zone (1..900) of a declination, from the largest declination of every zone """
+        if self.zones is None:
+            return dec_to_zone(dec)
+
+        # a declination on the border of two zones is in the northern zone, like in query.dec_to_zone
+        return int(self.zones[min(int(np.searchsorted(self.max_dec, dec, 'right')), len(self.zones) - 1)])
+
+
+def read_zone_record(location, zone, number):
+    """
+    read the record of a single star from its zone file, at its byte offset (the file is memory mapped)
+    :param location: the directory with the zone files, see zone_file
+    :return: numpy array with the record (ucac4_dtype)
+    """
+    with ZoneReader(zone_file(location, zone)) as reader:
+        # raises an IndexError when the zone file has no star with this number
+        reader.get(number)
+        return reader[number - 1:number].copy()
+
+
+def read_zone_star(location, zone, number, columns):
+    """ :return: the star tuple (zone and the selected columns) of a star in a zone file """
+    return stars_from_columns(zone, decode_columns(read_zone_record(location, zone, number), columns))[0]
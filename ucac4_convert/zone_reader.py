@@ -0,0 +1,104 @@
+import os
+import mmap
+import bisect
+import numpy as np
+
+from ucac4_convert.decoder import ucac4_dtype, record_size, decode_columns
+
+
+class ZoneReader:
+    """
+    Random access to the 78 byte records of a binary zone file (z001..z900) without reading or copying it.
+
+    The file is memory mapped (read only) and exposed as a numpy structured array with ucac4_dtype,
+    so only the pages that are accessed are read, and all processes that open the same zone file
+    share one copy of it in the page cache.
+
+    Records can be accessed with their UCAC4 running number (get), or by (0 based) numpy indexing and slicing.
+    Stars within a zone are sorted on ra, so an ra range is found with a binary search.
+
+    Usage:
+        with ZoneReader('u4b/z451') as reader:
+            record = reader.get(133336)
+            records = reader.ra_range(10.0, 10.5)
+    """
+
+    def __init__(self, source_location):
+        """
+        Constructor.
+        :param source_location: path of a binary zone file, like ../u4b/z001
+        """
+        self.source_location = source_location
+        self.zone = int(source_location[-3:])
+        self.file = open(source_location, "rb")
+        self.mmap = None
+
+        size = os.path.getsize(source_location)
+        if size == 0:
+            # an empty file can not be memory mapped
+            self.records = np.empty(0, dtype=ucac4_dtype)
+        else:
+            self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.records = np.frombuffer(self.mmap, dtype=ucac4_dtype, count=size // record_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, index):
+        """ numpy indexing (0 based), slices return views on the file without copying """
+        return self.records[index]
+
+    def close(self):
+        """
+        close the memory map. Views on the records that are still in use keep the map open,
+        in that case it is closed when they are garbage collected.
+        """
+        self.records = None
+        if self.mmap:
+            try:
+                self.mmap.close()
+            except BufferError:
+                pass
+            self.mmap = None
+        self.file.close()
+
+    def get(self, record_number):
+        """
+        the record with the running number along the zone, as used in UCAC4 ids (zzz-nnnnnn, 1 based)
+        """
+        if record_number < 1 or record_number > len(self.records):
+            raise IndexError("record " + str(record_number) + " is not in zone " + str(self.zone))
+        return self.records[record_number - 1]
+
+    def ra_to_index(self, ra, side='left'):
+        """
+        binary search for the index where a star with this ra (degrees) would be in the zone.
+        The search reads only the ra of the records it visits: np.searchsorted would first copy the
+        whole (strided) ra field of the zone into a contiguous array.
+        """
+        ra_mas = round(ra * 3600000)
+        search = bisect.bisect_left if side == 'left' else bisect.bisect_right
+        return search(self.records['ra'], ra_mas)
+
+    def ra_range(self, ra_min, ra_max):
+        """
+        the records with ra_min <= ra <= ra_max (degrees), found with a binary search.
+        When ra_min > ra_max the range wraps around ra = 0/360, and the two parts are concatenated (copied).
+        Otherwise the result is a view on the file.
+        """
+        if ra_min > ra_max:
+            return np.concatenate([self.ra_range(ra_min, 360), self.ra_range(0, ra_max)])
+
+        start = self.ra_to_index(ra_min, 'left')
+        stop = self.ra_to_index(ra_max, 'right')
+        return self.records[start:stop]
+
+    def columns(self, start=0, stop=None):
+        """ the records start..stop decoded into the columns of the 'stars' table """
+        return decode_columns(self.records[start:stop])